@@ -16,23 +16,38 @@ from aiogram.types import (
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from .catalog import search_cache
+from .catalog_index import index as catalog_index
 from .config import settings
 from .db import (
+    backup_database,
+    pool_stats,
+    product_cache,
+    retention,
+    shard_stats,
+    write_behind,
+    writer_stats,
+)
+from .storage import (
     add_color,
-    add_photo_file_id,
+    adjust_variant_stock,
     clear_product_publications,
     delete_product,
     get_product,
     get_product_publications,
+    save_product_bundle,
     save_product_publication,
     set_color_active,
     set_product_active,
     set_variant_active,
+    set_variant_stock,
     toggle_product_sale,
     update_product_description,
     update_product_price,
-    upsert_product,
 )
+from .similar import similar_index
+from .stock import stock
+from .vocab import CATEGORIES, CATEGORY_LABELS, GENDER_LABELS, GENDERS, SEASON_LABELS, SEASONS
 
 router = Router(name="admin")
 
@@ -44,29 +59,6 @@ PRIVATE_FILTER = F.chat.type == ChatType.PRIVATE
 
 WHOLESALE_NOTE = "По вопросам закупок по оптовым ценам обращайтесь по тел. +7(903)776-17-47"
 
-GENDERS = [
-    ("Мужской", "male"),
-    ("Женский", "female"),
-]
-
-CATEGORIES = [
-    ("Брюки", "pants"),
-    ("Толстовка", "hoodie"),
-    ("Футболка", "tshirt"),
-    ("Шорты", "shorts"),
-    ("Безрукавка", "vest"),
-    ("Анорак", "anorak"),
-    ("Куртка", "jacket"),
-    ("Спортивный костюм", "tracksuit"),
-]
-
-SEASONS = [
-    ("Лето", "summer"),
-    ("Весна-Осень", "autumn"),
-    ("Зима", "winter"),
-    ("Еврозима", "euro_winter"),
-]
-
 INSULATIONS = [
     ("Нет", ""),
     ("Тинсулейт", "thinsulate"),
@@ -76,29 +68,6 @@ INSULATIONS = [
 
 SIZES = ["S", "M", "L", "XL", "XXL", "XXXL"]
 
-GENDER_LABELS = {
-    "male": "мужской",
-    "female": "женский",
-}
-
-CATEGORY_LABELS = {
-    "pants": "брюки",
-    "hoodie": "толстовка",
-    "tshirt": "футболка",
-    "shorts": "шорты",
-    "vest": "безрукавка",
-    "anorak": "анорак",
-    "jacket": "куртка",
-    "tracksuit": "спортивный костюм",
-}
-
-SEASON_LABELS = {
-    "summer": "лето",
-    "autumn": "Весна-Осень",
-    "winter": "зима",
-    "euro_winter": "еврозима",
-}
-
 INSULATION_LABELS = {
     "": "",
     "thinsulate": "тинсулейт",
@@ -423,30 +392,26 @@ def _seller_deep_link(sku: str) -> str:
     return f"https://t.me/{bot_username}?start=manager_{sku}" if sku else f"https://t.me/{bot_username}?start=manager"
 
 async def _save_add_session(s: AddSession) -> None:
-    await upsert_product(
-        sku=s.sku,
-        title=s.title,
-        description=_ensure_note(s.description),
-        gender=s.gender,
-        category=s.category,
-        season=s.season,
-        insulation=s.insulation,
-        material=s.material,
-        price=s.price,
-        currency="RUB",
-        is_active=True,
-        is_sale=s.is_sale,
+    await save_product_bundle(
+        product={
+            "sku": s.sku,
+            "title": s.title,
+            "description": _ensure_note(s.description),
+            "gender": s.gender,
+            "category": s.category,
+            "season": s.season,
+            "insulation": s.insulation,
+            "material": s.material,
+            "price": s.price,
+            "currency": "RUB",
+            "is_active": True,
+            "is_sale": s.is_sale,
+        },
+        sizes={size: size in s.sizes for size in SIZES},
+        colors=_unique_keep_order(s.colors),
+        photo_file_ids=s.photo_file_ids,
     )
 
-    for size in SIZES:
-        await set_variant_active(s.sku, size, size in s.sizes)
-
-    for color in _unique_keep_order(s.colors):
-        await add_color(s.sku, color)
-
-    for file_id in s.photo_file_ids:
-        await add_photo_file_id(s.sku, file_id)
-
 
 async def send_product_card(chat_id: int, sku: str, bot: Bot) -> None:
     p = await get_product(sku)
@@ -560,6 +525,157 @@ async def admin_start(m: Message):
     await m.answer("Админ-меню:", reply_markup=_admin_home_kb())
 
 
+@router.message(Command("dbstats"), PRIVATE_FILTER, ADMIN_FILTER)
+async def admin_dbstats(m: Message):
+    if not m.from_user or not _is_admin(m.from_user.id):
+        return
+
+    pool = pool_stats()
+    lines = [
+        "🗄 База данных",
+        f"Пул: {pool.get('size', 0)} соед., занято {pool.get('in_use', 0)}, ждут {pool.get('waiting', 0)}",
+        f"Выдач: {pool.get('checkouts', 0)}",
+        f"Ожидание: ср. {pool.get('wait_avg_ms', 0)} мс, макс. {pool.get('wait_max_ms', 0)} мс",
+    ]
+
+    w = writer_stats()
+    lines.append(
+        f"Запись: очередь {w.get('queue_depth', 0)} (макс. {w.get('queue_depth_max', 0)}), "
+        f"коммитов {w.get('batches', 0)}, записей {w.get('writes', 0)}, "
+        f"пачка ср. {w.get('batch_avg', 0)} / макс. {w.get('batch_max', 0)}, "
+        f"коммит ср. {w.get('commit_avg_ms', 0)} мс"
+    )
+
+    for sh in shard_stats():
+        lines.append(
+            f"Шард {sh['index']}: очередь {sh.get('queue_depth', 0)}, "
+            f"коммитов {sh.get('batches', 0)}, записей {sh.get('writes', 0)}, "
+            f"коммит ср. {sh.get('commit_avg_ms', 0)} мс"
+        )
+
+    idx = catalog_index.stats()
+    lines.append(
+        f"Индекс каталога: {'готов' if idx['ready'] else 'холодный'}, "
+        f"товаров {idx['products']}, размеров {idx['sizes']}, цветов {idx['colors']}, "
+        f"слов для нечеткого поиска {idx['terms']}"
+    )
+
+    sim = similar_index.stats()
+    lines.append(
+        f"Индекс похожих: {'готов' if sim['ready'] else 'холодный'}, "
+        f"товаров {sim['products']}, n-грамм {sim['grams']}"
+    )
+
+    st = stock.stats()
+    lines.append(
+        f"Остатки: {'учитываются' if settings.STOCK_TRACKING else 'не учитываются'}, "
+        f"товаров {st['skus']}, размеров {st['sizes']}, в наличии {st['in_stock']} позиций"
+    )
+
+    sc = search_cache.stats()
+    lines.append(
+        f"Кэш поиска: {sc['size']}/{sc['maxsize']}, попаданий {sc['hits']}, "
+        f"промахов {sc['misses']} ({sc['hit_rate']:.0%})"
+    )
+
+    pc = product_cache.stats()
+    lines.append(
+        f"Кэш товаров: {pc['size']}/{pc['maxsize']}, попаданий {pc['hits']}, "
+        f"промахов {pc['misses']} ({pc['hit_rate']:.0%})"
+    )
+
+    rt = retention.stats()
+    if rt["runs"]:
+        last = rt["last_report"]
+        deleted = ", ".join(
+            f"{table} {last[table]}"
+            for table in ("sales_sessions", "conversation_messages", "conversations", "orders")
+            if table in last
+        )
+        lines.append(
+            f"Очистка: запусков {rt['runs']}, удалено всего {rt['total_deleted']}; "
+            f"последний раз: {deleted or '-'}, заказов в архив {last.get('sales_orders_archived', 0)}, "
+            f"свободных страниц {last.get('free_pages', 0)}"
+        )
+
+    if write_behind is not None:
+        wb = write_behind.stats()
+        lines.append(
+            f"Отложенная запись ({wb['interval_ms']} мс): в буфере сессий {wb['pending_sessions']}, "
+            f"сообщений {wb['pending_messages']}; записей {wb['writes']}, "
+            f"сбросов {wb['flushes']}, строк {wb['flushed_rows']}"
+        )
+    await m.answer("\n".join(lines))
+
+
+@router.message(Command("backup"), PRIVATE_FILTER, ADMIN_FILTER)
+async def admin_backup(m: Message):
+    if not m.from_user or not _is_admin(m.from_user.id):
+        return
+
+    if settings.STORAGE_BACKEND != "sqlite":
+        return await m.answer("Резервные копии делаются только для SQLite-хранилища.")
+
+    await m.answer("Делаю резервную копию базы…")
+    try:
+        res = await backup_database()
+    except Exception as e:
+        return await m.answer(f"Не удалось сделать копию: {e}")
+
+    await m.answer(
+        "💾 Резервная копия готова\n"
+        f"Файл: {res['path']}\n"
+        + (f"Шардов: {len(res['shards'])}\n" if res["shards"] else "")
+        + f"Размер: {res['bytes'] / 2**20:.1f} МБ\n"
+        f"Время: {res['seconds']:.2f} с ({res['steps']} шагов)\n"
+        f"Хранится копий: {res['kept']}, удалено старых: {len(res['removed'])}"
+    )
+
+
+@router.message(Command("stock"), PRIVATE_FILTER, ADMIN_FILTER)
+async def admin_stock(m: Message):
+    if not m.from_user or not _is_admin(m.from_user.id):
+        return
+
+    usage = (
+        "Формат:\n"
+        "/stock SKU — остатки по размерам\n"
+        "/stock SKU L 5 — установить остаток\n"
+        "/stock SKU L +3 (или -1) — изменить остаток"
+    )
+    parts = (m.text or "").split()
+    if len(parts) not in (2, 4):
+        return await m.answer(usage)
+
+    sku = _normalize_sku(parts[1])
+    if len(parts) == 4:
+        size, amount = parts[2].strip().upper(), parts[3].strip()
+        try:
+            n = int(amount)
+        except ValueError:
+            return await m.answer(usage)
+        if amount[0] in "+-":
+            if await adjust_variant_stock(sku, size, n) is None:
+                return await m.answer(f"Не удалось: нет активного размера {size} у {sku} или остаток уйдет в минус.")
+        elif await set_variant_stock(sku, size, n) is None:
+            return await m.answer(f"У {sku} нет размера {size}.")
+
+    p = await get_product(sku)
+    if not p:
+        return await m.answer("Товар не найден.")
+
+    by_size = {v["size"]: v for v in p.get("sizes", [])}
+    lines = [f"📦 Остатки {sku}:"]
+    for size in _sort_sizes(list(by_size)):
+        v = by_size[size]
+        lines.append(f"{size}: {v.get('stock') or 0}" + ("" if v.get("is_active") else " (размер выключен)"))
+    if not by_size:
+        lines.append("Размеры не заданы.")
+    if not settings.STOCK_TRACKING:
+        lines.append("\nУчёт остатков выключен (STOCK_TRACKING=0): поиск и оформление их не учитывают.")
+    await m.answer("\n".join(lines))
+
+
 @router.callback_query(F.data == "adm:edit")
 async def adm_edit(cb: CallbackQuery):
     if not cb.from_user or not _is_admin(cb.from_user.id):
@@ -1,8 +1,98 @@
+import base64
+import json
+import re
+import zlib
 from typing import Any, Optional
 
-import aiosqlite
-
+from .cache import LRUCache
+from .catalog_index import index
 from .config import settings
+from .db import card_colors, card_sizes, catalog_version, connection, fts_enabled
+from .similar import similar_index
+
+# Common Russian inflectional endings, longest first. Stripping them and
+# searching by prefix lets "куртка" match "куртки"/"куртку" without a full
+# stemmer.
+_RU_ENDINGS = (
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "иях",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ой", "ей", "ий", "ый", "ую", "юю",
+    "ах", "ях", "ам", "ям", "ов", "ев", "ом", "ем", "ью",
+    "а", "я", "ы", "и", "у", "ю", "е", "о", "ь", "й",
+)
+_MIN_STEM = 3
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# bm25 column weights: title, description, sku, category, material
+_BM25 = "bm25(products_fts, 10.0, 1.0, 5.0, 3.0, 2.0)"
+
+# Results are tagged with db.catalog_version(), so any catalog write makes
+# every cached search stale; the TTL only bounds memory for idle keys.
+search_cache = LRUCache(settings.SEARCH_CACHE_SIZE, settings.SEARCH_CACHE_TTL)
+
+
+def stem(word: str) -> str:
+    """Strip one Russian inflection ending, keeping at least three letters."""
+    if not re.search(r"[а-яё]", word):
+        return word
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[: -len(ending)]
+    return word
+
+
+def query_stems(text: str) -> list[str]:
+    """Stems of every word in a search query, lowercased with ё folded."""
+    words = _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    return [stem(w) for w in words if w and w != "_"]
+
+
+def fts_query(text: str) -> str:
+    """Build an FTS5 MATCH expression: every word as a quoted stem prefix."""
+    return " ".join(f'"{s}"*' for s in query_stems(text))
+
+
+def _norm_text(value: Optional[str]) -> str:
+    return " ".join((value or "").lower().split())
+
+
+def _norm_price(value: Optional[float]) -> Optional[int]:
+    if value is None:
+        return None
+    return int(round(float(value)))
+
+
+_RESULT_COLUMNS = """
+    p.sku, p.title, p.description, p.gender, p.category, p.season,
+    p.insulation, p.material, p.price, p.currency, p.is_sale,
+    c.variants_json, c.colors_json, p.created_at
+"""
+
+
+def _copy_results(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return [dict(r, sizes=list(r["sizes"]), colors=list(r["colors"])) for r in rows]
+
+
+def normalize_args(
+    query: str = "",
+    color: Optional[str] = None,
+    size: Optional[str] = None,
+    gender: Optional[str] = None,
+    category: Optional[str] = None,
+    season: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+) -> dict[str, Any]:
+    """Search arguments in canonical form: the cache key and cursor fingerprint."""
+    return {
+        "query": _norm_text(query),
+        "color": _norm_text(color) or None,
+        "size": (size or "").strip().upper() or None,
+        "gender": _norm_text(gender) or None,
+        "category": _norm_text(category) or None,
+        "season": _norm_text(season) or None,
+        "min_price": _norm_price(min_price),
+        "max_price": _norm_price(max_price),
+    }
 
 
 async def search_products(
@@ -16,23 +106,61 @@ async def search_products(
     max_price: Optional[float] = None,
     limit: int = 6,
 ) -> list[dict[str, Any]]:
+    args = normalize_args(query, color, size, gender, category, season, min_price, max_price)
+    args["limit"] = int(limit)
+    key = tuple(args.values())
+    version = catalog_version()
+
+    cached = search_cache.get(key, version)
+    if cached is not None:
+        return _copy_results(cached)
+
+    results = await _search_uncached(**args)
+    search_cache.set(key, _copy_results(results), version)
+    return results
+
+
+def _where(
+    query: str,
+    color: Optional[str],
+    size: Optional[str],
+    gender: Optional[str],
+    category: Optional[str],
+    season: Optional[str],
+    min_price: Optional[float],
+    max_price: Optional[float],
+) -> tuple[list[str], list[Any], str]:
+    """WHERE terms and params for the filters, plus the FTS match ("" when unused)."""
     where = ["p.is_active = 1"]
     params: list[Any] = []
 
-    if query:
-        where.append("(p.title LIKE ? OR p.description LIKE ? OR p.sku LIKE ? OR p.category LIKE ?)")
-        q = f"%{query}%"
+    match = fts_query(query) if query and fts_enabled() else ""
+    if match:
+        where.append("products_fts MATCH ?")
+        params.append(match)
+    elif query:
+        # Query and color arrive lowercased (see normalize_args); compare
+        # against lowercased columns so Cyrillic matches regardless of case.
+        where.append(
+            "(unicode_lower(p.title) LIKE ? OR unicode_lower(p.description) LIKE ?"
+            " OR unicode_lower(p.sku) LIKE ? OR unicode_lower(p.category) LIKE ?)"
+        )
+        q = f"%{query.lower()}%"
         params.extend([q, q, q, q])
 
     if color:
+        # ё folded like the catalog index's color facet and vocab's stems.
         where.append(
-            "EXISTS (SELECT 1 FROM product_colors pc WHERE pc.sku = p.sku AND pc.is_active = 1 AND pc.color LIKE ?)"
+            "EXISTS (SELECT 1 FROM product_colors pc WHERE pc.sku = p.sku AND pc.is_active = 1"
+            " AND replace(unicode_lower(pc.color), 'ё', 'е') LIKE ?)"
         )
-        params.append(f"%{color}%")
+        params.append(f"%{color.lower().replace('ё', 'е')}%")
 
     if size:
+        in_stock = " AND pv.stock > 0" if settings.STOCK_TRACKING else ""
         where.append(
-            "EXISTS (SELECT 1 FROM product_variants pv WHERE pv.sku = p.sku AND pv.is_active = 1 AND pv.size = ?)"
+            "EXISTS (SELECT 1 FROM product_variants pv"
+            f" WHERE pv.sku = p.sku AND pv.is_active = 1 AND pv.size = ?{in_stock})"
         )
         params.append(size.strip().upper())
 
@@ -56,51 +184,261 @@ async def search_products(
         where.append("p.price <= ?")
         params.append(float(max_price))
 
-    sql = """
-        SELECT p.sku, p.title, p.description, p.gender, p.category, p.season,
-               p.insulation, p.material, p.price, p.currency, p.is_sale
-        FROM products p
-    """
-    if where:
-        sql += " WHERE " + " AND ".join(where)
-    sql += " ORDER BY p.is_sale DESC, p.created_at DESC LIMIT ?"
+    return where, params, match
+
+
+def _from(match: str) -> str:
+    sql = " FROM products p JOIN product_cards c ON c.sku = p.sku"
+    if match:
+        sql += " JOIN products_fts ON products_fts.rowid = p.rowid"
+    return sql
+
+
+def _result(r: Any) -> dict[str, Any]:
+    return {
+        "sku": r[0],
+        "title": r[1],
+        "description": r[2],
+        "gender": r[3],
+        "category": r[4],
+        "season": r[5],
+        "insulation": r[6],
+        "material": r[7],
+        "price": r[8],
+        "currency": r[9],
+        "is_sale": bool(r[10]),
+        "sizes": card_sizes(r[11]),
+        "colors": card_colors(r[12]),
+    }
+
+
+async def _search_uncached(
+    query: str = "",
+    color: Optional[str] = None,
+    size: Optional[str] = None,
+    gender: Optional[str] = None,
+    category: Optional[str] = None,
+    season: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = 6,
+) -> list[dict[str, Any]]:
+    filters = {
+        "color": color,
+        "size": size,
+        "gender": gender,
+        "category": category,
+        "season": season,
+        "min_price": min_price,
+        "max_price": max_price,
+    }
+    indexed = index.search(query=query, limit=limit, **filters)
+    if indexed is not None:
+        return indexed
+
+    where, params, match = _where(query, **filters)
+    sql = f"SELECT {_RESULT_COLUMNS}{_from(match)} WHERE " + " AND ".join(where)
+    if match:
+        sql += f" ORDER BY {_BM25}, p.is_sale DESC, p.created_at DESC LIMIT ?"
+    else:
+        sql += " ORDER BY p.is_sale DESC, p.created_at DESC, p.sku DESC LIMIT ?"
     params.append(int(limit))
 
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with connection() as db:
         cur = await db.execute(sql, tuple(params))
         rows = await cur.fetchall()
 
-    results = []
-    for r in rows:
-        sku = r[0]
-
-        async with aiosqlite.connect(settings.DB_PATH) as db:
-            cur = await db.execute(
-                "SELECT size FROM product_variants WHERE sku = ? AND is_active = 1 ORDER BY size",
-                (sku,),
-            )
-            sizes = [row[0] for row in await cur.fetchall()]
-
-            cur = await db.execute(
-                "SELECT color FROM product_colors WHERE sku = ? AND is_active = 1 ORDER BY color",
-                (sku,),
-            )
-            colors = [row[0] for row in await cur.fetchall()]
-
-        results.append({
-            "sku": sku,
-            "title": r[1],
-            "description": r[2],
-            "gender": r[3],
-            "category": r[4],
-            "season": r[5],
-            "insulation": r[6],
-            "material": r[7],
-            "price": r[8],
-            "currency": r[9],
-            "is_sale": bool(r[10]),
-            "sizes": sizes,
-            "colors": colors,
-        })
+    results = [_result(r) for r in rows]
+
+    if not results and query:
+        # Misspelled or transliterated words ("худик", "anorak").
+        fuzzy = index.fuzzy_search(query, limit=limit, **filters)
+        if fuzzy:
+            return fuzzy
+
+    return results
+
+
+# -------- "Show more" pages --------
+# A page ends with an opaque cursor naming the last row's position in the
+# page order, so the next page is a range read that starts right after it
+# (one index seek) instead of OFFSET re-reading every earlier page. Three
+# orders, one per kind of search:
+#   "k": filters / LIKE   is_sale DESC, created_at DESC, sku DESC
+#   "r": FTS query        bm25, is_sale DESC, created_at DESC, sku
+#   "f": fuzzy fallback   in-memory scoring; the cursor is an offset
+# The cursor also carries a checksum of the filters, so it can't be
+# replayed against a different search.
+
+
+def _fingerprint(args: dict[str, Any]) -> int:
+    return zlib.crc32(json.dumps(args, sort_keys=True, ensure_ascii=False).encode())
+
+
+def encode_cursor(args: dict[str, Any], mode: str, key: tuple) -> str:
+    raw = json.dumps([_fingerprint(args), mode, *key], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(args: dict[str, Any], cursor: Optional[str]) -> Optional[tuple[str, tuple]]:
+    """(mode, key) from a cursor made for the same ``args``; None for the first page.
+
+    Raises ValueError for a malformed cursor or one from another search.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        fingerprint, mode, *key = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+    if fingerprint != _fingerprint(args) or mode not in ("k", "r", "f"):
+        raise ValueError("cursor does not belong to this search")
+    return mode, tuple(key)
+
+
+async def search_products_page(
+    query: str = "",
+    color: Optional[str] = None,
+    size: Optional[str] = None,
+    gender: Optional[str] = None,
+    category: Optional[str] = None,
+    season: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = 6,
+    cursor: Optional[str] = None,
+) -> dict[str, Any]:
+    """One page of ``search_products`` results.
+
+    Returns {"items": [...], "next_cursor": str | None}; pass next_cursor
+    back with the same filters for the following page.
+    """
+    args = normalize_args(query, color, size, gender, category, season, min_price, max_price)
+    position = decode_cursor(args, cursor)
+    limit = int(limit)
+
+    key = (*args.values(), limit, cursor)
+    version = catalog_version()
+    cached = search_cache.get(key, version)
+    if cached is not None:
+        return {"items": _copy_results(cached["items"]), "next_cursor": cached["next_cursor"]}
+
+    page = await _page_uncached(args, position, limit)
+    search_cache.set(key, {"items": _copy_results(page["items"]), "next_cursor": page["next_cursor"]}, version)
+    return page
+
+
+async def _page_uncached(args: dict[str, Any], position: Optional[tuple[str, tuple]], limit: int) -> dict[str, Any]:
+    query = args["query"]
+    filters = {k: v for k, v in args.items() if k != "query"}
+    mode, after = position or (None, None)
+
+    if mode == "f":
+        return _fuzzy_page(args, after[0], limit)
+
+    if not query:
+        indexed = index.search_page(after=after, limit=limit, **filters)
+        if indexed is not None:
+            items, last = indexed
+            return {"items": items, "next_cursor": encode_cursor(args, "k", last) if last else None}
+
+    where, params, match = _where(query, **filters)
+    if match:
+        # bm25 is only computable next to the MATCH, hence the subquery.
+        sql = (
+            f"SELECT * FROM (SELECT {_RESULT_COLUMNS}, {_BM25} AS score{_from(match)}"
+            f" WHERE {' AND '.join(where)})"
+        )
+        if after:
+            sql += " WHERE (score, -is_sale, -created_at, sku) > (?, ?, ?, ?)"
+            score, is_sale, created_at, sku = after
+            params.extend([score, -int(is_sale), -int(created_at), sku])
+        sql += " ORDER BY score, is_sale DESC, created_at DESC, sku LIMIT ?"
+    else:
+        if after:
+            where.append("(p.is_sale, p.created_at, p.sku) < (?, ?, ?)")
+            params.extend([int(after[0]), int(after[1]), after[2]])
+        sql = f"SELECT {_RESULT_COLUMNS}{_from(match)} WHERE " + " AND ".join(where)
+        sql += " ORDER BY p.is_sale DESC, p.created_at DESC, p.sku DESC LIMIT ?"
+    params.append(limit + 1)
+
+    async with connection() as db:
+        cur = await db.execute(sql, tuple(params))
+        rows = await cur.fetchall()
+
+    if not rows and query and position is None:
+        # Misspelled or transliterated words ("худик", "anorak").
+        return _fuzzy_page(args, 0, limit)
+
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit and page:
+        last = page[-1]
+        if match:
+            next_cursor = encode_cursor(args, "r", (last[14], bool(last[10]), last[13], last[0]))
+        else:
+            next_cursor = encode_cursor(args, "k", (bool(last[10]), last[13], last[0]))
+    return {"items": [_result(r) for r in page], "next_cursor": next_cursor}
+
+
+def _fuzzy_page(args: dict[str, Any], offset: int, limit: int) -> dict[str, Any]:
+    filters = {k: v for k, v in args.items() if k != "query"}
+    found = index.fuzzy_search(args["query"], limit=offset + limit + 1, **filters) or []
+    next_cursor = encode_cursor(args, "f", (offset + limit,)) if len(found) > offset + limit else None
+    return {"items": found[offset : offset + limit], "next_cursor": next_cursor}
+
+
+# -------- Similar products --------
+
+
+async def find_similar(
+    sku: str = "",
+    query: str = "",
+    color: Optional[str] = None,
+    size: Optional[str] = None,
+    limit: int = 6,
+) -> list[dict[str, Any]]:
+    """Products most like ``sku`` (or a free-form ``query``), best first.
+
+    ``color``/``size`` keep only products offered in them, e.g. alternatives
+    to an item that is out of the buyer's size. Candidates come from the
+    TF-IDF index, filtered through the catalog index's normalized facets
+    (or over-fetched and filtered in SQL while it is cold); one SQL read
+    loads the results.
+    """
+    sku = (sku or "").strip()
+    args = normalize_args(query, color, size)
+    limit = int(limit)
+    key = ("similar", sku, args["query"], args["color"], args["size"], limit)
+    version = catalog_version()
+
+    cached = search_cache.get(key, version)
+    if cached is not None:
+        return _copy_results(cached)
+
+    filtered = bool(args["color"] or args["size"])
+    allow = index.matcher(color=args["color"], size=args["size"]) if filtered else None
+    fetch = max(limit * 8, 50) if filtered and allow is None else limit
+    if sku:
+        ranked = similar_index.similar(sku, limit=fetch, allow=allow)
+    else:
+        ranked = similar_index.rank_text(args["query"], limit=fetch, allow=allow)
+    if not ranked:
+        return []
+
+    scores = dict(ranked)
+    if allow is None:
+        where, params, _ = _where("", args["color"], args["size"], None, None, None, None, None)
+    else:
+        where, params = ["p.is_active = 1"], []
+    where.append(f"p.sku IN ({','.join('?' * len(scores))})")
+    params.extend(scores)
+    async with connection() as db:
+        cur = await db.execute(f"SELECT {_RESULT_COLUMNS}{_from('')} WHERE " + " AND ".join(where), tuple(params))
+        rows = await cur.fetchall()
 
+    rows.sort(key=lambda r: -scores[r[0]])
+    results = [_result(r) for r in rows[:limit]]
+    search_cache.set(key, _copy_results(results), version)
     return results
@@ -0,0 +1,608 @@
+"""
+In-process faceted catalog index.
+
+Keeps one bitset (a Python int, bit = product slot) per facet value:
+gender, category, season, every active size, every normalized color and
+is_sale, plus a price-sorted array for range filters. Filtered searches
+without a text query become bitset intersections and a bisect instead of
+SQL with correlated EXISTS subqueries. A trigram index over the words of
+titles, categories and colors backs ``fuzzy_search()``, the fallback for
+misspelled or transliterated queries that match nothing exactly.
+
+The index is seeded from products and product_cards by ``load()`` and
+refreshed per sku through ``db.on_product_change``. With STOCK_TRACKING the
+size facet only holds sizes in stock, and a sell-out or restock flips one
+bit through ``db.on_stock_change``. While it is cold (not loaded yet)
+``search()`` and ``search_page()`` return None and the caller falls back
+to SQL.
+"""
+
+from __future__ import annotations
+
+import heapq
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from .config import settings
+from .db import card_colors, card_sizes, connection, on_product_change, on_stock_change
+
+_PRODUCT_COLUMNS = (
+    "sku,title,description,gender,category,season,insulation,material,price,currency,is_sale,created_at"
+)
+
+
+def _norm(value: Any) -> str:
+    return str(value or "").strip().lower().replace("ё", "е")
+
+
+_LETTERS_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+# Latin -> Cyrillic for transliterated queries ("anorak", "kurtka"),
+# digraphs first.
+_TRANSLIT = (
+    ("shch", "щ"), ("sch", "щ"), ("zh", "ж"), ("kh", "х"), ("ch", "ч"), ("sh", "ш"),
+    ("ts", "ц"), ("yu", "ю"), ("ya", "я"), ("yo", "е"), ("ye", "е"),
+    ("a", "а"), ("b", "б"), ("v", "в"), ("g", "г"), ("d", "д"), ("e", "е"), ("z", "з"),
+    ("i", "и"), ("y", "ы"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"),
+    ("p", "п"), ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("f", "ф"), ("h", "х"),
+    ("c", "к"), ("w", "в"), ("x", "кс"), ("j", "дж"), ("q", "к"),
+)
+
+
+def words(text: str) -> list[str]:
+    """Lowercased letter runs (no digits/underscores), ё folded to е."""
+    return _LETTERS_RE.findall((text or "").lower().replace("ё", "е"))
+
+
+def _translit(word: str) -> str:
+    for latin, cyrillic in _TRANSLIT:
+        word = word.replace(latin, cyrillic)
+    return word
+
+
+def _trigrams(word: str) -> set[str]:
+    padded = f"  {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class _Desc(str):
+    """A str that sorts in reverse, for DESC tiebreaks inside tuple keys."""
+
+    def __lt__(self, other: str) -> bool:
+        return str.__gt__(self, other)
+
+    def __le__(self, other: str) -> bool:
+        return str.__ge__(self, other)
+
+    def __gt__(self, other: str) -> bool:
+        return str.__lt__(self, other)
+
+    def __ge__(self, other: str) -> bool:
+        return str.__le__(self, other)
+
+
+def listing_key(is_sale: bool, created_at: int, sku: str) -> tuple[int, int, _Desc]:
+    """Sort key for ORDER BY is_sale DESC, created_at DESC, sku DESC."""
+    return (-int(is_sale), -int(created_at or 0), _Desc(sku))
+
+
+@dataclass
+class _Entry:
+    slot: int
+    sku: str
+    title: str
+    description: str
+    gender: str
+    category: str
+    season: str
+    insulation: str
+    material: str
+    price: float
+    currency: str
+    is_sale: bool
+    created_at: int
+    sizes: list[str] = field(default_factory=list)
+    colors: list[str] = field(default_factory=list)
+
+    def terms(self) -> set[str]:
+        """Words the typo-tolerant search matches against."""
+        return {*words(self.title), *words(self.category), *(w for c in self.colors for w in words(c))}
+
+    def sort_key(self) -> tuple[int, int, _Desc]:
+        return listing_key(self.is_sale, self.created_at, self.sku)
+
+    def as_result(self) -> dict[str, Any]:
+        return {
+            "sku": self.sku,
+            "title": self.title,
+            "description": self.description,
+            "gender": self.gender,
+            "category": self.category,
+            "season": self.season,
+            "insulation": self.insulation,
+            "material": self.material,
+            "price": self.price,
+            "currency": self.currency,
+            "is_sale": self.is_sale,
+            "sizes": list(self.sizes),
+            "colors": list(self.colors),
+        }
+
+
+class CatalogIndex:
+    def __init__(self) -> None:
+        self.ready = False
+        self._loading = False
+        self._dirty: set[str] = set()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._slots: dict[str, int] = {}
+        self._entries: list[Optional[_Entry]] = []
+        self._free: list[int] = []
+        self._all = 0
+        self._facets: dict[str, dict[str, int]] = {
+            "gender": {},
+            "category": {},
+            "season": {},
+            "size": {},
+            "color": {},
+        }
+        self._sale = 0
+        self._prices: list[tuple[float, int]] = []
+        self._order: list[tuple[tuple[int, int, _Desc], int]] = []
+        # Typo-tolerant search: term -> slot bits, trigram -> terms, and
+        # each term's trigram count for the Dice coefficient.
+        self._terms: dict[str, int] = {}
+        self._grams: dict[str, set[str]] = {}
+        self._term_grams: dict[str, int] = {}
+
+    # ---- maintenance ----
+
+    def _facet_values(self, e: _Entry) -> list[tuple[str, str]]:
+        pairs = [
+            ("gender", _norm(e.gender)),
+            ("category", _norm(e.category)),
+            ("season", _norm(e.season)),
+        ]
+        pairs.extend(("size", s.strip().upper()) for s in e.sizes)
+        pairs.extend(("color", _norm(c)) for c in e.colors)
+        return pairs
+
+    def _add(self, e: _Entry) -> None:
+        bit = 1 << e.slot
+        self._all |= bit
+        for facet, value in self._facet_values(e):
+            bucket = self._facets[facet]
+            bucket[value] = bucket.get(value, 0) | bit
+        if e.is_sale:
+            self._sale |= bit
+        for term in e.terms():
+            bits = self._terms.get(term, 0)
+            if not bits:
+                grams = _trigrams(term)
+                self._term_grams[term] = len(grams)
+                for gram in grams:
+                    self._grams.setdefault(gram, set()).add(term)
+            self._terms[term] = bits | bit
+        insort(self._prices, (e.price, e.slot))
+        insort(self._order, (e.sort_key(), e.slot))
+
+    def remove(self, sku: str) -> None:
+        """Drop ``sku`` from every facet and term; no-op when absent."""
+        slot = self._slots.pop(sku, None)
+        if slot is None:
+            return
+        e = self._entries[slot]
+        self._entries[slot] = None
+        self._free.append(slot)
+        if e is None:
+            return
+
+        mask = ~(1 << slot)
+        self._all &= mask
+        self._sale &= mask
+        for facet, value in self._facet_values(e):
+            bucket = self._facets[facet]
+            bits = bucket.get(value, 0) & mask
+            if bits:
+                bucket[value] = bits
+            else:
+                bucket.pop(value, None)
+        for term in e.terms():
+            bits = self._terms.get(term, 0) & mask
+            if bits:
+                self._terms[term] = bits
+                continue
+            self._terms.pop(term, None)
+            self._term_grams.pop(term, None)
+            for gram in _trigrams(term):
+                terms = self._grams.get(gram)
+                if terms is not None:
+                    terms.discard(term)
+                    if not terms:
+                        del self._grams[gram]
+        i = bisect_left(self._prices, (e.price, slot))
+        if i < len(self._prices) and self._prices[i] == (e.price, slot):
+            del self._prices[i]
+        i = bisect_left(self._order, (e.sort_key(), slot))
+        if i < len(self._order) and self._order[i] == (e.sort_key(), slot):
+            del self._order[i]
+
+    def put(self, row: tuple, sizes: list[str], colors: list[str]) -> None:
+        """Index (or re-index) a product row in _PRODUCT_COLUMNS order."""
+        sku = row[0]
+        self.remove(sku)
+        slot = self._free.pop() if self._free else len(self._entries)
+        if slot == len(self._entries):
+            self._entries.append(None)
+        e = _Entry(
+            slot=slot,
+            sku=sku,
+            title=row[1],
+            description=row[2],
+            gender=row[3],
+            category=row[4],
+            season=row[5],
+            insulation=row[6],
+            material=row[7],
+            price=float(row[8] or 0),
+            currency=row[9],
+            is_sale=bool(row[10]),
+            created_at=int(row[11] or 0),
+            sizes=sorted(sizes),
+            colors=sorted(colors),
+        )
+        self._entries[slot] = e
+        self._slots[sku] = slot
+        self._add(e)
+
+    async def _fetch(self, sku: Optional[str] = None) -> list[tuple[tuple, list[str], list[str]]]:
+        where = "WHERE p.is_active = 1" + (" AND p.sku = ?" if sku else "")
+        params = (sku,) if sku else ()
+        columns = ",".join(f"p.{c}" for c in _PRODUCT_COLUMNS.split(","))
+        async with connection() as db:
+            cur = await db.execute(
+                f"""
+                SELECT {columns}, c.variants_json, c.colors_json
+                FROM products p
+                JOIN product_cards c ON c.sku = p.sku
+                {where}
+                """,
+                params,
+            )
+            rows = await cur.fetchall()
+
+        return [(row[:-2], card_sizes(row[-2]), card_colors(row[-1])) for row in rows]
+
+    async def load(self) -> None:
+        """(Re)build the whole index from the database."""
+        self._loading = True
+        self._dirty.clear()
+        try:
+            rows = await self._fetch()
+            self._reset()
+            for row, sizes, colors in rows:
+                self.put(row, sizes, colors)
+            self.ready = True
+        finally:
+            self._loading = False
+
+        # Writes that raced with the bulk read.
+        dirty, self._dirty = self._dirty, set()
+        for sku in dirty:
+            await self.refresh(sku)
+
+    async def refresh(self, sku: str) -> None:
+        """Re-read a single sku after a catalog write."""
+        if self._loading:
+            self._dirty.add(sku)
+            return
+        if not self.ready:
+            return
+
+        rows = await self._fetch(sku)
+        if rows:
+            self.put(*rows[0])
+        else:
+            self.remove(sku)
+
+    def stock_changed(self, sku: str, size: str, old: int, new: int) -> None:
+        """Flip one size bit when a variant sells out or is restocked (``db.on_stock_change``)."""
+        if not settings.STOCK_TRACKING or (old > 0) == (new > 0):
+            return
+        if self._loading:
+            self._dirty.add(sku)
+            return
+        slot = self._slots.get(sku)
+        e = self._entries[slot] if slot is not None else None
+        if e is None:
+            return
+
+        bit = 1 << slot
+        bucket = self._facets["size"]
+        if new > 0:
+            if size not in e.sizes:
+                insort(e.sizes, size)
+            bucket[size] = bucket.get(size, 0) | bit
+        else:
+            if size in e.sizes:
+                e.sizes.remove(size)
+            bits = bucket.get(size, 0) & ~bit
+            if bits:
+                bucket[size] = bits
+            else:
+                bucket.pop(size, None)
+
+    # ---- queries ----
+
+    def _contains(self, facet: str, needle: str) -> int:
+        """Union of facet values containing ``needle`` (SQL ``LIKE %x%``)."""
+        bits = 0
+        for value, value_bits in self._facets[facet].items():
+            if needle in value:
+                bits |= value_bits
+        return bits
+
+    def _price_range(self, min_price: Optional[float], max_price: Optional[float]) -> tuple[int, int]:
+        lo = 0 if min_price is None else bisect_left(self._prices, (float(min_price), -1))
+        hi = (
+            len(self._prices)
+            if max_price is None
+            else bisect_right(self._prices, (float(max_price), len(self._entries)))
+        )
+        return lo, hi
+
+    def _filter(
+        self,
+        color: Optional[str],
+        size: Optional[str],
+        gender: Optional[str],
+        category: Optional[str],
+        season: Optional[str],
+        min_price: Optional[float],
+        max_price: Optional[float],
+    ) -> tuple[int, float, float]:
+        """Facet bits plus the price bounds still to check per entry."""
+        bits = self._all
+        if gender:
+            bits &= self._facets["gender"].get(_norm(gender), 0)
+        if category and bits:
+            bits &= self._contains("category", _norm(category))
+        if season and bits:
+            bits &= self._contains("season", _norm(season))
+        if size and bits:
+            bits &= self._facets["size"].get(size.strip().upper(), 0)
+        if color and bits:
+            bits &= self._contains("color", _norm(color))
+
+        lo_price = float("-inf") if min_price is None else float(min_price)
+        hi_price = float("inf") if max_price is None else float(max_price)
+        if (min_price is not None or max_price is not None) and bits:
+            lo, hi = self._price_range(min_price, max_price)
+            if hi - lo <= bits.bit_count():
+                # Narrow band: intersect with the bisected price slice.
+                price_bits = 0
+                for _, slot in self._prices[lo:hi]:
+                    price_bits |= 1 << slot
+                bits &= price_bits
+                lo_price, hi_price = float("-inf"), float("inf")
+        return bits, lo_price, hi_price
+
+    def _top(self, bits: int, lo_price: float, hi_price: float, limit: int) -> list[dict[str, Any]]:
+        """First ``limit`` entries of ``bits`` in listing order."""
+        limit = max(0, int(limit))
+        if bits.bit_count() > 64:
+            # Dense result: walk the global sort order and stop at `limit`.
+            out = []
+            for _, slot in self._order:
+                if bits >> slot & 1:
+                    e = self._entries[slot]
+                    if lo_price <= e.price <= hi_price:
+                        out.append(e.as_result())
+                        if len(out) >= limit:
+                            break
+            return out
+
+        entries = []
+        while bits:
+            low = bits & -bits
+            e = self._entries[low.bit_length() - 1]
+            if lo_price <= e.price <= hi_price:
+                entries.append(e)
+            bits ^= low
+
+        top = heapq.nsmallest(limit, entries, key=_Entry.sort_key)
+        return [e.as_result() for e in top]
+
+    def search(
+        self,
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+    ) -> Optional[list[dict[str, Any]]]:
+        """Filter-only search. Returns None when the caller must use SQL."""
+        if not self.ready or (query or "").strip():
+            return None
+
+        bits, lo_price, hi_price = self._filter(color, size, gender, category, season, min_price, max_price)
+        return self._top(bits, lo_price, hi_price, limit)
+
+    def get(self, sku: str) -> Optional[dict[str, Any]]:
+        """Search result for an indexed ``sku``, or None."""
+        slot = self._slots.get(sku)
+        e = self._entries[slot] if slot is not None else None
+        return e.as_result() if e is not None else None
+
+    def matcher(
+        self,
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> Optional[Callable[[str], bool]]:
+        """Predicate telling whether a sku passes the filters, or None while cold.
+
+        Same normalized facets as ``search()`` (so canonical color stems
+        such as "черн" match "Черный"), as a candidate filter for rankings
+        computed elsewhere.
+        """
+        if not self.ready:
+            return None
+
+        bits, lo_price, hi_price = self._filter(color, size, gender, category, season, min_price, max_price)
+        slots, entries = self._slots, self._entries
+
+        def allow(sku: str) -> bool:
+            slot = slots.get(sku)
+            return slot is not None and bool(bits >> slot & 1) and lo_price <= entries[slot].price <= hi_price
+
+        return allow
+
+    def search_page(
+        self,
+        after: Optional[tuple[bool, int, str]] = None,
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+    ) -> Optional[tuple[list[dict[str, Any]], Optional[tuple[bool, int, str]]]]:
+        """Filter-only page strictly after the (is_sale, created_at, sku) key ``after``.
+
+        Returns (results, key of the last result when more follow), or
+        None while the index is cold.
+        """
+        if not self.ready:
+            return None
+
+        bits, lo_price, hi_price = self._filter(color, size, gender, category, season, min_price, max_price)
+        bound = listing_key(*after) if after is not None else None
+        limit = max(0, int(limit))
+
+        out: list[_Entry] = []
+        if bits.bit_count() > 64:
+            # Dense result: bisect to the cursor in the global order and walk on.
+            start = 0 if bound is None else bisect_right(self._order, (bound, len(self._entries)))
+            for i in range(start, len(self._order)):
+                slot = self._order[i][1]
+                if bits >> slot & 1:
+                    e = self._entries[slot]
+                    if lo_price <= e.price <= hi_price:
+                        out.append(e)
+                        if len(out) > limit:
+                            break
+        else:
+            entries = []
+            while bits:
+                low = bits & -bits
+                e = self._entries[low.bit_length() - 1]
+                if lo_price <= e.price <= hi_price and (bound is None or e.sort_key() > bound):
+                    entries.append(e)
+                bits ^= low
+            out = heapq.nsmallest(limit + 1, entries, key=_Entry.sort_key)
+
+        page = out[:limit]
+        last = page[-1] if page and len(out) > limit else None
+        return [e.as_result() for e in page], (last.is_sale, last.created_at, last.sku) if last else None
+
+    def _similar_terms(self, word: str, min_similarity: float) -> dict[str, float]:
+        """Indexed terms whose trigram Dice coefficient with ``word`` passes."""
+        out: dict[str, float] = {}
+        for variant in {word, _translit(word)}:
+            grams = _trigrams(variant)
+            shared = Counter(term for gram in grams for term in self._grams.get(gram, ()))
+            for term, n in shared.items():
+                sim = 2 * n / (len(grams) + self._term_grams[term])
+                if sim >= min_similarity and sim > out.get(term, 0):
+                    out[term] = sim
+        return out
+
+    def fuzzy_search(
+        self,
+        query: str,
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+        min_similarity: Optional[float] = None,
+    ) -> Optional[list[dict[str, Any]]]:
+        """Typo/transliteration-tolerant text search over titles, categories and colors.
+
+        Each query word is matched to indexed terms through shared
+        trigrams; a product scores the sum over query words of its best
+        term similarity, ties broken by the listing order. Returns None
+        while the index is cold.
+        """
+        if not self.ready:
+            return None
+        if min_similarity is None:
+            min_similarity = settings.SEARCH_FUZZY_MIN_SIMILARITY
+
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        filter_bits, lo_price, hi_price = self._filter(color, size, gender, category, season, min_price, max_price)
+
+        # Buckets of equal score: {score: slot bits}. Each word splits every
+        # bucket by the best similarity level its slots reach.
+        buckets: dict[float, int] = {0.0: filter_bits}
+        for word in query_words:
+            levels: dict[float, int] = {}
+            for term, sim in self._similar_terms(word, min_similarity).items():
+                levels[sim] = levels.get(sim, 0) | self._terms[term]
+            if not levels:
+                continue
+
+            split: dict[float, int] = {}
+            for score, bits in buckets.items():
+                for sim in sorted(levels, reverse=True):
+                    hit = bits & levels[sim]
+                    if hit:
+                        split[score + sim] = split.get(score + sim, 0) | hit
+                        bits &= ~hit
+                if bits:
+                    split[score] = split.get(score, 0) | bits
+            buckets = split
+
+        out: list[dict[str, Any]] = []
+        for score in sorted(buckets, reverse=True):
+            if score <= 0 or len(out) >= limit:
+                break
+            out.extend(self._top(buckets[score], lo_price, hi_price, limit - len(out)))
+        return out
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "products": len(self._slots),
+            "sizes": len(self._facets["size"]),
+            "colors": len(self._facets["color"]),
+            "terms": len(self._terms),
+            "trigrams": len(self._grams),
+        }
+
+
+index = CatalogIndex()
+on_product_change(index.refresh)
+on_stock_change(index.stock_changed)
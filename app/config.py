@@ -12,6 +12,33 @@ class Settings(BaseSettings):
     WEBHOOK_PATH: str = "/webhook"
     WEBHOOK_SECRET: str
     DB_PATH: str = "/var/data/data.db"
+    STORAGE_BACKEND: str = "sqlite"
+    DB_SHARDS: int = 0
+    DB_POOL_SIZE: int = 4
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    DB_CACHE_SIZE_KB: int = 16384
+    DB_MMAP_SIZE: int = 268435456
+    DB_WRITE_BEHIND_MS: int = 0
+    DB_WRITE_BATCH_MAX: int = 64
+    DB_MESSAGE_CODEC: str = "plain"
+    DB_MESSAGE_CODEC_MIN_BYTES: int = 256
+    RETENTION_INTERVAL_S: float = 3600.0
+    RETENTION_BATCH: int = 500
+    RETENTION_SESSION_DAYS: int = 30
+    RETENTION_CONVERSATION_DAYS: int = 90
+    RETENTION_ORDER_DAYS: int = 365
+    ARCHIVE_ORDER_DAYS: int = 60
+    BACKUP_DIR: str = "/var/data/backups"
+    BACKUP_KEEP: int = 7
+    BACKUP_STEP_PAGES: int = 256
+    BACKUP_STEP_SLEEP_MS: int = 20
+    SEARCH_CACHE_SIZE: int = 512
+    SEARCH_CACHE_TTL: float = 60.0
+    SEARCH_FUZZY_MIN_SIMILARITY: float = 0.5
+    STOCK_TRACKING: bool = False
+    ORDER_RESERVATION_HOURS: float = 72.0
+    PRODUCT_CACHE_SIZE: int = 256
+    PRODUCT_CACHE_TTL: float = 300.0
     ADMIN_IDS: list[int] = []
     CHANNEL_ID: str = "-1001988399559"
     BOT_USERNAME: str = ""
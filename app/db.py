@@ -1,10 +1,24 @@
+import asyncio
+import copy
 import json
+import os
+import re
 import secrets
+import sqlite3
 import time
-from typing import Any, Optional
+import zlib
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
 
 import aiosqlite
 
+try:
+    import zstandard
+except ImportError:  # optional: DB_MESSAGE_CODEC=zstd falls back to zlib
+    zstandard = None
+
+from .cache import LRUCache
 from .config import settings
 
 
@@ -66,12 +80,6 @@ CREATE TABLE IF NOT EXISTS users (
   updated_at INTEGER NOT NULL
 );
 
-CREATE TABLE IF NOT EXISTS conversations (
-  user_id INTEGER PRIMARY KEY,
-  messages_json TEXT NOT NULL,
-  updated_at INTEGER NOT NULL
-);
-
 CREATE TABLE IF NOT EXISTS orders (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id INTEGER NOT NULL,
@@ -80,19 +88,32 @@ CREATE TABLE IF NOT EXISTS orders (
   created_at INTEGER NOT NULL
 );
 
-CREATE TABLE IF NOT EXISTS sales_sessions (
-  user_id INTEGER PRIMARY KEY,
-  sku TEXT DEFAULT '',
-  stage TEXT NOT NULL DEFAULT 'new_chat',
+CREATE TABLE IF NOT EXISTS sales_orders (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  order_no TEXT NOT NULL UNIQUE,
+  user_id INTEGER NOT NULL,
+  sku TEXT NOT NULL,
+  title TEXT DEFAULT '',
+  price REAL DEFAULT 0,
+  currency TEXT DEFAULT 'RUB',
+  size TEXT DEFAULT '',
+  color TEXT DEFAULT '',
+  customer_name TEXT DEFAULT '',
+  customer_phone TEXT DEFAULT '',
+  comment TEXT DEFAULT '',
   psychotype TEXT DEFAULT '',
-  psychotype_conf REAL DEFAULT 0,
-  context_json TEXT DEFAULT '{}',
+  payment_url TEXT DEFAULT '',
+  carrier TEXT DEFAULT '',
+  tracking_number TEXT DEFAULT '',
+  stage TEXT NOT NULL DEFAULT 'waiting_payment',
   created_at INTEGER NOT NULL,
-  updated_at INTEGER NOT NULL
+  updated_at INTEGER NOT NULL,
+  stock_reserved INTEGER NOT NULL DEFAULT 0
 );
 
-CREATE TABLE IF NOT EXISTS sales_orders (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
+-- Finished orders moved out of sales_orders by archive_sales_orders().
+CREATE TABLE IF NOT EXISTS sales_orders_archive (
+  id INTEGER PRIMARY KEY,
   order_no TEXT NOT NULL UNIQUE,
   user_id INTEGER NOT NULL,
   sku TEXT NOT NULL,
@@ -108,101 +129,961 @@ CREATE TABLE IF NOT EXISTS sales_orders (
   payment_url TEXT DEFAULT '',
   carrier TEXT DEFAULT '',
   tracking_number TEXT DEFAULT '',
-  stage TEXT NOT NULL DEFAULT 'waiting_payment',
+  stage TEXT NOT NULL,
   created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL,
+  archived_at INTEGER NOT NULL,
+  stock_reserved INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Per-buyer state. Lives in the main file, or in every shard file when
+# DB_SHARDS > 0 (see Shards below).
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+  user_id INTEGER PRIMARY KEY,
+  messages_json TEXT NOT NULL,
   updated_at INTEGER NOT NULL
 );
+
+CREATE TABLE IF NOT EXISTS conversation_messages (
+  user_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  role TEXT NOT NULL,
+  content TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sales_sessions (
+  user_id INTEGER PRIMARY KEY,
+  sku TEXT DEFAULT '',
+  stage TEXT NOT NULL DEFAULT 'new_chat',
+  psychotype TEXT DEFAULT '',
+  psychotype_conf REAL DEFAULT 0,
+  context_json TEXT DEFAULT '{}',
+  created_at INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL
+);
+"""
+
+# Full-text index over the catalog. External-content table: the text lives
+# in `products`, triggers keep the index in sync. unicode61 with
+# remove_diacritics folds "худи́" to "худи"; prefix indexes make the stem
+# queries built by catalog.fts_query cheap.
+# product_cards holds every variant, color and photo of a sku as JSON, so a
+# product reads as one row. product_card_source computes the cards from the
+# source tables; the triggers replace a card whenever one of its rows changes,
+# and check_product_cards() diffs the two.
+CARDS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS product_cards (
+  sku TEXT PRIMARY KEY,
+  variants_json TEXT NOT NULL DEFAULT '[]',
+  colors_json TEXT NOT NULL DEFAULT '[]',
+  photos_json TEXT NOT NULL DEFAULT '[]'
+) WITHOUT ROWID;
+
+CREATE VIEW IF NOT EXISTS product_card_source AS
+SELECT
+  p.sku AS sku,
+  (SELECT json_group_array(json_object('size', size, 'stock', stock, 'is_active', is_active))
+   FROM (SELECT size, stock, is_active FROM product_variants WHERE sku = p.sku ORDER BY size)) AS variants_json,
+  (SELECT json_group_array(json_object('color', color, 'is_active', is_active))
+   FROM (SELECT color, is_active FROM product_colors WHERE sku = p.sku ORDER BY color)) AS colors_json,
+  (SELECT json_group_array(file_id)
+   FROM (SELECT file_id FROM product_photos WHERE sku = p.sku ORDER BY id)) AS photos_json
+FROM products p;
+
+CREATE TRIGGER IF NOT EXISTS product_cards_products_ai AFTER INSERT ON products BEGIN
+  DELETE FROM product_cards WHERE sku = new.sku;
+  INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku = new.sku;
+END;
+
+CREATE TRIGGER IF NOT EXISTS product_cards_products_au AFTER UPDATE OF sku ON products BEGIN
+  DELETE FROM product_cards WHERE sku IN (old.sku, new.sku);
+  INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku = new.sku;
+END;
+
+CREATE TRIGGER IF NOT EXISTS product_cards_products_ad AFTER DELETE ON products BEGIN
+  DELETE FROM product_cards WHERE sku = old.sku;
+END;
+"""
+
+
+def _card_triggers(table: str) -> str:
+    return f"""
+CREATE TRIGGER IF NOT EXISTS product_cards_{table}_ai AFTER INSERT ON {table} BEGIN
+  DELETE FROM product_cards WHERE sku = new.sku;
+  INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku = new.sku;
+END;
+
+CREATE TRIGGER IF NOT EXISTS product_cards_{table}_au AFTER UPDATE ON {table} BEGIN
+  DELETE FROM product_cards WHERE sku IN (old.sku, new.sku);
+  INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku IN (old.sku, new.sku);
+END;
+
+CREATE TRIGGER IF NOT EXISTS product_cards_{table}_ad AFTER DELETE ON {table} BEGIN
+  DELETE FROM product_cards WHERE sku = old.sku;
+  INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku = old.sku;
+END;
+"""
+
+
+CARDS_SCHEMA += "".join(_card_triggers(t) for t in ("product_variants", "product_colors", "product_photos"))
+
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+  title, description, sku, category, material,
+  content='products',
+  content_rowid='rowid',
+  tokenize='unicode61 remove_diacritics 2',
+  prefix='2 3 4'
+);
+
+CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+  INSERT INTO products_fts(rowid, title, description, sku, category, material)
+  VALUES (new.rowid, new.title, new.description, new.sku, new.category, new.material);
+END;
+
+CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+  INSERT INTO products_fts(products_fts, rowid, title, description, sku, category, material)
+  VALUES ('delete', old.rowid, old.title, old.description, old.sku, old.category, old.material);
+END;
+
+CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN
+  INSERT INTO products_fts(products_fts, rowid, title, description, sku, category, material)
+  VALUES ('delete', old.rowid, old.title, old.description, old.sku, old.category, old.material);
+  INSERT INTO products_fts(rowid, title, description, sku, category, material)
+  VALUES (new.rowid, new.title, new.description, new.sku, new.category, new.material);
+END;
 """
 
 
+# -------- Connection pool --------
+def unicode_lower(value: Any) -> Any:
+    """SQL ``unicode_lower(x)``: SQLite's own lower() and LIKE only fold ASCII."""
+    return value.lower() if isinstance(value, str) else value
+
+
+async def _open_connection(path: str, *, query_only: bool = False) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(path)
+    await conn.create_function("unicode_lower", 1, unicode_lower, deterministic=True)
+    # Only takes effect on a brand-new file (before journal_mode writes the
+    # header); lets the retention job hand free pages back.
+    await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    await conn.execute(f"PRAGMA busy_timeout={int(settings.DB_BUSY_TIMEOUT_MS)}")
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute(f"PRAGMA cache_size=-{abs(int(settings.DB_CACHE_SIZE_KB))}")
+    await conn.execute(f"PRAGMA mmap_size={int(settings.DB_MMAP_SIZE)}")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    if query_only:
+        await conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class ConnectionPool:
+    """Fixed-size pool of long-lived, read-only aiosqlite connections.
+
+    Every connection gets the same PRAGMA profile on open, so callers never
+    pay for thread start-up, file open or page-cache warm-up per query.
+    Writes go through the single writer below; in WAL mode readers never
+    block it and see each commit as soon as its caller is released.
+    """
+
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = max(1, int(size))
+        self._idle: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._conns: list[aiosqlite.Connection] = []
+        self._waiting = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def open(self) -> None:
+        for _ in range(self.size):
+            conn = await _open_connection(self.path, query_only=True)
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        for conn in self._conns:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        self._conns.clear()
+        self._idle = asyncio.Queue()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            conn = await self._idle.get()
+        finally:
+            self._waiting -= 1
+
+        waited = time.perf_counter() - started
+        self._checkouts += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+        try:
+            yield conn
+        except BaseException:
+            # Never hand a connection with a half-done transaction to the next caller.
+            try:
+                await conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._idle.put_nowait(conn)
+
+    def stats(self) -> dict[str, Any]:
+        checkouts = self._checkouts
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "in_use": len(self._conns) - self._idle.qsize(),
+            "waiting": self._waiting,
+            "checkouts": checkouts,
+            "wait_total_ms": round(self._wait_total * 1000, 2),
+            "wait_avg_ms": round(self._wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+            "wait_max_ms": round(self._wait_max * 1000, 2),
+        }
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = asyncio.Lock()
+
+
+async def _get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    async with _pool_lock:
+        if _pool is None:
+            pool = ConnectionPool(settings.DB_PATH, settings.DB_POOL_SIZE)
+            await pool.open()
+            _pool = pool
+    return _pool
+
+
+@asynccontextmanager
+async def connection() -> AsyncIterator[aiosqlite.Connection]:
+    pool = await _get_pool()
+    async with pool.acquire() as db:
+        yield db
+
+
+def pool_stats() -> dict[str, Any]:
+    if _pool is None:
+        return {"size": 0, "checkouts": 0}
+    return _pool.stats()
+
+
+# -------- Writer --------
+@dataclass
+class _WriteRequest:
+    turn: asyncio.Future    # writer -> caller: the connection, savepoint open
+    done: asyncio.Future    # caller -> writer: True to keep the work, False to undo it
+    durable: asyncio.Future  # writer -> caller: the batch has committed
+
+
+class Writer:
+    """The only task that writes to the database.
+
+    Callers queue up in ``transaction()``; the writer opens one transaction,
+    gives each caller in turn a SAVEPOINT on its connection and commits once
+    the queue is drained or ``max_batch`` callers have gone (group commit).
+    A caller that raises is rolled back to its savepoint without affecting
+    the rest of the batch; the others are released after the COMMIT.
+    """
+
+    def __init__(self, path: str, max_batch: int) -> None:
+        self.path = path
+        self.max_batch = max(1, int(max_batch))
+        self._queue: asyncio.Queue[Optional[_WriteRequest]] = asyncio.Queue()
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batches = 0
+        self._writes = 0
+        self._rolled_back = 0
+        self._batch_max = 0
+        self._depth_max = 0
+        self._commit_total = 0.0
+
+    async def open(self) -> None:
+        self._conn = await _open_connection(self.path)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        loop = asyncio.get_running_loop()
+        req = _WriteRequest(loop.create_future(), loop.create_future(), loop.create_future())
+        self._queue.put_nowait(req)
+        self._depth_max = max(self._depth_max, self._queue.qsize())
+
+        try:
+            db = await req.turn
+        except asyncio.CancelledError:
+            if req.turn.done() and not req.turn.cancelled():
+                req.done.set_result(False)
+            raise
+
+        try:
+            yield db
+        except BaseException:
+            req.done.set_result(False)
+            raise
+        req.done.set_result(True)
+        await req.durable
+
+    async def _run(self) -> None:
+        db = self._conn
+        while True:
+            req = await self._queue.get()
+            if req is None:
+                return
+
+            batch: list[_WriteRequest] = []
+            stop = False
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                while True:
+                    if not req.turn.cancelled():
+                        await db.execute("SAVEPOINT write")
+                        req.turn.set_result(db)
+                        if await req.done:
+                            batch.append(req)
+                        else:
+                            await db.execute("ROLLBACK TO write")
+                            self._rolled_back += 1
+                        await db.execute("RELEASE write")
+
+                    if len(batch) >= self.max_batch or self._queue.empty():
+                        break
+                    req = self._queue.get_nowait()
+                    if req is None:
+                        stop = True
+                        break
+
+                started = time.perf_counter()
+                await db.commit()
+                self._commit_total += time.perf_counter() - started
+            except BaseException as e:
+                try:
+                    await db.rollback()
+                except Exception:
+                    pass
+                for r in batch:
+                    if not r.durable.done():
+                        r.durable.set_exception(e)
+                if req is not None and req not in batch:
+                    if not req.turn.done():
+                        # BEGIN or SAVEPOINT failed (e.g. another connection
+                        # held the lock past busy_timeout) before its turn.
+                        req.turn.set_exception(e)
+                    elif not req.turn.cancelled() and not req.done.done() and not req.durable.done():
+                        # Still inside its block: fail it once it finishes.
+                        req.durable.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+                if stop:
+                    return
+                continue
+
+            for r in batch:
+                if not r.durable.done():
+                    r.durable.set_result(None)
+            self._batches += 1
+            self._writes += len(batch)
+            self._batch_max = max(self._batch_max, len(batch))
+            if stop:
+                return
+
+    def stats(self) -> dict[str, Any]:
+        batches = self._batches
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_depth_max": self._depth_max,
+            "batches": batches,
+            "writes": self._writes,
+            "rolled_back": self._rolled_back,
+            "batch_avg": round(self._writes / batches, 2) if batches else 0.0,
+            "batch_max": self._batch_max,
+            "commit_avg_ms": round(self._commit_total * 1000 / batches, 3) if batches else 0.0,
+        }
+
+
+_writer: Optional[Writer] = None
+_writer_lock = asyncio.Lock()
+
+
+async def _get_writer() -> Writer:
+    global _writer
+    if _writer is not None:
+        return _writer
+
+    async with _writer_lock:
+        if _writer is None:
+            writer = Writer(settings.DB_PATH, settings.DB_WRITE_BATCH_MAX)
+            await writer.open()
+            _writer = writer
+    return _writer
+
+
+@asynccontextmanager
+async def writing() -> AsyncIterator[aiosqlite.Connection]:
+    """Run the block as one atomic unit on the writer connection.
+
+    Returns once the enclosing group commit is durable. Do not commit,
+    roll back or nest ``writing()`` inside the block.
+    """
+    writer = await _get_writer()
+    async with writer.transaction() as db:
+        yield db
+
+
+def writer_stats() -> dict[str, Any]:
+    if _writer is None:
+        return {"batches": 0, "writes": 0}
+    return _writer.stats()
+
+
+# -------- Shards --------
+# With DB_SHARDS > 0 the SHARD_SCHEMA tables (conversations, sales sessions)
+# live in DB_SHARDS extra files picked by a hash of user_id, each with its
+# own writer and reader pool, so buyers stop sharing one write lock.
+# Catalog, orders and everything else stay in DB_PATH. user_connection()
+# and user_writing() route by user_id; scripts/reshard.py moves rows when
+# the shard count changes. It only pays off when several worker processes
+# contend for the main file's write lock on separate cores: in one process
+# the group-commit writer already batches every buyer, and more writers
+# mean smaller batches (bench/shard_writes.py).
+SHARD_TABLES = ("conversation_messages", "conversations", "sales_sessions")
+
+
+def shard_path(index: int, base: Optional[str] = None) -> str:
+    root, ext = os.path.splitext(base or settings.DB_PATH)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def shard_of(user_id: int, shards: Optional[int] = None) -> Optional[int]:
+    """Shard index for ``user_id`` under ``shards`` (DB_SHARDS), or None when sharding is off."""
+    if shards is None:
+        shards = settings.DB_SHARDS
+    if shards <= 0:
+        return None
+    return zlib.crc32(str(int(user_id)).encode()) % shards
+
+
+def existing_shards(base: Optional[str] = None) -> list[int]:
+    """Indexes of the shard files present next to ``base`` (DB_PATH by default)."""
+    base = base or settings.DB_PATH
+    root, ext = os.path.splitext(base)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.shard(\d+)" + re.escape(ext or ".db") + "$")
+    found = []
+    for name in os.listdir(os.path.dirname(base) or "."):
+        match = pattern.match(name)
+        if match:
+            found.append(int(match.group(1)))
+    return sorted(found)
+
+
+async def _holds_shard_rows(path: str) -> bool:
+    db = await _open_connection(path)
+    try:
+        for table in SHARD_TABLES:
+            cur = await db.execute(f"SELECT 1 FROM {table} LIMIT 1")
+            if await cur.fetchone() is not None:
+                return True
+        return False
+    finally:
+        await db.close()
+
+
+async def _check_shard_layout() -> None:
+    """Refuse to start while per-user rows sit where DB_SHARDS won't read them.
+
+    Reads only open the user's own file, so rows left in the main file (or
+    in shards of another count, which stamp it in user_version) would
+    silently vanish from dialogs until scripts/reshard.py moves them.
+    """
+    shards = max(0, settings.DB_SHARDS)
+    stale = []
+    if shards and await _holds_shard_rows(settings.DB_PATH):
+        stale.append(settings.DB_PATH)
+    for index in existing_shards():
+        path = shard_path(index)
+        db = await _open_connection(path)
+        try:
+            cur = await db.execute("PRAGMA user_version")
+            layout = (await cur.fetchone())[0]
+        finally:
+            await db.close()
+        misplaced = index >= shards or layout not in (0, shards)
+        if misplaced and await _holds_shard_rows(path):
+            stale.append(path)
+    if stale:
+        raise RuntimeError(
+            f"{', '.join(stale)} hold conversation rows outside the DB_SHARDS={shards} layout;"
+            f" stop the bot and run: python -m scripts.reshard --to {shards}"
+        )
+
+
+class Shard:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.path = shard_path(index)
+        self.pool = ConnectionPool(self.path, settings.DB_POOL_SIZE)
+        self.writer = Writer(self.path, settings.DB_WRITE_BATCH_MAX)
+
+    async def open(self) -> None:
+        await self.pool.open()
+        await self.writer.open()
+
+    async def close(self) -> None:
+        await self.writer.close()
+        await self.pool.close()
+
+
+_shards: dict[int, Shard] = {}
+_shards_lock = asyncio.Lock()
+
+
+async def _get_shard(index: int) -> Shard:
+    shard = _shards.get(index)
+    if shard is not None:
+        return shard
+
+    async with _shards_lock:
+        if index not in _shards:
+            shard = Shard(index)
+            await shard.open()
+            _shards[index] = shard
+    return _shards[index]
+
+
+@asynccontextmanager
+async def shard_connection(index: Optional[int]) -> AsyncIterator[aiosqlite.Connection]:
+    if index is None:
+        async with connection() as db:
+            yield db
+    else:
+        shard = await _get_shard(index)
+        async with shard.pool.acquire() as db:
+            yield db
+
+
+@asynccontextmanager
+async def shard_writing(index: Optional[int]) -> AsyncIterator[aiosqlite.Connection]:
+    if index is None:
+        async with writing() as db:
+            yield db
+    else:
+        shard = await _get_shard(index)
+        async with shard.writer.transaction() as db:
+            yield db
+
+
+def user_connection(user_id: int):
+    """Reader for ``user_id``'s SHARD_SCHEMA rows."""
+    return shard_connection(shard_of(user_id))
+
+
+def user_writing(user_id: int):
+    """writing() on the file that holds ``user_id``'s SHARD_SCHEMA rows."""
+    return shard_writing(shard_of(user_id))
+
+
+def _files_holding(table: str) -> list[Optional[int]]:
+    """shard_writing() targets that may hold rows of ``table``.
+
+    The main file is always included, so maintenance (retention, backups)
+    also covers rows written before sharding; init_db refuses to start
+    until scripts/reshard.py has moved those.
+    """
+    if table not in SHARD_TABLES:
+        return [None]
+    return [None, *range(max(0, settings.DB_SHARDS))]
+
+
+def _database_files() -> list[str]:
+    return [settings.DB_PATH, *(shard_path(i) for i in range(max(0, settings.DB_SHARDS)))]
+
+
+def shard_stats() -> list[dict[str, Any]]:
+    return [
+        {"index": i, **_shards[i].writer.stats()}
+        for i in sorted(_shards)
+    ]
+
+
+_fts_enabled = False
+
+
+def fts_enabled() -> bool:
+    return _fts_enabled
+
+
 async def init_db() -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    global _fts_enabled
+    # Schema and migrations run on a private connection before the writer starts.
+    db = await _open_connection(settings.DB_PATH)
+    try:
         await db.executescript(SCHEMA)
+        await db.executescript(SHARD_SCHEMA)
+        await db.executescript(CARDS_SCHEMA)
         await db.commit()
+        await _run_migrations(db)
+
+        try:
+            await db.executescript(FTS_SCHEMA)
+            # products has no INTEGER PRIMARY KEY, so VACUUM may renumber
+            # rowids; rebuilding on start keeps the external-content index
+            # aligned. Cheap at catalog scale.
+            await db.execute("INSERT INTO products_fts(products_fts) VALUES('rebuild')")
+            await db.commit()
+            _fts_enabled = True
+        except aiosqlite.OperationalError:
+            # SQLite built without FTS5: catalog search falls back to LIKE.
+            await db.rollback()
+            _fts_enabled = False
+    finally:
+        await db.close()
+
+    await _check_shard_layout()
+    for index in range(max(0, settings.DB_SHARDS)):
+        db = await _open_connection(shard_path(index))
+        try:
+            await db.executescript(SHARD_SCHEMA)
+            for statement in _RETENTION_INDEXES:
+                await db.execute(statement)
+            # The shard count this file's users were placed for.
+            await db.execute(f"PRAGMA user_version={int(settings.DB_SHARDS)}")
+            await db.commit()
+        finally:
+            await db.close()
+
+
+async def close_db() -> None:
+    global _pool, _writer
+    await retention.stop()
+    if write_behind is not None:
+        await write_behind.close()
+    for index in list(_shards):
+        await _shards.pop(index).close()
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+# -------- Change notifications --------
+ProductListener = Callable[[str], Awaitable[None]]
+
+_product_listeners: list[ProductListener] = []
+_catalog_version = 0
+
+
+def catalog_version() -> int:
+    """Monotonic counter bumped by every product/variant/color/photo write."""
+    return _catalog_version
+
+
+def on_product_change(listener: ProductListener) -> None:
+    """Register a coroutine called with the sku after every catalog write."""
+    if listener not in _product_listeners:
+        _product_listeners.append(listener)
+
+
+async def _product_changed(sku: str) -> None:
+    global _catalog_version
+    _catalog_version += 1
+
+    sku = (sku or "").strip()
+    if not sku:
+        return
+
+    _product_gen[sku] = _product_gen.get(sku, 0) + 1
+    product_cache.pop(sku)
+    for listener in list(_product_listeners):
+        try:
+            await listener(sku)
+        except Exception:
+            pass
+    # A search that ran while the listeners awaited their reads may have
+    # cached the old index state under the version bumped above.
+    _catalog_version += 1
+
+
+# Stock writes skip the full per-sku refresh above: listeners get the one
+# changed cell, so keeping in-memory availability current is O(1).
+StockListener = Callable[[str, str, int, int], None]
+
+_stock_listeners: list[StockListener] = []
+
+
+def on_stock_change(listener: StockListener) -> None:
+    """Register a callable run with (sku, size, old, new) after a stock write to an active variant."""
+    if listener not in _stock_listeners:
+        _stock_listeners.append(listener)
+
+
+def _stock_changed(sku: str, size: str, old: int, new: int, active: bool) -> None:
+    global _catalog_version
+    # The card (and so get_product) carries the count.
+    _product_gen[sku] = _product_gen.get(sku, 0) + 1
+    product_cache.pop(sku)
+    if not active:
+        return
+
+    if settings.STOCK_TRACKING and (old > 0) != (new > 0):
+        # The size appeared in or dropped out of search results.
+        _catalog_version += 1
+    for listener in list(_stock_listeners):
+        try:
+            listener(sku, size, old, new)
+        except Exception:
+            pass
+
+
+# -------- Message codec --------
+# conversation_messages.content holds plain TEXT, or a BLOB whose first byte
+# names the codec. Short messages stay TEXT (compression would not pay for
+# itself), and TEXT rows written before the codec existed decode as-is, so
+# DB_MESSAGE_CODEC can be changed at any time without rewriting the table.
+_CODEC_ZLIB = 1
+_CODEC_ZSTD = 2
+
+_zstd_c = zstandard.ZstdCompressor(level=6) if zstandard else None
+_zstd_d = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def _encode_content(text: str, codec: Optional[str] = None) -> str | bytes:
+    codec = codec or settings.DB_MESSAGE_CODEC
+    raw = text.encode("utf-8")
+    if codec == "plain" or len(raw) < settings.DB_MESSAGE_CODEC_MIN_BYTES:
+        return text
+
+    if codec == "zstd" and _zstd_c is not None:
+        packed = bytes([_CODEC_ZSTD]) + _zstd_c.compress(raw)
+    else:
+        packed = bytes([_CODEC_ZLIB]) + zlib.compress(raw, 6)
+    return packed if len(packed) < len(raw) else text
+
+
+def _decode_content(value: str | bytes | None) -> str:
+    if not isinstance(value, bytes):
+        return value or ""
+
+    tag, body = value[0], value[1:]
+    if tag == _CODEC_ZLIB:
+        return zlib.decompress(body).decode("utf-8")
+    if tag == _CODEC_ZSTD:
+        if _zstd_d is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed messages")
+        return _zstd_d.decompress(body).decode("utf-8")
+    raise ValueError(f"unknown message codec {tag}")
 
 
 # -------- Conversations --------
-async def upsert_conversation(user_id: int, messages: list[dict[str, Any]]) -> None:
-    now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO conversations(user_id, messages_json, updated_at)
-            VALUES(?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              messages_json=excluded.messages_json,
-              updated_at=excluded.updated_at
-            """,
-            (user_id, json.dumps(messages, ensure_ascii=False), now),
-        )
-        await db.commit()
+# One row per message, clustered on (user_id, seq): a turn appends two rows
+# and the dialog reads only the tail, instead of rewriting and re-parsing
+# the whole history blob. The legacy `conversations` table is drained into
+# it by _migrate_conversations on start-up.
+async def append_messages(user_id: int, messages: list[dict[str, Any]]) -> None:
+    if not messages:
+        return
+    if write_behind is not None:
+        await write_behind.put_messages(user_id, messages)
+        return
+
+    async with user_writing(user_id) as db:
+        await _write_messages(db, user_id, messages)
 
 
-async def get_conversation(user_id: int) -> Optional[list[dict[str, Any]]]:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+async def _write_messages(db: aiosqlite.Connection, user_id: int, messages: list[dict[str, Any]]) -> None:
+    now = int(time.time())
+    await db.executemany(
+        """
+        INSERT INTO conversation_messages(user_id, seq, role, content, ts)
+        SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?
+        FROM conversation_messages
+        WHERE user_id=?
+        """,
+        [
+            (user_id, str(m.get("role") or "user"), _encode_content(str(m.get("content") or "")), now, user_id)
+            for m in messages
+        ],
+    )
+
+
+async def get_recent_messages(user_id: int, n: int) -> list[dict[str, Any]]:
+    async with user_connection(user_id) as db:
+        return await _read_recent_messages(db, user_id, n)
+
+
+async def _read_recent_messages(db: aiosqlite.Connection, user_id: int, n: int) -> list[dict[str, Any]]:
+    cur = await db.execute(
+        """
+        SELECT seq, role, content
+        FROM conversation_messages
+        WHERE user_id=?
+        ORDER BY seq DESC
+        LIMIT ?
+        """,
+        (user_id, int(n)),
+    )
+    rows = [(r[0], r[1], _decode_content(r[2])) for r in reversed(await cur.fetchall())]
+    if write_behind is not None:
+        rows = write_behind.overlay_messages(user_id, rows, n)
+    return [{"role": r[1], "content": r[2]} for r in rows]
+
+
+async def clear_conversation(user_id: int) -> None:
+    if write_behind is not None:
+        await write_behind.flush()
+    async with user_writing(user_id) as db:
+        await db.execute("DELETE FROM conversation_messages WHERE user_id=?", (user_id,))
+        await db.execute("DELETE FROM conversations WHERE user_id=?", (user_id,))
+
+
+async def _migrate_conversations(db: aiosqlite.Connection, batch: int = 500) -> int:
+    """Move legacy messages_json blobs into conversation_messages.
+
+    Rows are deleted from `conversations` once copied, so the step is
+    idempotent and resumes where it stopped if interrupted.
+    """
+    moved = 0
+    while True:
         cur = await db.execute(
-            "SELECT messages_json FROM conversations WHERE user_id=?",
-            (user_id,),
+            "SELECT user_id, messages_json, updated_at FROM conversations LIMIT ?",
+            (batch,),
         )
-        row = await cur.fetchone()
-
-    if not row:
-        return None
+        rows = await cur.fetchall()
+        if not rows:
+            return moved
+
+        for user_id, messages_json, updated_at in rows:
+            try:
+                messages = json.loads(messages_json or "[]")
+            except Exception:
+                messages = []
+
+            cur = await db.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM conversation_messages WHERE user_id=?",
+                (user_id,),
+            )
+            base = (await cur.fetchone())[0]
+            await db.executemany(
+                "INSERT INTO conversation_messages(user_id, seq, role, content, ts) VALUES(?,?,?,?,?)",
+                [
+                    (
+                        user_id,
+                        base + i,
+                        str(m.get("role") or "user"),
+                        _encode_content(str(m.get("content") or "")),
+                        updated_at,
+                    )
+                    for i, m in enumerate(messages, start=1)
+                    if isinstance(m, dict)
+                ],
+            )
+            await db.execute("DELETE FROM conversations WHERE user_id=?", (user_id,))
+            moved += 1
 
-    try:
-        return json.loads(row[0])
-    except Exception:
-        return None
+        await db.commit()
 
 
 # -------- Legacy orders --------
 async def create_order(user_id: int, status: str, payload: dict[str, Any]) -> int:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         cur = await db.execute(
             "INSERT INTO orders(user_id, status, payload_json, created_at) VALUES(?,?,?,?)",
             (user_id, status, json.dumps(payload, ensure_ascii=False), now),
         )
-        await db.commit()
         return int(cur.lastrowid)
 
 
 # -------- Products --------
+# Assembled product dicts by sku. Entries are private snapshots: callers
+# always get a copy, so mutating a returned dict never leaks into the cache.
+# The TTL bounds staleness when another process writes the same file.
+product_cache = LRUCache(settings.PRODUCT_CACHE_SIZE, settings.PRODUCT_CACHE_TTL)
+
+# Per-sku write generation; a read only populates the cache if no write to
+# that sku happened while it was in flight.
+_product_gen: dict[str, int] = {}
+
+
+def _copy_product(p: dict[str, Any]) -> dict[str, Any]:
+    return {
+        **p,
+        "sizes": [dict(v) for v in p["sizes"]],
+        "colors": [dict(c) for c in p["colors"]],
+        "photo_file_ids": list(p["photo_file_ids"]),
+    }
+
+
 async def get_product(sku: str) -> Optional[dict[str, Any]]:
     sku = (sku or "").strip()
     if not sku:
         return None
 
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT sku,title,description,gender,category,season,insulation,material,price,currency,is_active,is_sale,created_at,updated_at
-            FROM products
-            WHERE sku=?
-            """,
-            (sku,),
-        )
-        row = await cur.fetchone()
-        if not row:
-            return None
-
-        cur = await db.execute(
-            "SELECT size,stock,is_active FROM product_variants WHERE sku=? ORDER BY size",
-            (sku,),
-        )
-        variants = await cur.fetchall()
-
-        cur = await db.execute(
-            "SELECT color,is_active FROM product_colors WHERE sku=? ORDER BY color",
-            (sku,),
-        )
-        colors = await cur.fetchall()
-
-        cur = await db.execute(
-            "SELECT file_id FROM product_photos WHERE sku=? ORDER BY id",
-            (sku,),
-        )
-        photos = await cur.fetchall()
+    cached = product_cache.get(sku)
+    if cached is not None:
+        return _copy_product(cached)
+
+    async with connection() as db:
+        return await _read_product_cached(db, sku)
+
+
+async def _read_product_cached(db: aiosqlite.Connection, sku: str) -> Optional[dict[str, Any]]:
+    """Cache hit, or read on ``db`` and fill the cache if no write raced it."""
+    cached = product_cache.get(sku)
+    if cached is not None:
+        return _copy_product(cached)
+
+    gen = _product_gen.get(sku, 0)
+    product = await _read_product(db, sku)
+    if product is not None and _product_gen.get(sku, 0) == gen:
+        product_cache.set(sku, _copy_product(product))
+    return product
+
+
+async def _read_product(db: aiosqlite.Connection, sku: str) -> Optional[dict[str, Any]]:
+    cur = await db.execute(
+        """
+        SELECT p.sku,p.title,p.description,p.gender,p.category,p.season,p.insulation,p.material,p.price,p.currency,
+               p.is_active,p.is_sale,p.created_at,p.updated_at,c.variants_json,c.colors_json,c.photos_json
+        FROM products p
+        LEFT JOIN product_cards c ON c.sku = p.sku
+        WHERE p.sku=?
+        """,
+        (sku,),
+    )
+    row = await cur.fetchone()
+    if not row:
+        return None
 
     return {
         "sku": row[0],
@@ -220,17 +1101,68 @@ async def get_product(sku: str) -> Optional[dict[str, Any]]:
         "created_at": row[12],
         "updated_at": row[13],
         "sizes": [
-            {"size": v[0], "stock": v[1], "is_active": bool(v[2])}
-            for v in variants
+            {"size": v["size"], "stock": v["stock"], "is_active": bool(v["is_active"])}
+            for v in json.loads(row[14] or "[]")
         ],
         "colors": [
-            {"color": c[0], "is_active": bool(c[1])}
-            for c in colors
+            {"color": c["color"], "is_active": bool(c["is_active"])}
+            for c in json.loads(row[15] or "[]")
         ],
-        "photo_file_ids": [p[0] for p in photos],
+        "photo_file_ids": json.loads(row[16] or "[]"),
     }
 
 
+def card_sizes(variants_json: Optional[str]) -> list[str]:
+    """Sizes on offer from a product_cards.variants_json value.
+
+    Active sizes, and with STOCK_TRACKING only those in stock.
+    """
+    return [
+        v["size"]
+        for v in json.loads(variants_json or "[]")
+        if v["is_active"] and (not settings.STOCK_TRACKING or (v["stock"] or 0) > 0)
+    ]
+
+
+def card_colors(colors_json: Optional[str]) -> list[str]:
+    """Active colors from a product_cards.colors_json value."""
+    return [c["color"] for c in json.loads(colors_json or "[]") if c["is_active"]]
+
+
+async def check_product_cards(repair: bool = False) -> list[str]:
+    """Skus whose product_cards row differs from the source tables.
+
+    With ``repair`` the stale cards are rebuilt (and orphans dropped) in
+    the same write transaction.
+    """
+    async with writing() if repair else connection() as db:
+        cur = await db.execute(
+            """
+            SELECT sku FROM (
+              SELECT * FROM product_card_source EXCEPT SELECT * FROM product_cards
+            )
+            UNION
+            SELECT sku FROM (
+              SELECT * FROM product_cards EXCEPT SELECT * FROM product_card_source
+            )
+            ORDER BY sku
+            """
+        )
+        skus = [r[0] for r in await cur.fetchall()]
+        if repair and skus:
+            marks = ",".join("?" * len(skus))
+            await db.execute(f"DELETE FROM product_cards WHERE sku IN ({marks})", skus)
+            await db.execute(
+                f"INSERT INTO product_cards SELECT * FROM product_card_source WHERE sku IN ({marks})",
+                skus,
+            )
+
+    if repair:
+        for sku in skus:
+            await _product_changed(sku)
+    return skus
+
+
 async def upsert_product(
     *,
     sku: str,
@@ -245,63 +1177,149 @@ async def upsert_product(
     currency: str = "RUB",
     is_active: bool = True,
     is_sale: bool = False,
+) -> None:
+    async with writing() as db:
+        await _write_product(
+            db,
+            sku=sku,
+            title=title,
+            description=description,
+            gender=gender,
+            category=category,
+            season=season,
+            insulation=insulation,
+            material=material,
+            price=price,
+            currency=currency,
+            is_active=is_active,
+            is_sale=is_sale,
+        )
+
+    await _product_changed(sku)
+
+
+async def _write_product(
+    db: aiosqlite.Connection,
+    *,
+    sku: str,
+    title: str,
+    description: str,
+    gender: str,
+    category: str,
+    season: str,
+    insulation: str,
+    material: str,
+    price: float,
+    currency: str = "RUB",
+    is_active: bool = True,
+    is_sale: bool = False,
 ) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        await db.execute(
+    await db.execute(
+        """
+        INSERT INTO products(
+          sku,title,description,gender,category,season,insulation,material,
+          price,currency,is_active,is_sale,created_at,updated_at
+        )
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(sku) DO UPDATE SET
+          title=excluded.title,
+          description=excluded.description,
+          gender=excluded.gender,
+          category=excluded.category,
+          season=excluded.season,
+          insulation=excluded.insulation,
+          material=excluded.material,
+          price=excluded.price,
+          currency=excluded.currency,
+          is_active=excluded.is_active,
+          is_sale=excluded.is_sale,
+          updated_at=excluded.updated_at
+        """,
+        (
+            sku,
+            title,
+            description,
+            gender,
+            category,
+            season,
+            insulation,
+            material,
+            float(price),
+            currency,
+            1 if is_active else 0,
+            1 if is_sale else 0,
+            now,
+            now,
+        ),
+    )
+
+
+def variant_size(size: Optional[str]) -> str:
+    """How sizes are stored in product_variants: stripped and uppercased."""
+    return (size or "").strip().upper()
+
+
+async def save_product_bundle(
+    product: dict[str, Any],
+    sizes: dict[str, bool],
+    colors: list[str],
+    photo_file_ids: list[str],
+) -> None:
+    """Write a product with its variants, colors and photos in one transaction.
+
+    ``product`` takes the upsert_product keyword arguments; ``sizes`` maps
+    each size to its is_active flag. Either everything is saved or nothing.
+    """
+    sku = (product.get("sku") or "").strip()
+    if not sku:
+        raise ValueError("sku is required")
+
+    colors = [c.strip() for c in colors if (c or "").strip()]
+    photo_file_ids = [f for f in photo_file_ids if f]
+
+    async with writing() as db:
+        await _write_product(db, **{**product, "sku": sku})
+        await db.executemany(
             """
-            INSERT INTO products(
-              sku,title,description,gender,category,season,insulation,material,
-              price,currency,is_active,is_sale,created_at,updated_at
-            )
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            ON CONFLICT(sku) DO UPDATE SET
-              title=excluded.title,
-              description=excluded.description,
-              gender=excluded.gender,
-              category=excluded.category,
-              season=excluded.season,
-              insulation=excluded.insulation,
-              material=excluded.material,
-              price=excluded.price,
-              currency=excluded.currency,
-              is_active=excluded.is_active,
-              is_sale=excluded.is_sale,
-              updated_at=excluded.updated_at
+            INSERT INTO product_variants(sku,size,is_active)
+            VALUES(?,?,?)
+            ON CONFLICT(sku,size) DO UPDATE SET
+              is_active=excluded.is_active
             """,
-            (
-                sku,
-                title,
-                description,
-                gender,
-                category,
-                season,
-                insulation,
-                material,
-                float(price),
-                currency,
-                1 if is_active else 0,
-                1 if is_sale else 0,
-                now,
-                now,
-            ),
+            [(sku, variant_size(size), 1 if active else 0) for size, active in sizes.items()],
+        )
+        await db.executemany(
+            """
+            INSERT INTO product_colors(sku,color,is_active)
+            VALUES(?,?,1)
+            ON CONFLICT(sku,color) DO UPDATE SET
+              is_active=1
+            """,
+            [(sku, color) for color in colors],
+        )
+        await db.executemany(
+            "INSERT INTO product_photos(sku,file_id) VALUES(?,?)",
+            [(sku, file_id) for file_id in photo_file_ids],
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def set_product_active(sku: str, active: bool) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "UPDATE products SET is_active=?, updated_at=? WHERE sku=?",
             (1 if active else 0, now, sku),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def toggle_product_sale(sku: str) -> Optional[bool]:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         cur = await db.execute("SELECT is_sale FROM products WHERE sku=?", (sku,))
         row = await cur.fetchone()
         if not row:
@@ -312,42 +1330,48 @@ async def toggle_product_sale(sku: str) -> Optional[bool]:
             "UPDATE products SET is_sale=?, updated_at=? WHERE sku=?",
             (new_val, now, sku),
         )
-        await db.commit()
-        return bool(new_val)
+
+    await _product_changed(sku)
+    return bool(new_val)
 
 
 async def update_product_price(sku: str, price: float) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "UPDATE products SET price=?, updated_at=? WHERE sku=?",
             (float(price), now, sku),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def update_product_description(sku: str, description: str) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "UPDATE products SET description=?, updated_at=? WHERE sku=?",
             ((description or "").strip(), now, sku),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def delete_product(sku: str) -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute("DELETE FROM product_publications WHERE sku=?", (sku,))
         await db.execute("DELETE FROM product_photos WHERE sku=?", (sku,))
         await db.execute("DELETE FROM product_colors WHERE sku=?", (sku,))
         await db.execute("DELETE FROM product_variants WHERE sku=?", (sku,))
         await db.execute("DELETE FROM products WHERE sku=?", (sku,))
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def set_variant_active(sku: str, size: str, active: bool) -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    sku = (sku or "").strip()
+    size = variant_size(size)
+    async with writing() as db:
         await db.execute(
             """
             INSERT INTO product_variants(sku,size,is_active)
@@ -357,7 +1381,55 @@ async def set_variant_active(sku: str, size: str, active: bool) -> None:
             """,
             (sku, size, 1 if active else 0),
         )
-        await db.commit()
+
+    await _product_changed(sku)
+
+
+async def set_variant_stock(sku: str, size: str, stock: int) -> Optional[int]:
+    """Set a variant's stock count. Returns the previous count, None if the variant doesn't exist."""
+    sku = (sku or "").strip()
+    size = variant_size(size)
+    stock = max(0, int(stock))
+    async with writing() as db:
+        cur = await db.execute(
+            "SELECT COALESCE(stock, 0), is_active FROM product_variants WHERE sku=? AND size=?",
+            (sku, size),
+        )
+        row = await cur.fetchone()
+        if row is None:
+            return None
+        await db.execute("UPDATE product_variants SET stock=? WHERE sku=? AND size=?", (stock, sku, size))
+
+    _stock_changed(sku, size, int(row[0]), stock, bool(row[1]))
+    return int(row[0])
+
+
+async def adjust_variant_stock(sku: str, size: str, delta: int) -> Optional[int]:
+    """Add ``delta`` to an active variant's stock unless it would drop below zero.
+
+    Returns the new count, or None when there is no such active variant or
+    not enough stock (nothing is written then). The check and the update
+    are one statement, so concurrent checkouts can't oversell.
+    """
+    sku = (sku or "").strip()
+    size = variant_size(size)
+    delta = int(delta)
+    async with writing() as db:
+        cur = await db.execute(
+            """
+            UPDATE product_variants SET stock = COALESCE(stock, 0) + ?
+            WHERE sku=? AND size=? AND is_active=1 AND COALESCE(stock, 0) + ? >= 0
+            RETURNING stock
+            """,
+            (delta, sku, size, delta),
+        )
+        rows = await cur.fetchall()
+    if not rows:
+        return None
+    row = rows[0]
+
+    _stock_changed(sku, size, int(row[0]) - delta, int(row[0]), True)
+    return int(row[0])
 
 
 async def add_color(sku: str, color: str) -> None:
@@ -365,7 +1437,7 @@ async def add_color(sku: str, color: str) -> None:
     if not color:
         return
 
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             """
             INSERT INTO product_colors(sku,color,is_active)
@@ -375,11 +1447,12 @@ async def add_color(sku: str, color: str) -> None:
             """,
             (sku, color),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def set_color_active(sku: str, color: str, active: bool) -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             """
             INSERT INTO product_colors(sku,color,is_active)
@@ -389,25 +1462,27 @@ async def set_color_active(sku: str, color: str, active: bool) -> None:
             """,
             (sku, color, 1 if active else 0),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 async def add_photo_file_id(sku: str, file_id: str) -> None:
     if not (sku and file_id):
         return
 
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "INSERT INTO product_photos(sku,file_id) VALUES(?,?)",
             (sku, file_id),
         )
-        await db.commit()
+
+    await _product_changed(sku)
 
 
 # -------- Channel publications --------
 async def save_product_publication(sku: str, chat_id: str, message_id: int) -> None:
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             """
             INSERT INTO product_publications(sku, chat_id, message_id, created_at)
@@ -415,11 +1490,10 @@ async def save_product_publication(sku: str, chat_id: str, message_id: int) -> N
             """,
             ((sku or "").strip(), str(chat_id).strip(), int(message_id), now),
         )
-        await db.commit()
 
 
 async def get_product_publications(sku: str) -> list[dict[str, Any]]:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with connection() as db:
         cur = await db.execute(
             """
             SELECT id, sku, chat_id, message_id, created_at
@@ -444,26 +1518,38 @@ async def get_product_publications(sku: str) -> list[dict[str, Any]]:
 
 
 async def clear_product_publications(sku: str) -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "DELETE FROM product_publications WHERE sku=?",
             ((sku or "").strip(),),
         )
-        await db.commit()
 
 
 # -------- Sales sessions --------
 async def get_sales_session(user_id: int) -> Optional[dict[str, Any]]:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT user_id, sku, stage, psychotype, psychotype_conf, context_json, created_at, updated_at
-            FROM sales_sessions
-            WHERE user_id=?
-            """,
-            (user_id,),
-        )
-        row = await cur.fetchone()
+    async with user_connection(user_id) as db:
+        return await _read_sales_session(db, user_id)
+
+
+async def _read_sales_session(db: aiosqlite.Connection, user_id: int) -> Optional[dict[str, Any]]:
+    cur = await db.execute(
+        """
+        SELECT user_id, sku, stage, psychotype, psychotype_conf, context_json, created_at, updated_at
+        FROM sales_sessions
+        WHERE user_id=?
+        """,
+        (user_id,),
+    )
+    row = await cur.fetchone()
+
+    if write_behind is not None:
+        buffered = write_behind.session(user_id)
+        if buffered is not None:
+            return {
+                "user_id": user_id,
+                **buffered,
+                "created_at": row[6] if row else buffered["updated_at"],
+            }
 
     if not row:
         return None
@@ -494,40 +1580,430 @@ async def upsert_sales_session(
     psychotype_conf: float = 0,
     context: dict[str, Any] | None = None,
 ) -> None:
-    now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO sales_sessions(
-              user_id, sku, stage, psychotype, psychotype_conf, context_json, created_at, updated_at
-            )
-            VALUES(?,?,?,?,?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              sku=excluded.sku,
-              stage=excluded.stage,
-              psychotype=excluded.psychotype,
-              psychotype_conf=excluded.psychotype_conf,
-              context_json=excluded.context_json,
-              updated_at=excluded.updated_at
+    if write_behind is not None:
+        write_behind.put_session(
+            user_id,
+            sku=sku,
+            stage=stage,
+            psychotype=psychotype,
+            psychotype_conf=psychotype_conf,
+            context=context,
+        )
+        return
+
+    async with user_writing(user_id) as db:
+        await _write_sales_session(
+            db,
+            user_id=user_id,
+            sku=sku,
+            stage=stage,
+            psychotype=psychotype,
+            psychotype_conf=psychotype_conf,
+            context=context,
+        )
+
+
+# A session created by a patch: the sales_sessions column defaults.
+_NEW_SESSION: dict[str, Any] = {"sku": "", "stage": "new_chat", "psychotype": "", "psychotype_conf": 0.0}
+
+
+async def patch_sales_session(
+    user_id: int,
+    *,
+    sku: Optional[str] = None,
+    stage: Optional[str] = None,
+    psychotype: Optional[str] = None,
+    psychotype_conf: Optional[float] = None,
+    context_patch: dict[str, Any] | None = None,
+    messages: list[dict[str, Any]] | None = None,
+) -> None:
+    """Change only the given fields of a session, in one UPDATE.
+
+    ``context_patch`` replaces top-level context keys in place with
+    json_set (a None value removes the key via json_remove), so a stage
+    step that records one answer serializes that answer only. Keys may not
+    contain ``"`` (they are quoted JSON path labels). ``messages`` are
+    appended in the same transaction. A user without a session gets one,
+    with the schema defaults for the fields not given.
+
+    With write-behind the patched session is buffered next to the
+    messages (read from the table first when it is not buffered yet), so
+    the next flush commits both in one transaction.
+    """
+    for key in context_patch or {}:
+        if not isinstance(key, str) or not key or '"' in key:
+            raise ValueError(f"invalid session context key {key!r}")
+
+    if write_behind is not None:
+        current = write_behind.session(user_id)
+        if current is None:
+            async with user_connection(user_id) as db:
+                current = await _read_sales_session(db, user_id)
+        if current is None:
+            current = dict(_NEW_SESSION, context={})
+        context = current["context"]
+        for key, value in (context_patch or {}).items():
+            if value is None:
+                context.pop(key, None)
+            else:
+                context[key] = value
+        write_behind.put_session(
+            user_id,
+            sku=current["sku"] if sku is None else sku,
+            stage=current["stage"] if stage is None else stage,
+            psychotype=current["psychotype"] if psychotype is None else psychotype,
+            psychotype_conf=current["psychotype_conf"] if psychotype_conf is None else psychotype_conf,
+            context=context,
+        )
+        if messages:
+            await write_behind.put_messages(user_id, messages)
+        return
+
+    context_expr = "context_json"
+    context_params: list[Any] = []
+    if context_patch:
+        updates = [(k, v) for k, v in context_patch.items() if v is not None]
+        removed = [k for k, v in context_patch.items() if v is None]
+        if updates:
+            context_expr = f"json_set({context_expr}, {', '.join('?, json(?)' for _ in updates)})"
+            for key, value in updates:
+                context_params += [f'$."{key}"', json.dumps(value, ensure_ascii=False)]
+        if removed:
+            context_expr = f"json_remove({context_expr}, {', '.join('?' for _ in removed)})"
+            context_params += [f'$."{key}"' for key in removed]
+
+    async with user_writing(user_id) as db:
+        cur = await db.execute(
+            f"""
+            UPDATE sales_sessions SET
+              sku=COALESCE(?, sku),
+              stage=COALESCE(?, stage),
+              psychotype=COALESCE(?, psychotype),
+              psychotype_conf=COALESCE(?, psychotype_conf),
+              context_json={context_expr},
+              updated_at=?
+            WHERE user_id=?
             """,
             (
-                user_id,
-                (sku or "").strip(),
+                None if sku is None else sku.strip(),
                 stage,
-                (psychotype or "").strip(),
-                float(psychotype_conf or 0),
-                json.dumps(context or {}, ensure_ascii=False),
-                now,
-                now,
+                None if psychotype is None else psychotype.strip(),
+                None if psychotype_conf is None else float(psychotype_conf),
+                *context_params,
+                int(time.time()),
+                user_id,
             ),
         )
-        await db.commit()
+        if cur.rowcount == 0:
+            await _write_sales_session(
+                db,
+                user_id=user_id,
+                sku=_NEW_SESSION["sku"] if sku is None else sku,
+                stage=_NEW_SESSION["stage"] if stage is None else stage,
+                psychotype=_NEW_SESSION["psychotype"] if psychotype is None else psychotype,
+                psychotype_conf=_NEW_SESSION["psychotype_conf"] if psychotype_conf is None else psychotype_conf,
+                context={k: v for k, v in (context_patch or {}).items() if v is not None},
+            )
+        if messages:
+            await _write_messages(db, user_id, messages)
+
+
+async def _write_sales_session(
+    db: aiosqlite.Connection,
+    *,
+    user_id: int,
+    sku: str,
+    stage: str,
+    psychotype: str,
+    psychotype_conf: float,
+    context: dict[str, Any] | None,
+) -> None:
+    now = int(time.time())
+    await db.execute(
+        """
+        INSERT INTO sales_sessions(
+          user_id, sku, stage, psychotype, psychotype_conf, context_json, created_at, updated_at
+        )
+        VALUES(?,?,?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          sku=excluded.sku,
+          stage=excluded.stage,
+          psychotype=excluded.psychotype,
+          psychotype_conf=excluded.psychotype_conf,
+          context_json=excluded.context_json,
+          updated_at=excluded.updated_at
+        """,
+        (
+            user_id,
+            (sku or "").strip(),
+            stage,
+            (psychotype or "").strip(),
+            float(psychotype_conf or 0),
+            json.dumps(context or {}, ensure_ascii=False),
+            now,
+            now,
+        ),
+    )
 
 
 async def clear_sales_session(user_id: int) -> None:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
+    if write_behind is not None:
+        await write_behind.flush()
+    async with user_writing(user_id) as db:
         await db.execute("DELETE FROM sales_sessions WHERE user_id=?", (user_id,))
-        await db.commit()
+
+
+# -------- Dialog state --------
+@dataclass
+class DialogState:
+    """Everything one sales_dialog turn needs, loaded in a single read."""
+
+    user_id: int
+    sku: str = ""
+    stage: str = "new_chat"
+    psychotype: str = ""
+    psychotype_conf: float = 0.0
+    context: dict[str, Any] = field(default_factory=dict)
+    history: list[dict[str, Any]] = field(default_factory=list)
+    product: Optional[dict[str, Any]] = None
+    _saved: dict[str, Any] = field(default_factory=dict, repr=False, compare=False)
+
+    def mark_saved(self) -> None:
+        self._saved = {
+            "sku": self.sku,
+            "stage": self.stage,
+            "psychotype": self.psychotype,
+            "psychotype_conf": self.psychotype_conf,
+            "context": copy.deepcopy(self.context),
+        }
+
+    def changes(self) -> dict[str, Any]:
+        """What changed since load, as patch_sales_session keyword arguments."""
+        out = {
+            name: getattr(self, name)
+            for name in ("sku", "stage", "psychotype", "psychotype_conf")
+            if getattr(self, name) != self._saved.get(name)
+        }
+        saved = self._saved.get("context", {})
+        patch = {k: v for k, v in self.context.items() if k not in saved or saved[k] != v}
+        patch.update({k: None for k in saved if k not in self.context})
+        if patch:
+            out["context_patch"] = patch
+        return out
+
+
+async def load_dialog_state(user_id: int, history_limit: int = 20) -> Optional[DialogState]:
+    """Session, recent history and current product in one read transaction.
+
+    With sharding on, the product comes from the main file in a second read.
+    Returns None when the user has no sales session.
+    """
+    sharded = shard_of(user_id) is not None
+    async with user_connection(user_id) as db:
+        await db.execute("BEGIN")
+        try:
+            session = await _read_sales_session(db, user_id)
+            if not session:
+                return None
+
+            history = await _read_recent_messages(db, user_id, history_limit)
+
+            sku = (session.get("sku") or "").strip()
+            product = None
+            if sku and not sharded:
+                product = await _read_product_cached(db, sku)
+        finally:
+            await db.commit()
+
+    if sku and sharded:
+        product = await get_product(sku)
+
+    state = DialogState(
+        user_id=user_id,
+        sku=sku,
+        stage=session.get("stage") or "profiling",
+        psychotype=session.get("psychotype") or "",
+        psychotype_conf=float(session.get("psychotype_conf") or 0),
+        context=session.get("context") or {},
+        history=history,
+        product=product,
+    )
+    state.mark_saved()
+    return state
+
+
+# -------- Write-behind --------
+# With DB_WRITE_BEHIND_MS > 0 conversation appends and sales-session upserts
+# are buffered per user and committed together by a background task, so a
+# burst of dialog turns costs one transaction instead of one per turn.
+# Reads overlay the buffer; order creation and shutdown flush it first.
+PendingMessage = tuple[int, str, str, int]  # seq, role, content, ts
+
+
+class WriteBehind:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._sessions: dict[int, dict[str, Any]] = {}
+        self._messages: dict[int, list[PendingMessage]] = {}
+        # Taken by a running flush but not committed yet: still visible to reads.
+        self._inflight_sessions: dict[int, dict[str, Any]] = {}
+        self._inflight_messages: dict[int, list[PendingMessage]] = {}
+        self._next_seq: dict[int, int] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def _ensure_task(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def put_session(
+        self,
+        user_id: int,
+        *,
+        sku: str,
+        stage: str,
+        psychotype: str,
+        psychotype_conf: float,
+        context: dict[str, Any] | None,
+    ) -> None:
+        # Latest wins; the context is snapshotted the way the DB would store it.
+        self._sessions[user_id] = {
+            "sku": (sku or "").strip(),
+            "stage": stage,
+            "psychotype": (psychotype or "").strip(),
+            "psychotype_conf": float(psychotype_conf or 0),
+            "context": json.loads(json.dumps(context or {}, ensure_ascii=False)),
+            "updated_at": int(time.time()),
+        }
+        self.writes += 1
+        self._ensure_task()
+
+    async def put_messages(self, user_id: int, messages: list[dict[str, Any]]) -> None:
+        if user_id not in self._next_seq:
+            async with user_connection(user_id) as db:
+                cur = await db.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM conversation_messages WHERE user_id=?",
+                    (user_id,),
+                )
+                last = (await cur.fetchone())[0]
+            self._next_seq.setdefault(user_id, last + 1)
+
+        seq = self._next_seq[user_id]
+        self._next_seq[user_id] = seq + len(messages)
+        now = int(time.time())
+        self._messages.setdefault(user_id, []).extend(
+            (seq + i, str(m.get("role") or "user"), str(m.get("content") or ""), now)
+            for i, m in enumerate(messages)
+        )
+        self.writes += 1
+        self._ensure_task()
+
+    def session(self, user_id: int) -> Optional[dict[str, Any]]:
+        s = self._sessions.get(user_id) or self._inflight_sessions.get(user_id)
+        return copy.deepcopy(s) if s is not None else None
+
+    def overlay_messages(self, user_id: int, rows: list[tuple], n: int) -> list[tuple]:
+        """Merge committed (seq, role, content) rows with buffered ones, keep the last n."""
+        pending = self._inflight_messages.get(user_id, []) + self._messages.get(user_id, [])
+        if not pending:
+            return rows
+        merged = {r[0]: r for r in rows}
+        for seq, role, content, _ in pending:
+            merged[seq] = (seq, role, content)
+        return [merged[k] for k in sorted(merged)][-int(n):] if n > 0 else []
+
+    async def flush(self) -> int:
+        """Commit everything buffered so far, one transaction per shard; returns rows written."""
+        async with self._lock:
+            if not self._sessions and not self._messages:
+                return 0
+            self._inflight_sessions, self._sessions = self._sessions, {}
+            self._inflight_messages, self._messages = self._messages, {}
+            # One transaction per shard (a single group when sharding is off).
+            groups: dict[Optional[int], tuple[list, list]] = {}
+            for user_id, s in self._inflight_sessions.items():
+                groups.setdefault(shard_of(user_id), ([], []))[0].append((user_id, s))
+            written = len(self._inflight_sessions)
+            for user_id, pending in self._inflight_messages.items():
+                rows = groups.setdefault(shard_of(user_id), ([], []))[1]
+                rows.extend((user_id, seq, role, _encode_content(content), ts) for seq, role, content, ts in pending)
+                written += len(pending)
+            try:
+                for index, (sessions, rows) in groups.items():
+                    async with shard_writing(index) as db:
+                        for user_id, s in sessions:
+                            await _write_sales_session(
+                                db,
+                                user_id=user_id,
+                                sku=s["sku"],
+                                stage=s["stage"],
+                                psychotype=s["psychotype"],
+                                psychotype_conf=s["psychotype_conf"],
+                                context=s["context"],
+                            )
+                        if rows:
+                            await db.executemany(
+                                """
+                                INSERT INTO conversation_messages(user_id, seq, role, content, ts)
+                                VALUES(?,?,?,?,?)
+                                ON CONFLICT(user_id, seq) DO NOTHING
+                                """,
+                                rows,
+                            )
+            except BaseException:
+                # Put the batch back; anything buffered meanwhile is newer and wins.
+                for user_id, s in self._inflight_sessions.items():
+                    self._sessions.setdefault(user_id, s)
+                for user_id, pending in self._inflight_messages.items():
+                    self._messages[user_id] = pending + self._messages.get(user_id, [])
+                raise
+            finally:
+                users = list(self._inflight_messages)
+                self._inflight_sessions, self._inflight_messages = {}, {}
+
+            # Committed: seq for idle users can be re-read from the table next time.
+            for user_id in users:
+                if user_id not in self._messages:
+                    self._next_seq.pop(user_id, None)
+            self.flushes += 1
+            self.flushed_rows += written
+            return written
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "interval_ms": int(self.interval * 1000),
+            "pending_sessions": len(self._sessions),
+            "pending_messages": sum(len(v) for v in self._messages.values()),
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
+
+write_behind: Optional[WriteBehind] = (
+    WriteBehind(settings.DB_WRITE_BEHIND_MS / 1000) if settings.DB_WRITE_BEHIND_MS > 0 else None
+)
 
 
 # -------- Sales orders --------
@@ -552,19 +2028,47 @@ async def create_sales_order(
     psychotype: str = "",
     payment_url: str = "",
     stage: str = "waiting_payment",
-) -> dict[str, Any]:
+    reserve_stock: bool = False,
+) -> Optional[dict[str, Any]]:
+    """Create a sales order.
+
+    With ``reserve_stock`` one unit of the (sku, size) variant is taken in
+    the same transaction, and given back by ``cancel_sales_order``. Returns
+    None (and writes nothing) when that variant is sold out.
+    """
+    if write_behind is not None:
+        # Barrier: the session/dialog that led to this order must be durable first.
+        await write_behind.flush()
+
     now = int(time.time())
     order_no = _make_order_no()
+    variant_sku = (sku or "").strip()
+    stored_size = variant_size(size)
+
+    async with writing() as db:
+        taken = None
+        if reserve_stock:
+            cur = await db.execute(
+                """
+                UPDATE product_variants SET stock = COALESCE(stock, 0) - 1
+                WHERE sku=? AND size=? AND is_active=1 AND COALESCE(stock, 0) > 0
+                RETURNING stock
+                """,
+                (variant_sku, stored_size),
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                return None
+            taken = int(rows[0][0])
 
-    async with aiosqlite.connect(settings.DB_PATH) as db:
         cur = await db.execute(
             """
             INSERT INTO sales_orders(
               order_no, user_id, sku, title, price, currency, size, color,
               customer_name, customer_phone, comment, psychotype,
-              payment_url, carrier, tracking_number, stage, created_at, updated_at
+              payment_url, carrier, tracking_number, stage, created_at, updated_at, stock_reserved
             )
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
             """,
             (
                 order_no,
@@ -585,11 +2089,14 @@ async def create_sales_order(
                 stage,
                 now,
                 now,
+                1 if reserve_stock else 0,
             ),
         )
-        await db.commit()
         order_id = int(cur.lastrowid)
 
+    if taken is not None:
+        _stock_changed(variant_sku, stored_size, taken + 1, taken, True)
+
     return {
         "id": order_id,
         "order_no": order_no,
@@ -610,26 +2117,18 @@ async def create_sales_order(
         "stage": stage,
         "created_at": now,
         "updated_at": now,
+        "stock_reserved": bool(reserve_stock),
     }
 
 
-async def get_sales_order_by_no(order_no: str) -> Optional[dict[str, Any]]:
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT id, order_no, user_id, sku, title, price, currency, size, color,
-                   customer_name, customer_phone, comment, psychotype,
-                   payment_url, carrier, tracking_number, stage, created_at, updated_at
-            FROM sales_orders
-            WHERE order_no=?
-            """,
-            ((order_no or "").strip(),),
-        )
-        row = await cur.fetchone()
+_SALES_ORDER_COLUMNS = (
+    "id, order_no, user_id, sku, title, price, currency, size, color, "
+    "customer_name, customer_phone, comment, psychotype, "
+    "payment_url, carrier, tracking_number, stage, created_at, updated_at, stock_reserved"
+)
 
-    if not row:
-        return None
 
+def _sales_order(row: Any) -> dict[str, Any]:
     return {
         "id": row[0],
         "order_no": row[1],
@@ -650,27 +2149,57 @@ async def get_sales_order_by_no(order_no: str) -> Optional[dict[str, Any]]:
         "stage": row[16],
         "created_at": row[17],
         "updated_at": row[18],
+        "stock_reserved": bool(row[19]),
     }
 
 
-async def update_sales_order_stage(order_no: str, stage: str) -> None:
+async def get_sales_order_by_no(order_no: str) -> Optional[dict[str, Any]]:
+    """Look the order up in sales_orders, then in sales_orders_archive."""
+    order_no = (order_no or "").strip()
+    async with connection() as db:
+        cur = await db.execute(
+            f"SELECT {_SALES_ORDER_COLUMNS} FROM sales_orders WHERE order_no=?",
+            (order_no,),
+        )
+        row = await cur.fetchone()
+        if not row:
+            cur = await db.execute(
+                f"SELECT {_SALES_ORDER_COLUMNS} FROM sales_orders_archive WHERE order_no=?",
+                (order_no,),
+            )
+            row = await cur.fetchone()
+
+    return _sales_order(row) if row else None
+
+
+async def update_sales_order_stage(order_no: str, stage: str) -> bool:
+    """Move an order to ``stage``; False when it is missing or already cancelled.
+
+    The stage is checked in the UPDATE itself, so an order that expired
+    after the caller looked at it is not revived without its stock.
+    """
+    if stage == "cancelled":
+        # Never leave a reserved unit behind.
+        return await cancel_sales_order(order_no) is not None
+
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        await db.execute(
-            "UPDATE sales_orders SET stage=?, updated_at=? WHERE order_no=?",
+    async with writing() as db:
+        cur = await db.execute(
+            "UPDATE sales_orders SET stage=?, updated_at=? WHERE order_no=? AND stage != 'cancelled'",
             (stage, now, (order_no or "").strip()),
         )
-        await db.commit()
+        return cur.rowcount > 0
 
 
-async def set_sales_order_tracking(order_no: str, carrier: str, tracking_number: str) -> None:
+async def set_sales_order_tracking(order_no: str, carrier: str, tracking_number: str) -> bool:
+    """Mark an order shipped; False when it is missing or already cancelled."""
     now = int(time.time())
-    async with aiosqlite.connect(settings.DB_PATH) as db:
-        await db.execute(
+    async with writing() as db:
+        cur = await db.execute(
             """
             UPDATE sales_orders
             SET carrier=?, tracking_number=?, stage='shipped', updated_at=?
-            WHERE order_no=?
+            WHERE order_no=? AND stage != 'cancelled'
             """,
             (
                 (carrier or "").strip(),
@@ -679,5 +2208,490 @@ async def set_sales_order_tracking(order_no: str, carrier: str, tracking_number:
                 (order_no or "").strip(),
             ),
         )
-        await db.commit()
+        return cur.rowcount > 0
+
+
+# Stages after which an order never changes again.
+ORDER_TERMINAL_STAGES = ("shipped", "delivered", "cancelled")
+
+
+async def _cancel_order(
+    db: aiosqlite.Connection, order_no: str, now: int
+) -> Optional[tuple[dict[str, Any], Optional[tuple]]]:
+    """Cancel an open order on the writer connection and put its reserved unit back.
+
+    Returns (order before the change, (sku, size, new stock, is_active) when a
+    unit was returned), or None when the order is missing or already final.
+    """
+    cur = await db.execute(
+        f"SELECT {_SALES_ORDER_COLUMNS} FROM sales_orders WHERE order_no=?",
+        (order_no,),
+    )
+    row = await cur.fetchone()
+    if row is None or row[16] in ORDER_TERMINAL_STAGES:
+        return None
+
+    await db.execute(
+        "UPDATE sales_orders SET stage='cancelled', stock_reserved=0, updated_at=? WHERE id=?",
+        (now, row[0]),
+    )
+    returned = None
+    if row[19]:
+        sku, size = row[3], variant_size(row[7])
+        cur = await db.execute(
+            "UPDATE product_variants SET stock = COALESCE(stock, 0) + 1 WHERE sku=? AND size=?"
+            " RETURNING stock, is_active",
+            (sku, size),
+        )
+        rows = await cur.fetchall()
+        if rows:
+            returned = (sku, size, int(rows[0][0]), bool(rows[0][1]))
+    return _sales_order(row), returned
+
+
+def _stock_returned(returned: Optional[tuple]) -> None:
+    if returned is not None:
+        sku, size, stock, active = returned
+        _stock_changed(sku, size, stock - 1, stock, active)
+
+
+async def cancel_sales_order(order_no: str) -> Optional[dict[str, Any]]:
+    """Cancel an order that is not shipped yet, returning its reserved unit to stock.
+
+    The stage change and the stock increment are one transaction. Returns
+    the order as it was before, or None when there is no such open order.
+    """
+    async with writing() as db:
+        cancelled = await _cancel_order(db, (order_no or "").strip(), int(time.time()))
+    if cancelled is None:
+        return None
+
+    order, returned = cancelled
+    _stock_returned(returned)
+    return order
+
+
+async def expire_unpaid_orders(hours: float, batch: int = 500) -> int:
+    """Cancel orders that have held a stock unit unpaid for ``hours``.
+
+    Each batch is one writer turn; returns the number of orders cancelled.
+    """
+    cutoff = int(time.time() - float(hours) * 3600)
+    expired = 0
+    while True:
+        returned = []
+        async with writing() as db:
+            cur = await db.execute(
+                """
+                SELECT order_no FROM sales_orders
+                WHERE stage = 'waiting_payment' AND stock_reserved = 1 AND created_at < ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (cutoff, int(batch)),
+            )
+            order_nos = [r[0] for r in await cur.fetchall()]
+            now = int(time.time())
+            for order_no in order_nos:
+                cancelled = await _cancel_order(db, order_no, now)
+                if cancelled is not None:
+                    returned.append(cancelled[1])
+        for r in returned:
+            _stock_returned(r)
+        expired += len(order_nos)
+        if len(order_nos) < batch:
+            return expired
+        await asyncio.sleep(0)
+
+
+async def archive_sales_orders(days: int, batch: int = 500) -> int:
+    """Move terminal orders not touched for ``days`` days to the archive.
+
+    Each batch is one writer turn; returns the number of orders moved.
+    """
+    cutoff = int(time.time()) - int(days) * 86400
+    stages = ", ".join("?" for _ in ORDER_TERMINAL_STAGES)
+    moved = 0
+    while True:
+        async with writing() as db:
+            cur = await db.execute(
+                f"""
+                SELECT id FROM sales_orders
+                WHERE stage IN ({stages}) AND updated_at < ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (*ORDER_TERMINAL_STAGES, cutoff, int(batch)),
+            )
+            ids = [r[0] for r in await cur.fetchall()]
+            if ids:
+                marks = ", ".join("?" for _ in ids)
+                await db.execute(
+                    f"""
+                    INSERT INTO sales_orders_archive({_SALES_ORDER_COLUMNS}, archived_at)
+                    SELECT {_SALES_ORDER_COLUMNS}, ? FROM sales_orders WHERE id IN ({marks})
+                    """,
+                    (int(time.time()), *ids),
+                )
+                await db.execute(f"DELETE FROM sales_orders WHERE id IN ({marks})", ids)
+        moved += len(ids)
+        if len(ids) < batch:
+            return moved
+        await asyncio.sleep(0)
+
+
+# -------- Retention --------
+# Periodically drops rows past their TTL (RETENTION_*_DAYS, 0 keeps forever)
+# in RETENTION_BATCH-sized deletes, each its own writer turn so the write
+# lock is never held for long, cancels unpaid orders that have held a stock
+# unit for ORDER_RESERVATION_HOURS, archives finished orders older than
+# ARCHIVE_ORDER_DAYS, then returns free pages to the OS and truncates the WAL.
+RETENTION_KEEP_STAGES = ("waiting_payment", "packing", "shipped")
+
+# (name, setting with the TTL in days, batched delete taking (cutoff, limit))
+RETENTION_RULES: list[tuple[str, str, str]] = [
+    (
+        "sales_sessions",
+        "RETENTION_SESSION_DAYS",
+        f"""
+        DELETE FROM sales_sessions
+        WHERE user_id IN (
+          SELECT user_id FROM sales_sessions
+          WHERE updated_at < ? AND stage NOT IN ({", ".join(f"'{s}'" for s in RETENTION_KEEP_STAGES)})
+          LIMIT ?
+        )
+        """,
+    ),
+    (
+        "conversation_messages",
+        "RETENTION_CONVERSATION_DAYS",
+        """
+        DELETE FROM conversation_messages
+        WHERE (user_id, seq) IN (
+          SELECT user_id, seq FROM conversation_messages WHERE ts < ? LIMIT ?
+        )
+        """,
+    ),
+    (
+        "conversations",
+        "RETENTION_CONVERSATION_DAYS",
+        """
+        DELETE FROM conversations
+        WHERE user_id IN (SELECT user_id FROM conversations WHERE updated_at < ? LIMIT ?)
+        """,
+    ),
+    (
+        "orders",
+        "RETENTION_ORDER_DAYS",
+        "DELETE FROM orders WHERE id IN (SELECT id FROM orders WHERE created_at < ? LIMIT ?)",
+    ),
+]
+
+
+class Retention:
+    def __init__(self, interval: float, batch: int):
+        self.interval = interval
+        self.batch = max(1, int(batch))
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.last_run: Optional[int] = None
+        self.last_report: dict[str, Any] = {}
+        self.total_deleted = 0
+
+    def start(self) -> None:
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except Exception:
+                pass
+
+    async def run(self) -> dict[str, Any]:
+        """One pass over RETENTION_RULES; returns rows deleted per table."""
+        now = int(time.time())
+        report: dict[str, Any] = {}
+        total = 0
+        for table, ttl_setting, sql in RETENTION_RULES:
+            days = int(getattr(settings, ttl_setting))
+            if days <= 0:
+                continue
+            cutoff = now - days * 86400
+            deleted = 0
+            for index in _files_holding(table):
+                while True:
+                    async with shard_writing(index) as db:
+                        cur = await db.execute(sql, (cutoff, self.batch))
+                        count = cur.rowcount
+                    deleted += count
+                    if count < self.batch:
+                        break
+                    await asyncio.sleep(0)  # let queued writers in between batches
+            report[table] = deleted
+            total += deleted
+
+        if settings.ORDER_RESERVATION_HOURS > 0:
+            report["sales_orders_expired"] = await expire_unpaid_orders(
+                settings.ORDER_RESERVATION_HOURS, self.batch
+            )
+
+        if settings.ARCHIVE_ORDER_DAYS > 0:
+            report["sales_orders_archived"] = await archive_sales_orders(
+                settings.ARCHIVE_ORDER_DAYS, self.batch
+            )
+
+        compacted = [await self._compact(path) for path in _database_files()]
+        report.update(
+            free_pages=sum(c["free_pages"] for c in compacted),
+            wal_checkpointed=sum(c["wal_checkpointed"] for c in compacted),
+            wal_busy=any(c["wal_busy"] for c in compacted),
+        )
+        self.runs += 1
+        self.last_run = now
+        self.last_report = report
+        self.total_deleted += total
+        return report
+
+    async def _compact(self, path: str) -> dict[str, Any]:
+        # PRAGMAs that cannot run inside the writer's transaction get a
+        # private connection; busy_timeout makes them queue behind it.
+        db = await _open_connection(path)
+        try:
+            cur = await db.execute("PRAGMA freelist_count")
+            free_pages = (await cur.fetchone())[0]
+            cur = await db.execute("PRAGMA auto_vacuum")
+            if (await cur.fetchone())[0] == 2 and free_pages:
+                await db.execute("PRAGMA incremental_vacuum")
+                await db.commit()
+            cur = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy, _, checkpointed = await cur.fetchone()
+        finally:
+            await db.close()
+        return {"free_pages": free_pages, "wal_checkpointed": checkpointed, "wal_busy": bool(busy)}
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "interval_s": self.interval,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_report": dict(self.last_report),
+            "total_deleted": self.total_deleted,
+        }
+
+
+retention = Retention(settings.RETENTION_INTERVAL_S, settings.RETENTION_BATCH)
+
+
+# -------- Backups --------
+# Online snapshots through the SQLite backup API: BACKUP_STEP_PAGES pages
+# per step with BACKUP_STEP_SLEEP_MS between steps, so the writer only
+# ever waits for one short step. The source holds a read transaction for
+# the whole copy; in WAL mode that pins a consistent snapshot without
+# blocking writers, and the backup never restarts on concurrent commits.
+_backup_lock = asyncio.Lock()
+
+
+def _backup_files(directory: str, prefix: str) -> list[str]:
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        os.path.join(directory, n) for n in names if n.startswith(prefix) and n.endswith(".db")
+    )
+
+
+async def _backup_file(source_path: str, path: str, pause: float) -> int:
+    """Copy ``source_path`` to ``path`` through ``path.part``; returns steps."""
+    part = path + ".part"
+    steps = 0
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        # Runs on the source connection's thread, between steps.
+        nonlocal steps
+        steps += 1
+        if remaining and pause:
+            time.sleep(pause)
+
+    source = await _open_connection(source_path, query_only=True)
+    target = sqlite3.connect(part, check_same_thread=False)
+    try:
+        await source.execute("BEGIN")
+        await source.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+        await source.backup(
+            target,
+            pages=max(1, int(settings.BACKUP_STEP_PAGES)),
+            progress=progress,
+        )
+        await source.rollback()
+        # A self-contained file: no -wal/-shm next to the snapshot.
+        target.execute("PRAGMA journal_mode=DELETE")
+    except BaseException:
+        target.close()
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        raise
+    finally:
+        await source.close()
+    target.close()
+    os.replace(part, path)
+    return steps
+
+
+async def backup_database(directory: Optional[str] = None, keep: Optional[int] = None) -> dict[str, Any]:
+    """Write a timestamped snapshot of the database and rotate old ones.
+
+    The copy goes to ``<name>-YYYYmmdd-HHMMSS.db.part`` and is renamed
+    only once complete. Shard files get their own snapshots with the same
+    timestamp. Keeps the newest ``keep`` snapshots per file (BACKUP_KEEP
+    by default).
+    """
+    directory = directory or settings.BACKUP_DIR
+    keep = settings.BACKUP_KEEP if keep is None else keep
+    pause = max(0, settings.BACKUP_STEP_SLEEP_MS) / 1000
+
+    async with _backup_lock:
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        started = time.perf_counter()
+        paths = []
+        steps = 0
+        for source_path in _database_files():
+            prefix = os.path.splitext(os.path.basename(source_path))[0] + "-"
+            paths.append(os.path.join(directory, f"{prefix}{stamp}.db"))
+            steps += await _backup_file(source_path, paths[-1], pause)
+        elapsed = time.perf_counter() - started
+
+        removed = []
+        kept = 0
+        for source_path in _database_files():
+            prefix = os.path.splitext(os.path.basename(source_path))[0] + "-"
+            snapshots = _backup_files(directory, prefix)
+            stale = snapshots[: max(0, len(snapshots) - max(1, keep))]
+            for old in stale:
+                try:
+                    os.remove(old)
+                    removed.append(old)
+                except OSError:
+                    pass
+            kept = max(kept, len(snapshots) - len(stale))
+
+    return {
+        "path": paths[0],
+        "shards": paths[1:],
+        "bytes": sum(os.path.getsize(p) for p in paths),
+        "seconds": round(elapsed, 3),
+        "steps": steps,
+        "removed": removed,
+        "kept": kept,
+    }
+
+
+# -------- Migrations --------
+# Ordered, append-only list of (version, name, step). A step is either a
+# tuple of SQL statements or a coroutine taking the connection; every step
+# must be idempotent, because a crash between the step and the
+# schema_version insert re-runs it on the next start. Never edit or reorder
+# a released step — add a new one.
+MigrationStep = tuple[str, ...] | Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+# Also applied to every shard file by init_db.
+_RETENTION_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_conversation_messages_ts ON conversation_messages(ts)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_sessions_updated_at ON sales_sessions(updated_at)",
+)
+
+async def _add_stock_reserved(db: aiosqlite.Connection) -> None:
+    # ADD COLUMN has no IF NOT EXISTS; fresh files already have it from SCHEMA.
+    for table in ("sales_orders", "sales_orders_archive"):
+        cur = await db.execute(f"PRAGMA table_info({table})")
+        if "stock_reserved" not in {row[1] for row in await cur.fetchall()}:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN stock_reserved INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS: list[tuple[int, str, MigrationStep]] = [
+    (
+        1,
+        "hot-path indexes",
+        (
+            "CREATE INDEX IF NOT EXISTS idx_product_photos_sku ON product_photos(sku)",
+            "CREATE INDEX IF NOT EXISTS idx_product_publications_sku ON product_publications(sku)",
+            "CREATE INDEX IF NOT EXISTS idx_sales_orders_user_id ON sales_orders(user_id)",
+            "CREATE INDEX IF NOT EXISTS idx_sales_orders_stage ON sales_orders(stage)",
+            "CREATE INDEX IF NOT EXISTS idx_products_listing ON products(is_active, is_sale, created_at)",
+        ),
+    ),
+    (2, "conversation blobs to conversation_messages", _migrate_conversations),
+    (3, "retention indexes", _RETENTION_INDEXES),
+    (4, "product cards backfill", ("INSERT OR REPLACE INTO product_cards SELECT * FROM product_card_source",)),
+    (
+        5,
+        "keyset listing index",
+        (
+            # Serves (is_sale, created_at, sku) < (?,?,?) as one range read;
+            # idx_products_listing is a prefix of it.
+            "CREATE INDEX IF NOT EXISTS idx_products_keyset ON products(is_active, is_sale, created_at, sku)",
+            "DROP INDEX IF EXISTS idx_products_listing",
+        ),
+    ),
+    (6, "sales order stock reservations", _add_stock_reserved),
+]
+
+
+async def _schema_version(db: aiosqlite.Connection) -> int:
+    cur = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    row = await cur.fetchone()
+    return int(row[0] or 0)
+
+
+async def _run_migrations(db: aiosqlite.Connection) -> list[int]:
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version INTEGER PRIMARY KEY,
+          name TEXT NOT NULL,
+          applied_at INTEGER NOT NULL
+        )
+        """
+    )
+    await db.commit()
+
+    current = await _schema_version(db)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+
+        await db.execute("BEGIN")
+        try:
+            if isinstance(step, tuple):
+                for statement in step:
+                    await db.execute(statement)
+            else:
+                await step(db)
+            await db.execute(
+                "INSERT INTO schema_version(version, name, applied_at) VALUES(?,?,?)",
+                (version, name, int(time.time())),
+            )
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        applied.append(version)
+
+    return applied
 
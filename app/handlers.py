@@ -3,7 +3,7 @@ from aiogram.enums import ChatType
 from aiogram.filters import Command
 from aiogram.types import Message
 
-from .db import get_conversation, upsert_conversation
+from .storage import append_messages, clear_conversation, get_recent_messages
 from .llm import chat
 
 router = Router()
@@ -28,7 +28,7 @@ async def reset(m: Message):
     if not m.from_user:
         return
 
-    await upsert_conversation(m.from_user.id, [])
+    await clear_conversation(m.from_user.id)
     await m.answer("Диалог сброшен. Напиши, что ищешь.")
 
 
@@ -41,14 +41,13 @@ async def any_text(m: Message):
         return
 
     user_id = m.from_user.id
-    history = await get_conversation(user_id) or []
-    history.append({"role": "user", "content": m.text})
-    history = history[-20:]
+    user_msg = {"role": "user", "content": m.text}
+    history = await get_recent_messages(user_id, 19)
+    history.append(user_msg)
 
     reply = await chat(user_id=user_id, messages=history)
 
-    history.append({"role": "assistant", "content": reply})
-    await upsert_conversation(user_id, history)
+    await append_messages(user_id, [user_msg, {"role": "assistant", "content": reply}])
 
     await m.answer(reply)
 
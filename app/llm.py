@@ -4,8 +4,8 @@ from typing import Any
 from openai import AsyncOpenAI
 
 from .config import settings
-from .catalog import search_products
-from .db import create_order
+from .storage import create_order, find_similar, search_products_page
+from .vocab import normalize_filters
 
 SYSTEM_PROMPT = """
 Ты — менеджер Telegram-магазина одежды MOSLAV.
@@ -61,6 +61,7 @@ SALES_SYSTEM_PROMPT_TEMPLATE = """
 6) Не выдумывай товары. Используй только данные из каталога.
 7) Если покупатель пишет не по теме — вежливо верни к покупкам.
 8) Всегда фиксируй следующий шаг в конце ответа (вопрос, предложение, CTA).
+9) Если нужного размера или цвета нет — предложи похожие товары через find_similar.
 """.strip()
 
 
@@ -70,7 +71,11 @@ TOOLS = [
     {
         "type": "function",
         "name": "search_catalog",
-        "description": "Ищет товары в каталоге магазина по текстовому запросу, цвету, размеру, полу, категории, сезону, ценовому диапазону.",
+        "description": (
+            "Ищет товары в каталоге магазина по текстовому запросу, цвету, размеру, полу, категории, сезону, "
+            "ценовому диапазону. Возвращает items и next_cursor: чтобы показать ещё, повтори вызов с теми же "
+            "параметрами и cursor=next_cursor. next_cursor = null — больше товаров нет."
+        ),
         "parameters": {
             "type": "object",
             "properties": {
@@ -83,6 +88,26 @@ TOOLS = [
                 "min_price": {"type": "number", "description": "Минимальная цена"},
                 "max_price": {"type": "number", "description": "Максимальная цена"},
                 "limit": {"type": "integer", "default": 6},
+                "cursor": {"type": "string", "description": "next_cursor из прошлого ответа, для следующей страницы"},
+            },
+            "required": [],
+        },
+    },
+    {
+        "type": "function",
+        "name": "find_similar",
+        "description": (
+            "Находит похожие товары: к товару sku или к описанию query. Используй, когда нужного "
+            "размера или цвета нет — передай size/color, и вернутся только альтернативы, где они есть."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "sku": {"type": "string", "description": "Артикул товара, к которому ищем похожие"},
+                "query": {"type": "string", "description": "Описание, если артикула нет"},
+                "size": {"type": "string", "description": "Нужный размер (S/M/L/XL/XXL/XXXL)"},
+                "color": {"type": "string", "description": "Нужный цвет"},
+                "limit": {"type": "integer", "default": 6},
             },
             "required": [],
         },
@@ -127,15 +152,30 @@ def _dump_item(x: Any) -> Any:
 
 async def _run_tool(name: str, args: dict[str, Any]) -> Any:
     if name == "search_catalog":
-        return await search_products(
+        args = normalize_filters(args)
+        try:
+            return await search_products_page(
+                query=(args.get("query", "") or ""),
+                color=args.get("color") or None,
+                size=args.get("size") or None,
+                gender=args.get("gender") or None,
+                category=args.get("category") or None,
+                season=args.get("season") or None,
+                min_price=args.get("min_price"),
+                max_price=args.get("max_price"),
+                limit=int(args.get("limit", 6) or 6),
+                cursor=args.get("cursor") or None,
+            )
+        except ValueError as e:
+            return {"error": f"{e}; repeat the search without cursor"}
+
+    if name == "find_similar":
+        args = normalize_filters(args)
+        return await find_similar(
+            sku=(args.get("sku", "") or ""),
             query=(args.get("query", "") or ""),
             color=args.get("color") or None,
             size=args.get("size") or None,
-            gender=args.get("gender") or None,
-            category=args.get("category") or None,
-            season=args.get("season") or None,
-            min_price=args.get("min_price"),
-            max_price=args.get("max_price"),
             limit=int(args.get("limit", 6) or 6),
         )
 
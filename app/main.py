@@ -3,10 +3,10 @@ from aiogram import Bot, Dispatcher
 from aiogram.types import Update
 
 from .config import settings
-from .db import init_db
 from .handlers import router
 from .admin import router as admin_router
 from .sales import router as sales_router
+from .storage import storage
 
 app = FastAPI()
 
@@ -19,7 +19,7 @@ dp.include_router(router)
 
 @app.on_event("startup")
 async def on_startup():
-    await init_db()
+    await storage.init()
     url = settings.webhook_url
     if url.startswith("https://"):
         await bot.set_webhook(
@@ -35,6 +35,7 @@ async def on_shutdown():
     if url.startswith("https://"):
         await bot.delete_webhook(drop_pending_updates=True)
     await bot.session.close()
+    await storage.close()
 
 
 @app.post(settings.WEBHOOK_PATH)
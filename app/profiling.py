@@ -42,6 +42,35 @@ PSYCHOTYPE_KEYWORDS: dict[str, list[str]] = {
     ],
 }
 
+# Lead context keyword maps (substrings of the lowercased message). Dict
+# order is priority. app/vocab.py reuses them for search filter terms.
+GENDER_KEYWORDS: dict[str, list[str]] = {
+    "male": ["для парня", "мужск", "мужчин", "себе парню", "мужу", "брату"],
+    "female": ["для девушк", "женск", "женщин", "себе девушке", "жене", "сестр", "подруг"],
+}
+
+SEASON_KEYWORDS: dict[str, list[str]] = {
+    "winter": ["зим", "холод", "мороз", "тепл"],
+    "summer": ["лет", "жар", "легк"],
+    "autumn": ["весн", "осен", "демисезон"],
+}
+
+CATEGORY_KEYWORDS: dict[str, list[str]] = {
+    "hoodie": ["худи", "толстовк", "свитшот", "кенгур"],
+    "jacket": ["куртк", "пуховик", "бомбер", "ветровк"],
+    "pants": ["штан", "брюк", "джогер", "карго"],
+    "tshirt": ["футболк", "майк", "тишк"],
+    "shorts": ["шорт"],
+    "tracksuit": ["костюм", "спортивн"],
+    "anorak": ["анорак"],
+    "vest": ["безрукавк", "жилет"],
+}
+
+COLOR_WORDS: list[str] = [
+    "черн", "бел", "серы", "серо", "синий", "синюю", "красн",
+    "зелен", "хаки", "бежев", "коричнев", "голуб",
+]
+
 # Tone/style presets per psychotype
 PSYCHOTYPE_STYLE: dict[str, dict[str, str]] = {
     "rational": {
@@ -145,10 +174,10 @@ def extract_lead_context(text: str, existing: dict[str, Any] | None = None) -> d
 
     # Gender detection
     if not ctx.get("gender"):
-        if any(w in t for w in ["для парня", "мужск", "мужчин", "себе парню", "мужу", "брату"]):
-            ctx["gender"] = "male"
-        elif any(w in t for w in ["для девушк", "женск", "женщин", "себе девушке", "жене", "сестр", "подруг"]):
-            ctx["gender"] = "female"
+        for gender, words in GENDER_KEYWORDS.items():
+            if any(w in t for w in words):
+                ctx["gender"] = gender
+                break
 
     # Budget detection
     if not ctx.get("budget"):
@@ -165,12 +194,10 @@ def extract_lead_context(text: str, existing: dict[str, Any] | None = None) -> d
 
     # Season
     if not ctx.get("season_pref"):
-        if any(w in t for w in ["зим", "холод", "мороз", "тепл"]):
-            ctx["season_pref"] = "winter"
-        elif any(w in t for w in ["лет", "жар", "легк"]):
-            ctx["season_pref"] = "summer"
-        elif any(w in t for w in ["весн", "осен", "демисезон"]):
-            ctx["season_pref"] = "autumn"
+        for season, words in SEASON_KEYWORDS.items():
+            if any(w in t for w in words):
+                ctx["season_pref"] = season
+                break
 
     # Occasion
     if not ctx.get("occasion"):
@@ -201,28 +228,14 @@ def extract_lead_context(text: str, existing: dict[str, Any] | None = None) -> d
 
     # Category interest
     if not ctx.get("category_interest"):
-        cat_map = {
-            "hoodie": ["худи", "толстовк", "свитшот", "кенгур"],
-            "jacket": ["куртк", "пуховик", "бомбер", "ветровк"],
-            "pants": ["штан", "брюк", "джогер", "карго"],
-            "tshirt": ["футболк", "майк", "тишк"],
-            "shorts": ["шорт"],
-            "tracksuit": ["костюм", "спортивн"],
-            "anorak": ["анорак"],
-            "vest": ["безрукавк", "жилет"],
-        }
-        for cat, words in cat_map.items():
+        for cat, words in CATEGORY_KEYWORDS.items():
             if any(w in t for w in words):
                 ctx["category_interest"] = cat
                 break
 
     # Color preference
     if not ctx.get("color_pref"):
-        color_words = [
-            "черн", "бел", "серы", "серо", "синий", "синюю", "красн",
-            "зелен", "хаки", "бежев", "коричнев", "голуб",
-        ]
-        for w in color_words:
+        for w in COLOR_WORDS:
             if w in t:
                 ctx["color_pref"] = w.rstrip("нйюыоае")
                 break
@@ -9,16 +9,19 @@ from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from .config import settings
-from .db import (
+from .storage import (
+    cancel_sales_order,
+    clear_conversation,
     clear_sales_session,
     create_sales_order,
-    get_conversation,
     get_product,
     get_sales_order_by_no,
     get_sales_session,
+    load_dialog_state,
+    patch_sales_session,
     set_sales_order_tracking,
+    stock_level,
     update_sales_order_stage,
-    upsert_conversation,
     upsert_sales_session,
 )
 from .llm import SALES_SYSTEM_PROMPT_TEMPLATE, sales_chat
@@ -70,6 +73,18 @@ def _format_price(value: float | int | str) -> str:
         return str(value).strip()
 
 
+def _available_sizes(p: dict | None) -> list[str] | None:
+    """Sizes a buyer can order: active ones, with STOCK_TRACKING only those in stock."""
+    if not p:
+        return None
+    sizes = p.get("sizes", [])
+    available = [s["size"] if isinstance(s, dict) else s for s in sizes if (isinstance(s, dict) and s.get("is_active", True)) or isinstance(s, str)]
+    if settings.STOCK_TRACKING:
+        sku = p.get("sku", "")
+        available = [s for s in available if (stock_level(sku, s) or 0) > 0]
+    return available
+
+
 def _parse_start_param(text: str) -> str:
     parts = (text or "").strip().split(maxsplit=1)
     return parts[1].strip() if len(parts) > 1 else ""
@@ -86,11 +101,9 @@ def _product_preview_text(p: dict) -> str:
         parts.append(desc[:200])
     parts.append(f"💰 Цена: {price} {currency}")
 
-    sizes = p.get("sizes", [])
-    if sizes:
-        size_list = [s["size"] if isinstance(s, dict) else s for s in sizes if (isinstance(s, dict) and s.get("is_active", True)) or isinstance(s, str)]
-        if size_list:
-            parts.append(f"📏 Размеры: {', '.join(size_list)}")
+    size_list = _available_sizes(p)
+    if size_list:
+        parts.append(f"📏 Размеры: {', '.join(size_list)}")
 
     colors = p.get("colors", [])
     if colors:
@@ -120,11 +133,9 @@ def _product_info_for_prompt(p: dict) -> str:
     if p.get("insulation"):
         lines.append(f"Утеплитель: {p['insulation']}")
 
-    sizes = p.get("sizes", [])
-    if sizes:
-        size_list = [s["size"] if isinstance(s, dict) else s for s in sizes if (isinstance(s, dict) and s.get("is_active", True)) or isinstance(s, str)]
-        if size_list:
-            lines.append(f"Доступные размеры: {', '.join(size_list)}")
+    size_list = _available_sizes(p)
+    if size_list:
+        lines.append(f"Доступные размеры: {', '.join(size_list)}")
 
     colors = p.get("colors", [])
     if colors:
@@ -167,10 +178,7 @@ def _sizing_info_for_prompt(ctx: dict, product: dict | None) -> str:
 
     gender = ctx.get("gender", product.get("gender", "male") if product else "male")
     fit = ctx.get("fit_pref", "")
-    available = None
-    if product:
-        sizes = product.get("sizes", [])
-        available = [s["size"] if isinstance(s, dict) else s for s in sizes if (isinstance(s, dict) and s.get("is_active", True)) or isinstance(s, str)]
+    available = _available_sizes(product)
 
     rec = recommend_size(body, gender=gender, fit_pref=fit, available_sizes=available)
     if not rec:
@@ -270,7 +278,7 @@ async def sales_start(m: Message):
         context={},
     )
     # Reset sales conversation history
-    await upsert_conversation(m.from_user.id, [])
+    await clear_conversation(m.from_user.id)
 
     await m.answer("Здравствуйте! Я менеджер магазина и помогу подобрать и оформить заказ.")
     await _send_product_preview(m, sku)
@@ -289,28 +297,22 @@ async def sale_checkout(cb):
         return
 
     context = s.get("context", {})
-    psychotype = s.get("psychotype", "")
-    psychotype_conf = float(s.get("psychotype_conf") or 0)
     sku = s.get("sku", "")
 
     # Check if we have sizing info — try to recommend
     product = await get_product(sku) if sku else None
     body = context.get("body_params", {})
     gender = context.get("gender", product.get("gender", "male") if product else "male")
-    available = None
-    if product:
-        sizes = product.get("sizes", [])
-        available = [sv["size"] if isinstance(sv, dict) else sv for sv in sizes if (isinstance(sv, dict) and sv.get("is_active", True)) or isinstance(sv, str)]
+    available = _available_sizes(product)
 
     rec = recommend_size(body, gender=gender, fit_pref=context.get("fit_pref", ""), available_sizes=available) if body else None
 
     if rec and rec.confidence >= 0.5:
         # Pre-fill recommended size
-        context["recommended_size"] = rec.primary
-        context["recommended_alt"] = rec.alternative
-        await upsert_sales_session(
-            user_id=cb.from_user.id, sku=sku, stage="collect_size",
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
+        await patch_sales_session(
+            cb.from_user.id,
+            stage="collect_size",
+            context_patch={"recommended_size": rec.primary, "recommended_alt": rec.alternative},
         )
         await cb.answer()
         if cb.message:
@@ -321,10 +323,7 @@ async def sale_checkout(cb):
                 "Напишите нужный размер или подтвердите рекомендованный."
             )
     else:
-        await upsert_sales_session(
-            user_id=cb.from_user.id, sku=sku, stage="collect_size",
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-        )
+        await patch_sales_session(cb.from_user.id, stage="collect_size")
         await cb.answer()
         if cb.message:
             sizes_text = ""
@@ -348,8 +347,12 @@ async def admin_payok(m: Message):
     order = await get_sales_order_by_no(order_no)
     if not order:
         return await m.answer("Заказ не найден.")
+    if order["stage"] == "cancelled":
+        return await m.answer(f"Заказ {order_no} отменён, товар вернулся в остаток. Оформите новый заказ.")
 
-    await update_sales_order_stage(order_no, "packing")
+    if not await update_sales_order_stage(order_no, "packing"):
+        # Expired between the lookup and the update.
+        return await m.answer(f"Заказ {order_no} уже отменён, оплату не отмечаю. Оформите новый заказ.")
     await upsert_sales_session(
         user_id=order["user_id"],
         sku=order["sku"],
@@ -372,6 +375,39 @@ async def admin_payok(m: Message):
     await m.answer(f"Заказ {order_no} переведен в packing, клиент уведомлен.")
 
 
+@router.message(Command("cancel"))
+async def admin_cancel(m: Message):
+    if not m.from_user or not _is_admin(m.from_user.id):
+        return
+
+    parts = (m.text or "").strip().split(maxsplit=1)
+    if len(parts) != 2:
+        return await m.answer("Формат: /cancel MS-20260309-AB12")
+
+    order_no = parts[1].strip()
+    order = await cancel_sales_order(order_no)
+    if not order:
+        return await m.answer("Заказ не найден или уже отправлен/отменён.")
+
+    await upsert_sales_session(
+        user_id=order["user_id"],
+        sku=order["sku"],
+        stage="selling",
+        psychotype=order.get("psychotype", ""),
+        psychotype_conf=0,
+        context={},
+    )
+
+    await m.bot.send_message(
+        order["user_id"],
+        f"Заказ {order_no} отменён.\n"
+        "Если захотите оформить его снова или подобрать что-то другое — просто напишите."
+    )
+
+    returned = " Товар вернулся в остаток." if order["stock_reserved"] else ""
+    await m.answer(f"Заказ {order_no} отменён, клиент уведомлен.{returned}")
+
+
 @router.message(Command("track"))
 async def admin_track(m: Message):
     if not m.from_user or not _is_admin(m.from_user.id):
@@ -385,8 +421,11 @@ async def admin_track(m: Message):
     order = await get_sales_order_by_no(order_no)
     if not order:
         return await m.answer("Заказ не найден.")
+    if order["stage"] == "cancelled":
+        return await m.answer(f"Заказ {order_no} отменён, товар вернулся в остаток. Оформите новый заказ.")
 
-    await set_sales_order_tracking(order_no, carrier, tracking_number)
+    if not await set_sales_order_tracking(order_no, carrier, tracking_number):
+        return await m.answer(f"Заказ {order_no} уже отменён, трек не сохранён. Оформите новый заказ.")
     await upsert_sales_session(
         user_id=order["user_id"],
         sku=order["sku"],
@@ -480,8 +519,8 @@ async def sales_dialog(m: Message):
     if _is_admin(m.from_user.id):
         return
 
-    s = await get_sales_session(m.from_user.id)
-    if not s:
+    state = await load_dialog_state(m.from_user.id, history_limit=20)
+    if not state:
         return
 
     text = (m.text or "").strip()
@@ -489,14 +528,15 @@ async def sales_dialog(m: Message):
         return
 
     user_id = m.from_user.id
-    psychotype = s.get("psychotype", "")
-    psychotype_conf = float(s.get("psychotype_conf") or 0)
-    context: dict[str, Any] = s.get("context", {}) or {}
-    stage = s.get("stage", "profiling")
-    sku = s.get("sku", "")
+    psychotype = state.psychotype
+    psychotype_conf = state.psychotype_conf
+    context: dict[str, Any] = state.context
+    stage = state.stage
+    sku = state.sku
+    product = state.product
 
     # --- Update profiling signals from every message ---
-    history = await get_conversation(user_id) or []
+    history = state.history
 
     # Detect psychotype (uses full history)
     new_psychotype, new_conf = detect_psychotype(
@@ -514,42 +554,36 @@ async def sales_dialog(m: Message):
     if body_params:
         context["body_params"] = body_params
 
+    state.psychotype = psychotype
+    state.psychotype_conf = psychotype_conf
+    state.context = context
+
     # --- Stage-specific logic ---
 
     if stage in ("profiling", "selling"):
         # Check if buyer wants to checkout
         if _buyer_ready_to_checkout(text):
-            await upsert_sales_session(
-                user_id=user_id, sku=sku, stage="collect_size",
-                psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-            )
+            state.stage = "collect_size"
 
             # Try size recommendation
-            product = await get_product(sku) if sku else None
             body = context.get("body_params", {})
             if body:
                 gender = context.get("gender", product.get("gender", "male") if product else "male")
-                available = None
-                if product:
-                    sizes = product.get("sizes", [])
-                    available = [sv["size"] if isinstance(sv, dict) else sv for sv in sizes if (isinstance(sv, dict) and sv.get("is_active", True)) or isinstance(sv, str)]
+                available = _available_sizes(product)
                 rec = recommend_size(body, gender=gender, fit_pref=context.get("fit_pref", ""), available_sizes=available)
                 if rec and rec.confidence >= 0.5:
                     context["recommended_size"] = rec.primary
-                    await upsert_sales_session(
-                        user_id=user_id, sku=sku, stage="collect_size",
-                        psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-                    )
+                    await patch_sales_session(user_id, **state.changes())
                     return await m.answer(
                         f"Отлично, оформляем! По вашим параметрам рекомендую размер {rec.primary} "
                         f"(уверенность {rec.confidence:.0%}), альтернатива: {rec.alternative}.\n\n"
                         "Напишите нужный размер или подтвердите рекомендованный."
                     )
 
+            await patch_sales_session(user_id, **state.changes())
             return await m.answer("Отлично, оформляем. Напишите, пожалуйста, нужный размер.")
 
         # LLM-driven natural dialogue for profiling/selling
-        product = await get_product(sku) if sku else None
         system_prompt = _build_sales_prompt(
             psychotype=psychotype,
             psychotype_conf=psychotype_conf,
@@ -559,21 +593,21 @@ async def sales_dialog(m: Message):
         )
 
         # Add user message to conversation history
-        history.append({"role": "user", "content": text})
+        user_msg = {"role": "user", "content": text}
+        history.append(user_msg)
         history = history[-20:]
 
         reply = await sales_chat(user_id=user_id, messages=history, system_prompt=system_prompt)
 
-        history.append({"role": "assistant", "content": reply})
-        await upsert_conversation(user_id, history)
-
         # Move to selling after first exchange
         new_stage = "selling" if stage == "profiling" else stage
         readiness = estimate_purchase_readiness(text, context, new_stage)
 
-        await upsert_sales_session(
-            user_id=user_id, sku=sku, stage=new_stage,
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
+        state.stage = new_stage
+        await patch_sales_session(
+            user_id,
+            **state.changes(),
+            messages=[user_msg, {"role": "assistant", "content": reply}],
         )
 
         # Notify admins on high readiness
@@ -591,13 +625,14 @@ async def sales_dialog(m: Message):
         return await m.answer(reply)
 
     if stage == "collect_size":
+        if settings.STOCK_TRACKING and stock_level(sku, text) == 0:
+            available = _available_sizes(product)
+            in_stock = f"\nВ наличии: {', '.join(available)}." if available else ""
+            return await m.answer(f"Размера {text.upper()} сейчас нет в наличии.{in_stock}\nКакой размер записать?")
         context["size"] = text
-        await upsert_sales_session(
-            user_id=user_id, sku=sku, stage="collect_color",
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-        )
+        state.stage = "collect_color"
+        await patch_sales_session(user_id, **state.changes())
         # Show available colors if known
-        product = await get_product(sku) if sku else None
         colors_text = ""
         if product:
             colors = product.get("colors", [])
@@ -608,35 +643,33 @@ async def sales_dialog(m: Message):
 
     if stage == "collect_color":
         context["color"] = text
-        await upsert_sales_session(
-            user_id=user_id, sku=sku, stage="collect_name",
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-        )
+        state.stage = "collect_name"
+        await patch_sales_session(user_id, **state.changes())
         return await m.answer("Подскажите, пожалуйста, как к вам обращаться?")
 
     if stage == "collect_name":
         context["customer_name"] = text
-        await upsert_sales_session(
-            user_id=user_id, sku=sku, stage="collect_phone",
-            psychotype=psychotype, psychotype_conf=psychotype_conf, context=context,
-        )
+        state.stage = "collect_phone"
+        await patch_sales_session(user_id, **state.changes())
         return await m.answer("Оставьте номер телефона для связи по заказу.")
 
     if stage == "collect_phone":
         context["customer_phone"] = text
 
-        product = await get_product(sku)
         title = product.get("title", "") if product else sku
         price = float(product.get("price", 0)) if product else 0
         currency = product.get("currency", "RUB") if product else "RUB"
 
+        # The unit is taken in the order's own transaction (and returned if
+        # it is cancelled or expires unpaid); None means it sold out meanwhile.
+        size = context.get("size", "")
         temp_order = await create_sales_order(
             user_id=user_id,
             sku=sku,
             title=title,
             price=price,
             currency=currency,
-            size=context.get("size", ""),
+            size=size,
             color=context.get("color", ""),
             customer_name=context.get("customer_name", ""),
             customer_phone=context.get("customer_phone", ""),
@@ -644,7 +677,17 @@ async def sales_dialog(m: Message):
             psychotype=psychotype,
             payment_url="",
             stage="waiting_payment",
+            reserve_stock=settings.STOCK_TRACKING and stock_level(sku, size) is not None,
         )
+        if temp_order is None:
+            state.stage = "collect_size"
+            await patch_sales_session(user_id, **state.changes())
+            available = _available_sizes(product)
+            in_stock = f"\nВ наличии: {', '.join(available)}." if available else ""
+            return await m.answer(
+                f"К сожалению, пока мы оформляли заказ, размер {size.upper()} закончился.{in_stock}\n"
+                "Напишите, какой размер записать."
+            )
 
         payment_url = PAYMENT_URL_TEMPLATE.format(order_no=temp_order["order_no"])
 
@@ -680,11 +723,9 @@ async def sales_dialog(m: Message):
             f"Ссылка на оплату: {payment_url}",
         )
 
-        await upsert_sales_session(
-            user_id=user_id, sku=sku, stage="waiting_payment",
-            psychotype=psychotype, psychotype_conf=psychotype_conf,
-            context={**context, "order_no": temp_order["order_no"]},
-        )
+        state.stage = "waiting_payment"
+        state.context = {**context, "order_no": temp_order["order_no"]}
+        await patch_sales_session(user_id, **state.changes())
 
         return await m.answer(
             f"Отлично, заказ почти оформлен ✅\n\n"
@@ -700,6 +741,14 @@ async def sales_dialog(m: Message):
         )
 
     if stage == "waiting_payment":
+        order = await get_sales_order_by_no(context.get("order_no", ""))
+        if order and order["stage"] == "cancelled":
+            state.stage = "selling"
+            await patch_sales_session(user_id, **state.changes())
+            return await m.answer(
+                f"Заказ {order['order_no']} отменён: оплата так и не поступила.\n"
+                "Если товар всё ещё нужен, напишите — оформим заново."
+            )
         return await m.answer(
             "Ваш заказ уже создан и ожидает подтверждения оплаты.\n"
             "Как только оплата будет подтверждена, я сразу сообщу об этом здесь."
@@ -0,0 +1,284 @@
+"""
+Offline "similar products" index.
+
+Every active product is a TF-IDF vector over character trigrams of its
+title, category, material and description (words padded with spaces, so
+"куртка" and "куртки" share most grams; title and category count more).
+No embedding service is involved: the whole index is a few NumPy arrays.
+
+Scoring is one sparse matrix-vector product over the stacked, L2-normalized
+product vectors (CSR rows summed with ``np.add.reduceat``), which gives the
+cosine similarity of every product to the query vector at once.
+
+Like ``CatalogIndex`` it is seeded by ``load()`` at startup and refreshed
+per sku through ``db.on_product_change``. Each product's term counts and the
+document frequencies are updated in place; the stacked arrays are rebuilt
+lazily on the first query after a text change, so a burst of admin edits
+costs one rebuild. Edits that leave the text alone (sizes, colors, photos,
+price) cost nothing.
+"""
+
+from __future__ import annotations
+
+import math
+from collections import Counter
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from .catalog_index import words
+from .db import connection, on_product_change
+
+# Term-count multiplier per field.
+_FIELDS = (("title", 3.0), ("category", 2.0), ("material", 1.0), ("description", 1.0))
+_N = 3
+
+
+def _grams(text: str) -> Counter[str]:
+    out: Counter[str] = Counter()
+    for word in words(text):
+        padded = f" {word} "
+        out.update(padded[i : i + _N] for i in range(len(padded) - _N + 1))
+    return out
+
+
+def _term_counts(fields: dict[str, str]) -> Counter[str]:
+    counts: Counter[str] = Counter()
+    for name, weight in _FIELDS:
+        for gram, n in _grams(fields.get(name) or "").items():
+            counts[gram] += weight * n
+    return counts
+
+
+class SimilarityIndex:
+    def __init__(self) -> None:
+        self.ready = False
+        self._loading = False
+        self._dirty: set[str] = set()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._slots: dict[str, int] = {}
+        self._skus: list[Optional[str]] = []
+        self._free: list[int] = []
+        self._texts: list[Optional[tuple[str, ...]]] = []
+        # Per slot: gram columns and their weighted counts.
+        self._docs: list[Optional[tuple[np.ndarray, np.ndarray]]] = []
+        self._vocab: dict[str, int] = {}
+        self._df: list[int] = []
+        # CSR matrix of every document; None when stale.
+        self._matrix: Optional[tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    # ---- maintenance ----
+
+    def remove(self, sku: str) -> None:
+        """Drop ``sku``'s document; no-op when absent."""
+        slot = self._slots.pop(sku, None)
+        if slot is None:
+            return
+        doc = self._docs[slot]
+        if doc is not None:
+            for col in doc[0].tolist():
+                self._df[col] -= 1
+        self._skus[slot] = None
+        self._texts[slot] = None
+        self._docs[slot] = None
+        self._free.append(slot)
+        self._matrix = None
+
+    def put(self, sku: str, fields: dict[str, str]) -> None:
+        """Index (or re-index) ``sku`` from its title/category/material/description."""
+        text = tuple(fields.get(name) or "" for name, _ in _FIELDS)
+        slot = self._slots.get(sku)
+        if slot is not None and self._texts[slot] == text:
+            return
+
+        self.remove(sku)
+        counts = _term_counts(fields)
+        vocab, df = self._vocab, self._df
+        columns = []
+        for gram in counts:
+            col = vocab.get(gram)
+            if col is None:
+                col = vocab[gram] = len(df)
+                df.append(0)
+            df[col] += 1
+            columns.append(col)
+        cols = np.array(columns, dtype=np.int32)
+        weights = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+
+        slot = self._free.pop() if self._free else len(self._skus)
+        if slot == len(self._skus):
+            self._skus.append(None)
+            self._texts.append(None)
+            self._docs.append(None)
+        self._skus[slot] = sku
+        self._texts[slot] = text
+        self._docs[slot] = (cols, weights)
+        self._slots[sku] = slot
+        self._matrix = None
+
+    def _idf(self) -> np.ndarray:
+        df = np.asarray(self._df, dtype=np.float32)
+        return np.log((1.0 + len(self._slots)) / (1.0 + df)) + 1.0
+
+    def _build(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """CSR (offsets, cols, weights), rows L2-normalized; empty rows for free slots."""
+        if self._matrix is not None:
+            return self._matrix
+
+        empty = (np.empty(0, np.int32), np.empty(0, np.float32))
+        docs = [d if d is not None else empty for d in self._docs] or [empty]
+        lengths = np.fromiter((len(d[0]) for d in docs), dtype=np.int64, count=len(docs))
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        cols = np.concatenate([d[0] for d in docs])
+        data = np.concatenate([d[1] for d in docs]) * self._idf()[cols]
+
+        norms = np.zeros(len(docs), dtype=np.float32)
+        self._row_sums(data * data, offsets, out=norms)
+        rows = np.repeat(np.arange(len(docs)), lengths)
+        data = (data / np.sqrt(norms)[rows]).astype(np.float32)
+
+        self._matrix = (offsets, cols, data)
+        return self._matrix
+
+    @staticmethod
+    def _row_sums(values: np.ndarray, offsets: np.ndarray, out: np.ndarray) -> np.ndarray:
+        # reduceat yields values[i] for an empty segment, so skip those rows.
+        nonempty = offsets[:-1] < offsets[1:]
+        if nonempty.any():
+            out[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+        return out
+
+    async def _fetch(self, sku: Optional[str] = None) -> list[tuple[str, dict[str, str]]]:
+        where = "WHERE is_active = 1" + (" AND sku = ?" if sku else "")
+        async with connection() as db:
+            cur = await db.execute(
+                f"SELECT sku, title, category, material, description FROM products {where}",
+                (sku,) if sku else (),
+            )
+            rows = await cur.fetchall()
+        return [(r[0], {"title": r[1], "category": r[2], "material": r[3], "description": r[4]}) for r in rows]
+
+    async def load(self) -> None:
+        """(Re)build the whole index from the database."""
+        self._loading = True
+        self._dirty.clear()
+        try:
+            rows = await self._fetch()
+            self._reset()
+            for sku, fields in rows:
+                self.put(sku, fields)
+            self._build()
+            self.ready = True
+        finally:
+            self._loading = False
+
+        dirty, self._dirty = self._dirty, set()
+        for sku in dirty:
+            await self.refresh(sku)
+
+    async def refresh(self, sku: str) -> None:
+        """Re-read a single sku after a catalog write."""
+        if self._loading:
+            self._dirty.add(sku)
+            return
+        if not self.ready:
+            return
+
+        rows = await self._fetch(sku)
+        if rows:
+            self.put(*rows[0])
+        else:
+            self.remove(sku)
+
+    # ---- queries ----
+
+    def _rank(
+        self,
+        query: np.ndarray,
+        limit: int,
+        skip: Optional[int],
+        allow: Optional[Callable[[str], bool]],
+    ) -> list[tuple[str, float]]:
+        offsets, cols, data = self._matrix
+        scores = self._row_sums(data * query[cols], offsets, np.zeros(len(offsets) - 1, dtype=np.float32))
+        if skip is not None:
+            scores[skip] = 0.0
+
+        hits = int(np.count_nonzero(scores > 0))
+        if not hits or limit <= 0:
+            return []
+        # Filters drop candidates, so partition off more than asked first.
+        want = min(hits, limit if allow is None else limit * 8)
+        while True:
+            top = np.argpartition(-scores, want - 1)[:want]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            out = []
+            for slot in top.tolist():
+                sku = self._skus[slot]
+                if scores[slot] > 0 and sku is not None and (allow is None or allow(sku)):
+                    out.append((sku, float(scores[slot])))
+                    if len(out) >= limit:
+                        return out
+            if want >= hits:
+                return out
+            want = hits
+
+    def similar(
+        self,
+        sku: str,
+        limit: int = 6,
+        allow: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[list[tuple[str, float]]]:
+        """Products most like ``sku`` as (sku, cosine), best first, ``sku`` itself excluded.
+
+        ``allow`` filters candidates. Returns None while the index is cold.
+        """
+        if not self.ready:
+            return None
+        slot = self._slots.get(sku)
+        if slot is None:
+            return []
+
+        offsets, cols, data = self._build()
+        query = np.zeros(len(self._df), dtype=np.float32)
+        start, end = offsets[slot], offsets[slot + 1]
+        query[cols[start:end]] = data[start:end]
+        return self._rank(query, int(limit), slot, allow)
+
+    def rank_text(
+        self,
+        text: str,
+        limit: int = 6,
+        allow: Optional[Callable[[str], bool]] = None,
+    ) -> Optional[list[tuple[str, float]]]:
+        """Products closest to a free-form description, as (sku, cosine)."""
+        if not self.ready:
+            return None
+
+        self._build()
+        idf = self._idf()
+        query = np.zeros(len(self._df), dtype=np.float32)
+        for gram, n in _grams(text).items():
+            col = self._vocab.get(gram)
+            if col is not None:
+                query[col] = (1.0 + math.log(n)) * idf[col]
+        norm = float(np.linalg.norm(query))
+        if not norm:
+            return []
+        return self._rank(query / norm, int(limit), None, allow)
+
+    def stats(self) -> dict[str, Any]:
+        matrix = self._matrix
+        return {
+            "ready": self.ready,
+            "products": len(self._slots),
+            "grams": len(self._vocab),
+            "nonzeros": int(matrix[0][-1]) if matrix is not None else None,
+        }
+
+
+similar_index = SimilarityIndex()
+on_product_change(similar_index.refresh)
@@ -0,0 +1,167 @@
+"""
+In-memory sku x size stock matrix.
+
+Mirrors product_variants.stock for active variants: one fixed-width row of
+an ``array('i')`` per sku, one column per size, -1 where the sku has no
+active variant of that size. A lookup is two dict probes and an array read.
+
+Stock writes (``db.set_variant_stock`` / ``db.adjust_variant_stock``) set
+one cell through ``db.on_stock_change``; other catalog writes re-read the
+sku's row through ``db.on_product_change``, since they may add, remove or
+deactivate sizes. Counts only drive availability when STOCK_TRACKING is on.
+"""
+
+from __future__ import annotations
+
+from array import array
+from typing import Any, Optional
+
+from .db import connection, on_product_change, on_stock_change
+
+_ABSENT = -1
+
+
+class StockMatrix:
+    def __init__(self, width: int = 8) -> None:
+        self.ready = False
+        self._loading = False
+        self._dirty: set[str] = set()
+        # Bumped by every apply(): a refresh whose read raced one re-reads.
+        self._gen: dict[str, int] = {}
+        self._initial_width = width
+        self._reset()
+
+    def _reset(self) -> None:
+        self._width = self._initial_width
+        self._cols: dict[str, int] = {}
+        self._rows: dict[str, int] = {}
+        self._free: list[int] = []
+        self._cells = array("i")
+
+    # ---- maintenance ----
+
+    def _col(self, size: str) -> int:
+        col = self._cols.get(size)
+        if col is not None:
+            return col
+        col = self._cols[size] = len(self._cols)
+        if col >= self._width:
+            # A new size past the row width: re-stride every row (rare, sizes are a short fixed list).
+            width = self._width * 2
+            cells = array("i", [_ABSENT]) * (len(self._cells) // self._width * width)
+            for row in range(len(self._cells) // self._width):
+                cells[row * width : row * width + self._width] = self._cells[row * self._width : (row + 1) * self._width]
+            self._cells, self._width = cells, width
+        return col
+
+    def _remove(self, sku: str) -> None:
+        row = self._rows.pop(sku, None)
+        if row is None:
+            return
+        base = row * self._width
+        self._cells[base : base + self._width] = array("i", [_ABSENT]) * self._width
+        self._free.append(row)
+
+    def _put(self, sku: str, variants: dict[str, int]) -> None:
+        cols = {size: self._col(size) for size in variants}
+        row = self._rows.get(sku)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = len(self._cells) // self._width
+                self._cells.extend(array("i", [_ABSENT]) * self._width)
+            self._rows[sku] = row
+        base = row * self._width
+        self._cells[base : base + self._width] = array("i", [_ABSENT]) * self._width
+        for size, stock in variants.items():
+            self._cells[base + cols[size]] = max(0, int(stock or 0))
+
+    def apply(self, sku: str, size: str, old: int, new: int) -> None:
+        """O(1) stock update for an active variant (``db.on_stock_change`` listener)."""
+        self._gen[sku] = self._gen.get(sku, 0) + 1
+        if self._loading:
+            self._dirty.add(sku)
+            return
+        row = self._rows.get(sku)
+        col = self._cols.get(size)
+        if row is None or col is None or self._cells[row * self._width + col] == _ABSENT:
+            # Variants are created by catalog writes, whose refresh loads them.
+            return
+        self._cells[row * self._width + col] = max(0, int(new))
+
+    async def _fetch(self, sku: Optional[str] = None) -> dict[str, dict[str, int]]:
+        where = "WHERE is_active = 1" + (" AND sku = ?" if sku else "")
+        async with connection() as db:
+            cur = await db.execute(
+                f"SELECT sku, size, COALESCE(stock, 0) FROM product_variants {where}",
+                (sku,) if sku else (),
+            )
+            rows = await cur.fetchall()
+        out: dict[str, dict[str, int]] = {}
+        for s, size, stock in rows:
+            out.setdefault(s, {})[size.strip().upper()] = int(stock)
+        return out
+
+    async def load(self) -> None:
+        """(Re)build the whole matrix from product_variants."""
+        self._loading = True
+        self._dirty.clear()
+        try:
+            variants = await self._fetch()
+            self._reset()
+            for sku, sizes in variants.items():
+                self._put(sku, sizes)
+            self.ready = True
+        finally:
+            self._loading = False
+
+        dirty, self._dirty = self._dirty, set()
+        for sku in dirty:
+            await self.refresh(sku)
+
+    async def refresh(self, sku: str) -> None:
+        """Re-read a single sku's variants after a catalog write."""
+        if self._loading:
+            self._dirty.add(sku)
+            return
+        if not self.ready:
+            return
+
+        while True:
+            gen = self._gen.get(sku, 0)
+            variants = await self._fetch(sku)
+            # A stock write committed during the read is newer than this
+            # snapshot (and already applied); read again rather than undo it.
+            if self._gen.get(sku, 0) == gen:
+                break
+        if sku in variants:
+            self._put(sku, variants[sku])
+        else:
+            self._remove(sku)
+
+    # ---- queries ----
+
+    def get(self, sku: str, size: str) -> Optional[int]:
+        """Stock of an active variant; None when there is no such variant."""
+        row = self._rows.get(sku)
+        col = self._cols.get((size or "").strip().upper())
+        if row is None or col is None:
+            return None
+        stock = self._cells[row * self._width + col]
+        return None if stock == _ABSENT else stock
+
+    def stats(self) -> dict[str, Any]:
+        in_stock = sum(1 for c in self._cells if c > 0)
+        return {
+            "ready": self.ready,
+            "skus": len(self._rows),
+            "sizes": len(self._cols),
+            "in_stock": in_stock,
+            "bytes": self._cells.itemsize * len(self._cells),
+        }
+
+
+stock = StockMatrix()
+on_product_change(stock.refresh)
+on_stock_change(stock.apply)
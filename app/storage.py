@@ -0,0 +1,798 @@
+"""
+Storage backends.
+
+``Storage`` is the persistence interface the handlers use: products,
+publications, conversations, sales sessions and orders. Two backends:
+
+* ``SqliteStorage`` - the aiosqlite implementation in ``app/db.py``
+  (write queue, caches, FTS, retention), used in production;
+* ``MemoryStorage`` - plain dicts plus the sorted/bitset ``CatalogIndex``
+  for search, no disk I/O at all. Meant for benchmarks and load tests of
+  the handler stack, and lost on restart.
+
+``STORAGE_BACKEND`` (``sqlite`` | ``memory``) picks one at import time;
+the module-level names below are bound to its methods, so call sites
+import plain functions as before.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import time
+from typing import Any, Optional, Protocol
+
+from . import db
+from .catalog import decode_cursor, encode_cursor, normalize_args, query_stems
+from .catalog import find_similar as _find_similar_sqlite
+from .catalog import search_products as _search_sqlite
+from .catalog import search_products_page as _search_page_sqlite
+from .catalog_index import CatalogIndex
+from .catalog_index import index as catalog_index
+from .config import settings
+from .db import DialogState
+from .similar import SimilarityIndex, similar_index
+from .stock import stock
+
+
+class Storage(Protocol):
+    async def init(self) -> None: ...
+    async def close(self) -> None: ...
+
+    # ---- products ----
+    async def get_product(self, sku: str) -> Optional[dict[str, Any]]: ...
+    async def upsert_product(
+        self,
+        *,
+        sku: str,
+        title: str,
+        description: str,
+        gender: str,
+        category: str,
+        season: str,
+        insulation: str,
+        material: str,
+        price: float,
+        currency: str = "RUB",
+        is_active: bool = True,
+        is_sale: bool = False,
+    ) -> None: ...
+    async def save_product_bundle(
+        self,
+        product: dict[str, Any],
+        sizes: dict[str, bool],
+        colors: list[str],
+        photo_file_ids: list[str],
+    ) -> None: ...
+    async def set_product_active(self, sku: str, active: bool) -> None: ...
+    async def toggle_product_sale(self, sku: str) -> Optional[bool]: ...
+    async def update_product_price(self, sku: str, price: float) -> None: ...
+    async def update_product_description(self, sku: str, description: str) -> None: ...
+    async def delete_product(self, sku: str) -> None: ...
+    async def set_variant_active(self, sku: str, size: str, active: bool) -> None: ...
+    async def set_variant_stock(self, sku: str, size: str, stock: int) -> Optional[int]: ...
+    async def adjust_variant_stock(self, sku: str, size: str, delta: int) -> Optional[int]: ...
+    def stock_level(self, sku: str, size: str) -> Optional[int]: ...
+    async def add_color(self, sku: str, color: str) -> None: ...
+    async def set_color_active(self, sku: str, color: str, active: bool) -> None: ...
+    async def add_photo_file_id(self, sku: str, file_id: str) -> None: ...
+    async def search_products(
+        self,
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+    ) -> list[dict[str, Any]]: ...
+    async def search_products_page(
+        self,
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+        cursor: Optional[str] = None,
+    ) -> dict[str, Any]: ...
+    async def find_similar(
+        self,
+        sku: str = "",
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        limit: int = 6,
+    ) -> list[dict[str, Any]]: ...
+
+    # ---- channel publications ----
+    async def save_product_publication(self, sku: str, chat_id: str, message_id: int) -> None: ...
+    async def get_product_publications(self, sku: str) -> list[dict[str, Any]]: ...
+    async def clear_product_publications(self, sku: str) -> None: ...
+
+    # ---- conversations ----
+    async def append_messages(self, user_id: int, messages: list[dict[str, Any]]) -> None: ...
+    async def get_recent_messages(self, user_id: int, n: int) -> list[dict[str, Any]]: ...
+    async def clear_conversation(self, user_id: int) -> None: ...
+
+    # ---- sales sessions ----
+    async def get_sales_session(self, user_id: int) -> Optional[dict[str, Any]]: ...
+    async def upsert_sales_session(
+        self,
+        *,
+        user_id: int,
+        sku: str = "",
+        stage: str = "new_chat",
+        psychotype: str = "",
+        psychotype_conf: float = 0,
+        context: dict[str, Any] | None = None,
+    ) -> None: ...
+    async def patch_sales_session(
+        self,
+        user_id: int,
+        *,
+        sku: Optional[str] = None,
+        stage: Optional[str] = None,
+        psychotype: Optional[str] = None,
+        psychotype_conf: Optional[float] = None,
+        context_patch: dict[str, Any] | None = None,
+        messages: list[dict[str, Any]] | None = None,
+    ) -> None: ...
+    async def clear_sales_session(self, user_id: int) -> None: ...
+    async def load_dialog_state(self, user_id: int, history_limit: int = 20) -> Optional[DialogState]: ...
+
+    # ---- orders ----
+    async def create_order(self, user_id: int, status: str, payload: dict[str, Any]) -> int: ...
+    async def create_sales_order(
+        self,
+        *,
+        user_id: int,
+        sku: str,
+        title: str = "",
+        price: float = 0,
+        currency: str = "RUB",
+        size: str = "",
+        color: str = "",
+        customer_name: str = "",
+        customer_phone: str = "",
+        comment: str = "",
+        psychotype: str = "",
+        payment_url: str = "",
+        stage: str = "waiting_payment",
+        reserve_stock: bool = False,
+    ) -> Optional[dict[str, Any]]: ...
+    async def get_sales_order_by_no(self, order_no: str) -> Optional[dict[str, Any]]: ...
+    async def update_sales_order_stage(self, order_no: str, stage: str) -> bool: ...
+    async def cancel_sales_order(self, order_no: str) -> Optional[dict[str, Any]]: ...
+    async def set_sales_order_tracking(self, order_no: str, carrier: str, tracking_number: str) -> bool: ...
+
+
+class SqliteStorage:
+    """The production backend: thin delegation to app/db.py."""
+
+    async def init(self) -> None:
+        await db.init_db()
+        await catalog_index.load()
+        await similar_index.load()
+        await stock.load()
+        db.retention.start()
+
+    async def close(self) -> None:
+        await db.close_db()
+
+    get_product = staticmethod(db.get_product)
+    upsert_product = staticmethod(db.upsert_product)
+    save_product_bundle = staticmethod(db.save_product_bundle)
+    set_product_active = staticmethod(db.set_product_active)
+    toggle_product_sale = staticmethod(db.toggle_product_sale)
+    update_product_price = staticmethod(db.update_product_price)
+    update_product_description = staticmethod(db.update_product_description)
+    delete_product = staticmethod(db.delete_product)
+    set_variant_active = staticmethod(db.set_variant_active)
+    set_variant_stock = staticmethod(db.set_variant_stock)
+    adjust_variant_stock = staticmethod(db.adjust_variant_stock)
+    stock_level = staticmethod(stock.get)
+    add_color = staticmethod(db.add_color)
+    set_color_active = staticmethod(db.set_color_active)
+    add_photo_file_id = staticmethod(db.add_photo_file_id)
+    search_products = staticmethod(_search_sqlite)
+    search_products_page = staticmethod(_search_page_sqlite)
+    find_similar = staticmethod(_find_similar_sqlite)
+
+    save_product_publication = staticmethod(db.save_product_publication)
+    get_product_publications = staticmethod(db.get_product_publications)
+    clear_product_publications = staticmethod(db.clear_product_publications)
+
+    append_messages = staticmethod(db.append_messages)
+    get_recent_messages = staticmethod(db.get_recent_messages)
+    clear_conversation = staticmethod(db.clear_conversation)
+
+    get_sales_session = staticmethod(db.get_sales_session)
+    upsert_sales_session = staticmethod(db.upsert_sales_session)
+    patch_sales_session = staticmethod(db.patch_sales_session)
+    clear_sales_session = staticmethod(db.clear_sales_session)
+    load_dialog_state = staticmethod(db.load_dialog_state)
+
+    create_order = staticmethod(db.create_order)
+    create_sales_order = staticmethod(db.create_sales_order)
+    get_sales_order_by_no = staticmethod(db.get_sales_order_by_no)
+    update_sales_order_stage = staticmethod(db.update_sales_order_stage)
+    cancel_sales_order = staticmethod(db.cancel_sales_order)
+    set_sales_order_tracking = staticmethod(db.set_sales_order_tracking)
+
+
+def _matches(result: dict[str, Any], stems: list[str]) -> bool:
+    text = " ".join((result["title"], result["description"], result["sku"], result["category"], result["material"]))
+    text = text.lower().replace("ё", "е")
+    return all(s in text for s in stems)
+
+
+def _now() -> int:
+    return int(time.time())
+
+
+class MemoryStorage:
+    """Everything in process memory; mirrors the SQLite backend's results."""
+
+    def __init__(self) -> None:
+        self._products: dict[str, dict[str, Any]] = {}
+        self._variants: dict[str, dict[str, dict[str, Any]]] = {}
+        self._colors: dict[str, dict[str, bool]] = {}
+        self._photos: dict[str, list[str]] = {}
+        self._publications: dict[str, list[dict[str, Any]]] = {}
+        self._messages: dict[int, list[dict[str, Any]]] = {}
+        self._sessions: dict[int, dict[str, Any]] = {}
+        self._orders: list[dict[str, Any]] = []
+        self._sales_orders: dict[str, dict[str, Any]] = {}
+        self._ids = {"publication": 0, "sales_order": 0}
+        # Same facet bitsets and sort order the SQLite backend caches.
+        self._index = CatalogIndex()
+        self._index.ready = True
+        self._similar = SimilarityIndex()
+        self._similar.ready = True
+
+    async def init(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def _next_id(self, kind: str) -> int:
+        self._ids[kind] += 1
+        return self._ids[kind]
+
+    # ---- products ----
+
+    def _reindex(self, sku: str) -> None:
+        p = self._products.get(sku)
+        if not p or not p["is_active"]:
+            self._index.remove(sku)
+            self._similar.remove(sku)
+            return
+        row = (
+            sku, p["title"], p["description"], p["gender"], p["category"], p["season"],
+            p["insulation"], p["material"], p["price"], p["currency"], p["is_sale"], p["created_at"],
+        )
+        sizes = [
+            s for s, v in self._variants.get(sku, {}).items()
+            if v["is_active"] and (not settings.STOCK_TRACKING or v["stock"] > 0)
+        ]
+        colors = [c for c, active in self._colors.get(sku, {}).items() if active]
+        self._index.put(row, sizes, colors)
+        self._similar.put(sku, p)
+
+    async def get_product(self, sku: str) -> Optional[dict[str, Any]]:
+        p = self._products.get(sku)
+        if p is None:
+            return None
+        return {
+            **p,
+            "sizes": [
+                {"size": size, "stock": v["stock"], "is_active": v["is_active"]}
+                for size, v in sorted(self._variants.get(sku, {}).items())
+            ],
+            "colors": [
+                {"color": color, "is_active": active}
+                for color, active in sorted(self._colors.get(sku, {}).items())
+            ],
+            "photo_file_ids": list(self._photos.get(sku, [])),
+        }
+
+    async def upsert_product(
+        self,
+        *,
+        sku: str,
+        title: str,
+        description: str,
+        gender: str,
+        category: str,
+        season: str,
+        insulation: str,
+        material: str,
+        price: float,
+        currency: str = "RUB",
+        is_active: bool = True,
+        is_sale: bool = False,
+    ) -> None:
+        now = _now()
+        old = self._products.get(sku)
+        self._products[sku] = {
+            "sku": sku,
+            "title": title,
+            "description": description,
+            "gender": gender,
+            "category": category,
+            "season": season,
+            "insulation": insulation,
+            "material": material,
+            "price": float(price),
+            "currency": currency,
+            "is_active": bool(is_active),
+            "is_sale": bool(is_sale),
+            "created_at": old["created_at"] if old else now,
+            "updated_at": now,
+        }
+        self._reindex(sku)
+
+    async def save_product_bundle(
+        self,
+        product: dict[str, Any],
+        sizes: dict[str, bool],
+        colors: list[str],
+        photo_file_ids: list[str],
+    ) -> None:
+        sku = (product.get("sku") or "").strip()
+        if not sku:
+            raise ValueError("sku is required")
+
+        await self.upsert_product(**{**product, "sku": sku})
+        variants = self._variants.setdefault(sku, {})
+        for size, active in sizes.items():
+            variants.setdefault(db.variant_size(size), {"stock": 0, "is_active": True})["is_active"] = bool(active)
+        for color in colors:
+            if (color or "").strip():
+                self._colors.setdefault(sku, {})[color.strip()] = True
+        self._photos.setdefault(sku, []).extend(f for f in photo_file_ids if f)
+        self._reindex(sku)
+
+    def _touch(self, sku: str, **fields: Any) -> bool:
+        p = self._products.get(sku)
+        if p is None:
+            return False
+        p.update(fields, updated_at=_now())
+        self._reindex(sku)
+        return True
+
+    async def set_product_active(self, sku: str, active: bool) -> None:
+        self._touch(sku, is_active=bool(active))
+
+    async def toggle_product_sale(self, sku: str) -> Optional[bool]:
+        p = self._products.get(sku)
+        if p is None:
+            return None
+        self._touch(sku, is_sale=not p["is_sale"])
+        return p["is_sale"]
+
+    async def update_product_price(self, sku: str, price: float) -> None:
+        self._touch(sku, price=float(price))
+
+    async def update_product_description(self, sku: str, description: str) -> None:
+        self._touch(sku, description=(description or "").strip())
+
+    async def delete_product(self, sku: str) -> None:
+        for table in (self._products, self._variants, self._colors, self._photos, self._publications):
+            table.pop(sku, None)
+        self._reindex(sku)
+
+    async def set_variant_active(self, sku: str, size: str, active: bool) -> None:
+        variants = self._variants.setdefault(sku, {})
+        variants.setdefault(db.variant_size(size), {"stock": 0, "is_active": True})["is_active"] = bool(active)
+        self._reindex(sku)
+
+    async def set_variant_stock(self, sku: str, size: str, stock: int) -> Optional[int]:
+        v = self._variants.get(sku, {}).get(db.variant_size(size))
+        if v is None:
+            return None
+        old, v["stock"] = v["stock"], max(0, int(stock))
+        self._reindex(sku)
+        return old
+
+    async def adjust_variant_stock(self, sku: str, size: str, delta: int) -> Optional[int]:
+        v = self._variants.get(sku, {}).get(db.variant_size(size))
+        if v is None or not v["is_active"] or v["stock"] + int(delta) < 0:
+            return None
+        v["stock"] += int(delta)
+        self._reindex(sku)
+        return v["stock"]
+
+    def stock_level(self, sku: str, size: str) -> Optional[int]:
+        v = self._variants.get(sku, {}).get(db.variant_size(size))
+        return v["stock"] if v is not None and v["is_active"] else None
+
+    async def add_color(self, sku: str, color: str) -> None:
+        color = (color or "").strip()
+        if color:
+            self._colors.setdefault(sku, {})[color] = True
+            self._reindex(sku)
+
+    async def set_color_active(self, sku: str, color: str, active: bool) -> None:
+        self._colors.setdefault(sku, {})[color] = bool(active)
+        self._reindex(sku)
+
+    async def add_photo_file_id(self, sku: str, file_id: str) -> None:
+        if sku and file_id:
+            self._photos.setdefault(sku, []).append(file_id)
+
+    async def search_products(
+        self,
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+    ) -> list[dict[str, Any]]:
+        filters = dict(
+            color=color, size=size, gender=gender, category=category, season=season,
+            min_price=min_price, max_price=max_price,
+        )
+        stems = query_stems(query)
+        if not stems:
+            return self._index.search(limit=limit, **filters) or []
+
+        # Text query: filter-ordered candidates, keep those containing every stem.
+        out = []
+        for r in self._index.search(limit=len(self._products), **filters) or []:
+            if _matches(r, stems):
+                out.append(r)
+                if len(out) >= limit:
+                    break
+        return out or self._index.fuzzy_search(query, limit=limit, **filters) or []
+
+    async def search_products_page(
+        self,
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        gender: Optional[str] = None,
+        category: Optional[str] = None,
+        season: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        limit: int = 6,
+        cursor: Optional[str] = None,
+    ) -> dict[str, Any]:
+        # Text queries page in listing order here (no bm25), so cursors are
+        # always "k" or "f".
+        args = normalize_args(query, color, size, gender, category, season, min_price, max_price)
+        mode, after = decode_cursor(args, cursor) or (None, None)
+        filters = {k: v for k, v in args.items() if k != "query"}
+        stems = query_stems(args["query"])
+
+        if mode == "f":
+            offset = after[0]
+            found = self._index.fuzzy_search(args["query"], limit=offset + limit + 1, **filters) or []
+            more = len(found) > offset + limit
+            return {
+                "items": found[offset : offset + limit],
+                "next_cursor": encode_cursor(args, "f", (offset + limit,)) if more else None,
+            }
+
+        if not stems:
+            items, last = self._index.search_page(after=after, limit=limit, **filters) or ([], None)
+            return {"items": items, "next_cursor": encode_cursor(args, "k", last) if last else None}
+
+        candidates, _ = self._index.search_page(after=after, limit=len(self._products), **filters) or ([], None)
+        out = []
+        for r in candidates:
+            if _matches(r, stems):
+                out.append(r)
+                if len(out) > limit:
+                    break
+        if not out and mode is None:
+            found = self._index.fuzzy_search(args["query"], limit=limit + 1, **filters) or []
+            more = len(found) > limit
+            return {"items": found[:limit], "next_cursor": encode_cursor(args, "f", (limit,)) if more else None}
+
+        next_cursor = None
+        if limit and len(out) > limit:
+            p = self._products[out[limit - 1]["sku"]]
+            next_cursor = encode_cursor(args, "k", (bool(p["is_sale"]), p["created_at"], p["sku"]))
+        return {"items": out[:limit], "next_cursor": next_cursor}
+
+    async def find_similar(
+        self,
+        sku: str = "",
+        query: str = "",
+        color: Optional[str] = None,
+        size: Optional[str] = None,
+        limit: int = 6,
+    ) -> list[dict[str, Any]]:
+        args = normalize_args(query, color, size)
+        allow = self._index.matcher(color=args["color"], size=args["size"])
+
+        sku = (sku or "").strip()
+        if sku:
+            ranked = self._similar.similar(sku, limit=limit, allow=allow)
+        else:
+            ranked = self._similar.rank_text(args["query"], limit=limit, allow=allow)
+        found = (self._index.get(s) for s, _ in ranked or [])
+        return [r for r in found if r is not None]
+
+    # ---- channel publications ----
+
+    async def save_product_publication(self, sku: str, chat_id: str, message_id: int) -> None:
+        sku = (sku or "").strip()
+        self._publications.setdefault(sku, []).append({
+            "id": self._next_id("publication"),
+            "sku": sku,
+            "chat_id": str(chat_id).strip(),
+            "message_id": int(message_id),
+            "created_at": _now(),
+        })
+
+    async def get_product_publications(self, sku: str) -> list[dict[str, Any]]:
+        return [dict(p) for p in self._publications.get((sku or "").strip(), [])]
+
+    async def clear_product_publications(self, sku: str) -> None:
+        self._publications.pop((sku or "").strip(), None)
+
+    # ---- conversations ----
+
+    async def append_messages(self, user_id: int, messages: list[dict[str, Any]]) -> None:
+        self._messages.setdefault(user_id, []).extend(
+            {"role": str(m.get("role") or "user"), "content": str(m.get("content") or "")}
+            for m in messages
+        )
+
+    async def get_recent_messages(self, user_id: int, n: int) -> list[dict[str, Any]]:
+        if n <= 0:
+            return []
+        return [dict(m) for m in self._messages.get(user_id, [])[-int(n):]]
+
+    async def clear_conversation(self, user_id: int) -> None:
+        self._messages.pop(user_id, None)
+
+    # ---- sales sessions ----
+
+    async def get_sales_session(self, user_id: int) -> Optional[dict[str, Any]]:
+        s = self._sessions.get(user_id)
+        return copy.deepcopy(s) if s is not None else None
+
+    async def upsert_sales_session(
+        self,
+        *,
+        user_id: int,
+        sku: str = "",
+        stage: str = "new_chat",
+        psychotype: str = "",
+        psychotype_conf: float = 0,
+        context: dict[str, Any] | None = None,
+    ) -> None:
+        now = _now()
+        old = self._sessions.get(user_id)
+        self._sessions[user_id] = {
+            "user_id": user_id,
+            "sku": (sku or "").strip(),
+            "stage": stage,
+            "psychotype": (psychotype or "").strip(),
+            "psychotype_conf": float(psychotype_conf or 0),
+            # Stored the way SQLite would store it: a JSON snapshot.
+            "context": json.loads(json.dumps(context or {}, ensure_ascii=False)),
+            "created_at": old["created_at"] if old else now,
+            "updated_at": now,
+        }
+
+    async def patch_sales_session(
+        self,
+        user_id: int,
+        *,
+        sku: Optional[str] = None,
+        stage: Optional[str] = None,
+        psychotype: Optional[str] = None,
+        psychotype_conf: Optional[float] = None,
+        context_patch: dict[str, Any] | None = None,
+        messages: list[dict[str, Any]] | None = None,
+    ) -> None:
+        for key in context_patch or {}:
+            if not isinstance(key, str) or not key or '"' in key:
+                raise ValueError(f"invalid session context key {key!r}")
+        if user_id not in self._sessions:
+            await self.upsert_sales_session(user_id=user_id)
+        s = self._sessions[user_id]
+        if sku is not None:
+            s["sku"] = sku.strip()
+        if stage is not None:
+            s["stage"] = stage
+        if psychotype is not None:
+            s["psychotype"] = psychotype.strip()
+        if psychotype_conf is not None:
+            s["psychotype_conf"] = float(psychotype_conf)
+        for key, value in (context_patch or {}).items():
+            if value is None:
+                s["context"].pop(key, None)
+            else:
+                s["context"][key] = json.loads(json.dumps(value, ensure_ascii=False))
+        s["updated_at"] = _now()
+        if messages:
+            await self.append_messages(user_id, messages)
+
+    async def clear_sales_session(self, user_id: int) -> None:
+        self._sessions.pop(user_id, None)
+
+    async def load_dialog_state(self, user_id: int, history_limit: int = 20) -> Optional[DialogState]:
+        s = await self.get_sales_session(user_id)
+        if not s:
+            return None
+        sku = (s.get("sku") or "").strip()
+        state = DialogState(
+            user_id=user_id,
+            sku=sku,
+            stage=s.get("stage") or "profiling",
+            psychotype=s.get("psychotype") or "",
+            psychotype_conf=float(s.get("psychotype_conf") or 0),
+            context=s.get("context") or {},
+            history=await self.get_recent_messages(user_id, history_limit),
+            product=await self.get_product(sku) if sku else None,
+        )
+        state.mark_saved()
+        return state
+
+    # ---- orders ----
+
+    async def create_order(self, user_id: int, status: str, payload: dict[str, Any]) -> int:
+        self._orders.append({
+            "user_id": user_id,
+            "status": status,
+            "payload": copy.deepcopy(payload),
+            "created_at": _now(),
+        })
+        return len(self._orders)
+
+    async def create_sales_order(
+        self,
+        *,
+        user_id: int,
+        sku: str,
+        title: str = "",
+        price: float = 0,
+        currency: str = "RUB",
+        size: str = "",
+        color: str = "",
+        customer_name: str = "",
+        customer_phone: str = "",
+        comment: str = "",
+        psychotype: str = "",
+        payment_url: str = "",
+        stage: str = "waiting_payment",
+        reserve_stock: bool = False,
+    ) -> Optional[dict[str, Any]]:
+        if reserve_stock and await self.adjust_variant_stock(sku, size, -1) is None:
+            return None
+
+        now = _now()
+        order_no = db._make_order_no()
+        while order_no in self._sales_orders:
+            order_no = db._make_order_no()
+        order = {
+            "id": self._next_id("sales_order"),
+            "order_no": order_no,
+            "user_id": user_id,
+            "sku": sku,
+            "title": title,
+            "price": float(price or 0),
+            "currency": currency,
+            "size": size,
+            "color": color,
+            "customer_name": customer_name,
+            "customer_phone": customer_phone,
+            "comment": comment,
+            "psychotype": psychotype,
+            "payment_url": payment_url,
+            "carrier": "",
+            "tracking_number": "",
+            "stage": stage,
+            "created_at": now,
+            "updated_at": now,
+            "stock_reserved": bool(reserve_stock),
+        }
+        self._sales_orders[order_no] = order
+        return dict(order)
+
+    async def get_sales_order_by_no(self, order_no: str) -> Optional[dict[str, Any]]:
+        order = self._sales_orders.get((order_no or "").strip())
+        return dict(order) if order else None
+
+    async def update_sales_order_stage(self, order_no: str, stage: str) -> bool:
+        if stage == "cancelled":
+            return await self.cancel_sales_order(order_no) is not None
+        order = self._sales_orders.get((order_no or "").strip())
+        if not order or order["stage"] == "cancelled":
+            return False
+        order.update(stage=stage, updated_at=_now())
+        return True
+
+    async def cancel_sales_order(self, order_no: str) -> Optional[dict[str, Any]]:
+        order = self._sales_orders.get((order_no or "").strip())
+        if not order or order["stage"] in db.ORDER_TERMINAL_STAGES:
+            return None
+        before = dict(order)
+        order.update(stage="cancelled", stock_reserved=False, updated_at=_now())
+        v = self._variants.get(order["sku"], {}).get(db.variant_size(order["size"]))
+        if before["stock_reserved"] and v is not None:
+            v["stock"] += 1
+            self._reindex(order["sku"])
+        return before
+
+    async def set_sales_order_tracking(self, order_no: str, carrier: str, tracking_number: str) -> bool:
+        order = self._sales_orders.get((order_no or "").strip())
+        if not order or order["stage"] == "cancelled":
+            return False
+        order.update(
+            carrier=(carrier or "").strip(),
+            tracking_number=(tracking_number or "").strip(),
+            stage="shipped",
+            updated_at=_now(),
+        )
+        return True
+
+
+def _create_storage() -> Storage:
+    backend = settings.STORAGE_BACKEND.strip().lower()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"unknown STORAGE_BACKEND {settings.STORAGE_BACKEND!r}")
+
+
+storage: Storage = _create_storage()
+
+# Call sites import these like the old db.py functions.
+get_product = storage.get_product
+upsert_product = storage.upsert_product
+save_product_bundle = storage.save_product_bundle
+set_product_active = storage.set_product_active
+toggle_product_sale = storage.toggle_product_sale
+update_product_price = storage.update_product_price
+update_product_description = storage.update_product_description
+delete_product = storage.delete_product
+set_variant_active = storage.set_variant_active
+set_variant_stock = storage.set_variant_stock
+adjust_variant_stock = storage.adjust_variant_stock
+stock_level = storage.stock_level
+add_color = storage.add_color
+set_color_active = storage.set_color_active
+add_photo_file_id = storage.add_photo_file_id
+search_products = storage.search_products
+search_products_page = storage.search_products_page
+find_similar = storage.find_similar
+
+save_product_publication = storage.save_product_publication
+get_product_publications = storage.get_product_publications
+clear_product_publications = storage.clear_product_publications
+
+append_messages = storage.append_messages
+get_recent_messages = storage.get_recent_messages
+clear_conversation = storage.clear_conversation
+
+get_sales_session = storage.get_sales_session
+upsert_sales_session = storage.upsert_sales_session
+patch_sales_session = storage.patch_sales_session
+clear_sales_session = storage.clear_sales_session
+load_dialog_state = storage.load_dialog_state
+
+create_order = storage.create_order
+create_sales_order = storage.create_sales_order
+get_sales_order_by_no = storage.get_sales_order_by_no
+update_sales_order_stage = storage.update_sales_order_stage
+cancel_sales_order = storage.cancel_sales_order
+set_sales_order_tracking = storage.set_sales_order_tracking
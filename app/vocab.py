@@ -0,0 +1,221 @@
+"""
+Canonical filter vocabulary for catalog search.
+
+The catalog stores codes set by the admin wizard (``hoodie``,
+``euro_winter``, ``male``) and free-form Russian colors, while the LLM's
+``search_catalog`` calls pass whatever the buyer said: "толстовку",
+"зимняя", "мужской", "black". ``canonical()`` maps such a value to the
+stored form so the filter hits on the first try.
+
+One dict per facet (term -> code) is compiled at import from the label
+tables below (also used by the admin wizard), the profiling keyword maps
+and a few synonyms. A lookup probes the whole normalized value (exact
+labels and phrases), then each word: the word itself, else its longest
+known prefix of at least three letters (which covers Russian endings).
+Between words, a noun beats an adjective ("спортивные штаны" are pants),
+then an exact word beats a prefix, then the longer match wins. A handful
+of hash probes, no scanning.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Optional
+
+from .catalog import stem
+from .catalog_index import words
+from .profiling import CATEGORY_KEYWORDS, COLOR_WORDS, GENDER_KEYWORDS, SEASON_KEYWORDS
+
+# (button label, code) for the admin wizard, and code -> display label.
+GENDERS = [
+    ("Мужской", "male"),
+    ("Женский", "female"),
+]
+
+CATEGORIES = [
+    ("Брюки", "pants"),
+    ("Толстовка", "hoodie"),
+    ("Футболка", "tshirt"),
+    ("Шорты", "shorts"),
+    ("Безрукавка", "vest"),
+    ("Анорак", "anorak"),
+    ("Куртка", "jacket"),
+    ("Спортивный костюм", "tracksuit"),
+]
+
+SEASONS = [
+    ("Лето", "summer"),
+    ("Весна-Осень", "autumn"),
+    ("Зима", "winter"),
+    ("Еврозима", "euro_winter"),
+]
+
+GENDER_LABELS = {
+    "male": "мужской",
+    "female": "женский",
+}
+
+CATEGORY_LABELS = {
+    "pants": "брюки",
+    "hoodie": "толстовка",
+    "tshirt": "футболка",
+    "shorts": "шорты",
+    "vest": "безрукавка",
+    "anorak": "анорак",
+    "jacket": "куртка",
+    "tracksuit": "спортивный костюм",
+}
+
+SEASON_LABELS = {
+    "summer": "лето",
+    "autumn": "Весна-Осень",
+    "winter": "зима",
+    "euro_winter": "еврозима",
+}
+
+_MIN_PREFIX = 3
+
+# A word with one of these endings is taken for an adjective.
+_ADJ_ENDINGS = (
+    "ый", "ий", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю",
+    "ого", "его", "ому", "ему", "ым", "им", "ых", "их", "ыми", "ими",
+)
+
+# Profiling season fragments that describe the garment ("лёгкая", "тёплая")
+# rather than a season: fine as a lead hint, wrong as a filter code.
+_NOT_SEASONS = ("легк", "тепл")
+
+_SYNONYMS: dict[str, dict[str, list[str]]] = {
+    "gender": {
+        "male": ["men", "mens", "man", "boy", "guy"],
+        "female": ["women", "womens", "woman", "girl", "lady"],
+    },
+    "category": {
+        "hoodie": ["hoody", "sweatshirt"],
+        "jacket": ["coat", "parka", "puffer", "bomber", "windbreaker"],
+        "pants": ["trousers", "joggers", "cargo"],
+        "tshirt": ["t-shirt", "tee"],
+        "tracksuit": ["suit"],
+        "vest": ["gilet"],
+    },
+    "season": {
+        "autumn": ["spring", "fall", "demi"],
+        "euro_winter": ["евро"],
+    },
+}
+
+# Stored colors are free-form ("черный", "темно-синий"); the filter is a
+# substring match, so the canonical form is the common stem.
+_COLORS: dict[str, list[str]] = {
+    "черн": ["black"],
+    "бел": ["white"],
+    "сер": ["grey", "gray"],
+    "син": ["blue", "navy"],
+    "красн": ["red"],
+    "зелен": ["green"],
+    "хаки": ["khaki", "olive"],
+    "бежев": ["beige"],
+    "коричнев": ["brown"],
+    "голуб": ["light blue", "sky"],
+}
+
+
+def _norm(value: str) -> str:
+    return " ".join(value.lower().replace("ё", "е").split())
+
+
+def _compile(*sources: dict[str, list[str]], phrases: dict[str, list[str]]) -> dict[str, str]:
+    """term -> code; earlier sources win on conflicts.
+
+    Terms from ``sources`` are also registered word by word (and stemmed);
+    ``phrases`` (the profiling substrings, "для парня") only as a whole.
+    """
+    table: dict[str, str] = {}
+    for source in sources:
+        for code, terms in source.items():
+            for term in terms:
+                term = _norm(term)
+                table.setdefault(term, code)
+                for word in words(term):
+                    table.setdefault(word, code)
+                    table.setdefault(stem(word), code)
+    for code, terms in phrases.items():
+        for term in terms:
+            table.setdefault(_norm(term), code)
+    return table
+
+
+def _labels(pairs: list[tuple[str, str]], labels: dict[str, str]) -> dict[str, list[str]]:
+    out: dict[str, list[str]] = {}
+    for label, code in pairs:
+        out.setdefault(code, []).extend([code, code.replace("_", " "), label])
+    for code, label in labels.items():
+        out.setdefault(code, []).append(label)
+    return out
+
+
+def _color_words() -> dict[str, list[str]]:
+    # Each profiling color word under the canonical stem it starts with.
+    out: dict[str, list[str]] = {}
+    for word in COLOR_WORDS:
+        root = max((s for s in _COLORS if word.startswith(s)), key=len, default=word)
+        out.setdefault(root, []).append(word)
+    return out
+
+
+VOCAB: dict[str, dict[str, str]] = {
+    "gender": _compile(_labels(GENDERS, GENDER_LABELS), _SYNONYMS["gender"], phrases=GENDER_KEYWORDS),
+    "category": _compile(_labels(CATEGORIES, CATEGORY_LABELS), _SYNONYMS["category"], phrases=CATEGORY_KEYWORDS),
+    "season": _compile(
+        _labels(SEASONS, SEASON_LABELS),
+        _SYNONYMS["season"],
+        phrases={code: [w for w in terms if w not in _NOT_SEASONS] for code, terms in SEASON_KEYWORDS.items()},
+    ),
+    "color": _compile({root: [root, *names] for root, names in _COLORS.items()}, phrases=_color_words()),
+}
+
+
+def _word_match(table: dict[str, str], word: str) -> Optional[tuple[bool, int, str]]:
+    """(exact, matched length, code) for ``word`` or its longest known prefix."""
+    code = table.get(word)
+    if code is not None:
+        return True, len(word), code
+    for end in range(len(word) - 1, _MIN_PREFIX - 1, -1):
+        code = table.get(word[:end])
+        if code is not None:
+            return False, end, code
+    return None
+
+
+def canonical(facet: str, value: Optional[str]) -> Optional[str]:
+    """Stored code for ``value`` in ``facet``, or None when unknown."""
+    table = VOCAB.get(facet)
+    if not table or not value:
+        return None
+
+    value = _norm(value)
+    code = table.get(value)
+    if code is not None:
+        return code
+
+    best: Optional[tuple[tuple[bool, bool, int], str]] = None
+    for word in words(value):
+        match = _word_match(table, word)
+        if match is None:
+            continue
+        rank = (not word.endswith(_ADJ_ENDINGS), match[0], match[1])
+        if best is None or rank > best[0]:
+            best = (rank, match[2])
+    return best[1] if best else None
+
+
+def normalize_filters(args: dict[str, Any]) -> dict[str, Any]:
+    """Copy of search_catalog ``args`` with known filter terms canonicalized.
+
+    Unknown values are passed through unchanged.
+    """
+    out = dict(args)
+    for facet in VOCAB:
+        value = out.get(facet)
+        if isinstance(value, str) and value.strip():
+            out[facet] = canonical(facet, value) or value
+    return out
@@ -0,0 +1,75 @@
+"""
+Benchmark "show more" pages: OFFSET/LIMIT against keyset cursors.
+
+For page ``n`` of the filter-only listing (limit 6) the OFFSET query reads
+and drops the ``6 * n`` rows before it; the cursor page seeks straight to
+the last row of page ``n - 1``. Both run as SQL with the catalog index
+cold and the search cache bypassed.
+
+    python -m bench.catalog_pages [--products 50000] [--repeat 100]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from bench.common import seed_catalog_sync, setup_env, timeit_async
+
+LIMIT = 6
+
+
+async def main(products: int, repeat: int) -> None:
+    path = setup_env("catalog-pages")
+
+    from app import db
+    from app.catalog import _RESULT_COLUMNS, normalize_args, _page_uncached, _result
+    from app.catalog_index import index
+
+    await db.init_db()
+    seed_catalog_sync(path, products)
+    index.ready = False
+    args = normalize_args()
+
+    async def offset_page(offset: int) -> list[dict]:
+        async with db.connection() as conn:
+            cur = await conn.execute(
+                f"""
+                SELECT {_RESULT_COLUMNS} FROM products p JOIN product_cards c ON c.sku = p.sku
+                WHERE p.is_active = 1
+                ORDER BY p.is_sale DESC, p.created_at DESC, p.sku DESC LIMIT ? OFFSET ?
+                """,
+                (LIMIT, offset),
+            )
+            return [_result(r) for r in await cur.fetchall()]
+
+    async with db.connection() as conn:
+        cur = await conn.execute(
+            "SELECT is_sale, created_at, sku FROM products WHERE is_active = 1"
+            " ORDER BY is_sale DESC, created_at DESC, sku DESC"
+        )
+        keys = await cur.fetchall()
+
+    print(f"catalog: {products} products, limit {LIMIT}, {repeat} runs per case")
+    print(f"{'page':>6} | {'offset p50':>10} | {'offset p95':>10} | {'cursor p50':>10} | {'cursor p95':>10}")
+    for page in (1, 10, 100, 1000, products // LIMIT - 1):
+        offset = LIMIT * (page - 1)
+        if page < 1 or offset >= len(keys):
+            continue
+        position = ("k", tuple(keys[offset - 1])) if offset else None
+        by_offset = await timeit_async(lambda: offset_page(offset), repeat)
+        by_cursor = await timeit_async(lambda: _page_uncached(args, position, LIMIT), repeat)
+        print(
+            f"{page:>6} | {by_offset['p50']:>8.2f}ms | {by_offset['p95']:>8.2f}ms"
+            f" | {by_cursor['p50']:>8.2f}ms | {by_cursor['p95']:>8.2f}ms"
+        )
+
+    await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.products, args.repeat))
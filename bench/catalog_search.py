@@ -0,0 +1,79 @@
+"""
+Benchmark catalog.search_products at limit=6, 20 and 50.
+
+Compares the batched size/color fetch against the previous N+1 pattern
+(two extra queries per result row). Both sides hit SQLite: the search
+cache is cleared and the in-memory CatalogIndex is kept cold, so the
+batched column times _search_uncached on its SQL path.
+
+    python -m bench.catalog_search [--products 5000] [--repeat 200]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from bench.common import seed_catalog_sync, setup_env, timeit_async
+
+
+async def _search_n_plus_one(connection, limit: int) -> list[dict]:
+    async with connection() as db:
+        cur = await db.execute(
+            """
+            SELECT p.sku, p.title FROM products p
+            WHERE p.is_active = 1
+            ORDER BY p.is_sale DESC, p.created_at DESC LIMIT ?
+            """,
+            (limit,),
+        )
+        rows = await cur.fetchall()
+
+    results = []
+    for sku, title in rows:
+        async with connection() as db:
+            cur = await db.execute(
+                "SELECT size FROM product_variants WHERE sku = ? AND is_active = 1 ORDER BY size",
+                (sku,),
+            )
+            sizes = [r[0] for r in await cur.fetchall()]
+            cur = await db.execute(
+                "SELECT color FROM product_colors WHERE sku = ? AND is_active = 1 ORDER BY color",
+                (sku,),
+            )
+            colors = [r[0] for r in await cur.fetchall()]
+        results.append({"sku": sku, "title": title, "sizes": sizes, "colors": colors})
+    return results
+
+
+async def main(products: int, repeat: int) -> None:
+    path = setup_env("catalog-search")
+
+    from app import db
+    from app.catalog import normalize_args, _search_uncached, search_cache
+    from app.catalog_index import index
+
+    await db.init_db()
+    seed_catalog_sync(path, products)
+    search_cache.clear()
+    index.ready = False
+
+    print(f"catalog: {products} products, {repeat} runs per case")
+    print(f"{'limit':>5} | {'batched p50':>11} | {'batched p95':>11} | {'n+1 p50':>8} | {'n+1 p95':>8}")
+    for limit in (6, 20, 50):
+        batched = await timeit_async(lambda: _search_uncached(**normalize_args(), limit=limit), repeat)
+        legacy = await timeit_async(lambda: _search_n_plus_one(db.connection, limit), repeat)
+        print(
+            f"{limit:>5} | {batched['p50']:>9.2f}ms | {batched['p95']:>9.2f}ms"
+            f" | {legacy['p50']:>6.2f}ms | {legacy['p95']:>6.2f}ms"
+        )
+
+    await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.products, args.repeat))
@@ -0,0 +1,88 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Benchmarks run against a throw-away SQLite file, so they must configure the
+environment before anything from ``app`` is imported (Settings is read at
+import time).
+"""
+
+from __future__ import annotations
+
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+COLORS = ["черный", "белый", "серый", "синий", "красный", "хаки", "бежевый", "зеленый"]
+CATEGORIES = ["pants", "hoodie", "tshirt", "shorts", "vest", "anorak", "jacket", "tracksuit"]
+SEASONS = ["summer", "autumn", "winter", "euro_winter"]
+SIZES = ["S", "M", "L", "XL", "XXL", "XXXL"]
+TITLES = ["Худи", "Толстовка", "Куртка", "Брюки карго", "Футболка", "Шорты", "Анорак", "Безрукавка"]
+
+
+def setup_env(name: str) -> str:
+    """Point the app at a fresh temporary database and return its path."""
+    tmpdir = tempfile.mkdtemp(prefix=f"moslav-bench-{name}-")
+    path = os.path.join(tmpdir, "bench.db")
+    os.environ["DB_PATH"] = path
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("WEBHOOK_SECRET", "bench")
+    return path
+
+
+def seed_catalog_sync(path: str, n: int, seed: int = 42) -> None:
+    """Bulk-insert ``n`` synthetic products with sizes and colors."""
+    import sqlite3
+
+    rnd = random.Random(seed)
+    now = int(time.time())
+    products = []
+    variants = []
+    colors = []
+    for i in range(n):
+        sku = f"SKU-{i:06d}"
+        title = f"{rnd.choice(TITLES)} {rnd.choice(COLORS)} {i}"
+        products.append((
+            sku, title, f"Описание товара {i}", rnd.choice(["male", "female"]),
+            rnd.choice(CATEGORIES), rnd.choice(SEASONS), "", "хлопок",
+            float(rnd.randrange(1500, 15000, 100)), 1, int(rnd.random() < 0.2),
+            now - rnd.randrange(0, 86400 * 90),
+        ))
+        for size in rnd.sample(SIZES, rnd.randint(2, 6)):
+            variants.append((sku, size, 1))
+        for color in rnd.sample(COLORS, rnd.randint(1, 4)):
+            colors.append((sku, color, 1))
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany(
+            """
+            INSERT INTO products(sku,title,description,gender,category,season,insulation,material,
+                                 price,is_active,is_sale,created_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            products,
+        )
+        conn.executemany("INSERT INTO product_variants(sku,size,is_active) VALUES(?,?,?)", variants)
+        conn.executemany("INSERT INTO product_colors(sku,color,is_active) VALUES(?,?,?)", colors)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def timeit_async(fn: Callable[[], Awaitable[Any]], repeat: int) -> dict[str, float]:
+    """Run ``fn`` ``repeat`` times and return latency percentiles in ms."""
+    await fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "mean": statistics.fmean(samples),
+    }
@@ -0,0 +1,153 @@
+"""
+Benchmark conversation storage: bytes on disk and history decode time.
+
+Builds one synthetic conversation table per layout and reports the file
+size and the time to load the last 20 messages of random users:
+
+* blob  - the legacy ``conversations.messages_json`` row per user
+* plain - ``conversation_messages`` rows stored as TEXT
+* zlib / zstd - the same rows through the db.py message codec
+  (zstd only when the ``zstandard`` package is installed)
+
+    python -m bench.conversation_codec [--users 100000] [--reads 2000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import time
+
+from bench.common import COLORS, TITLES, setup_env
+
+_USER_LINES = [
+    "Есть {title} размера {size}?",
+    "А в цвете {color} будет?",
+    "Сколько стоит доставка до Казани?",
+    "Хочу что-нибудь теплое на зиму, рост 182",
+    "Покажите, пожалуйста, что есть со скидкой",
+]
+_ASSISTANT_LINES = [
+    "Да, {title} есть в наличии в размере {size}, цвет {color}.",
+    "Модель хорошо держит форму после стирки и не садится.",
+    "Ткань плотная, хлопок с добавлением эластана, поэтому вещь приятная к телу и не растягивается.",
+    "Доставка по России занимает от двух до пяти рабочих дней, отправляем СДЭКом или Почтой.",
+    "Если размер не подойдет, обмен бесплатный в течение 14 дней после получения.",
+    "Могу подобрать к ней брюки карго или шорты в том же оттенке, получится готовый комплект.",
+    "Сейчас на эту позицию действует скидка, цена указана уже с ее учетом.",
+    "Подскажите ваш рост и вес, чтобы я точнее посоветовал размер.",
+]
+
+
+def _conversation(rnd: random.Random) -> list[dict[str, str]]:
+    out = []
+    for _ in range(rnd.randint(2, 10)):
+        fill = {
+            "title": rnd.choice(TITLES).lower(),
+            "size": rnd.choice(["S", "M", "L", "XL"]),
+            "color": rnd.choice(COLORS),
+        }
+        out.append({"role": "user", "content": rnd.choice(_USER_LINES).format(**fill)})
+        reply = " ".join(rnd.choice(_ASSISTANT_LINES) for _ in range(rnd.randint(1, 6)))
+        out.append({"role": "assistant", "content": reply.format(**fill)})
+    return out
+
+
+def _build(path: str, layout: str, users: int, seed: int) -> None:
+    from app.db import SCHEMA, SHARD_SCHEMA, _encode_content
+
+    rnd = random.Random(seed)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executescript(SHARD_SCHEMA)
+        batch = []
+        for user_id in range(1, users + 1):
+            messages = _conversation(rnd)
+            if layout == "blob":
+                batch.append((user_id, json.dumps(messages, ensure_ascii=False), now))
+            else:
+                batch.extend(
+                    (user_id, seq, m["role"], _encode_content(m["content"], layout), now)
+                    for seq, m in enumerate(messages, start=1)
+                )
+            if len(batch) >= 20000:
+                _flush(conn, layout, batch)
+                batch = []
+        _flush(conn, layout, batch)
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def _flush(conn: sqlite3.Connection, layout: str, batch: list[tuple]) -> None:
+    if layout == "blob":
+        conn.executemany("INSERT INTO conversations(user_id, messages_json, updated_at) VALUES(?,?,?)", batch)
+    else:
+        conn.executemany(
+            "INSERT INTO conversation_messages(user_id, seq, role, content, ts) VALUES(?,?,?,?,?)",
+            batch,
+        )
+
+
+def _read(path: str, layout: str, user_ids: list[int]) -> list[float]:
+    from app.db import _decode_content
+
+    conn = sqlite3.connect(path)
+    samples = []
+    try:
+        for user_id in user_ids:
+            started = time.perf_counter()
+            if layout == "blob":
+                row = conn.execute("SELECT messages_json FROM conversations WHERE user_id=?", (user_id,)).fetchone()
+                history = json.loads(row[0])[-20:]
+            else:
+                rows = conn.execute(
+                    "SELECT role, content FROM conversation_messages WHERE user_id=? ORDER BY seq DESC LIMIT 20",
+                    (user_id,),
+                ).fetchall()
+                history = [{"role": r, "content": _decode_content(c)} for r, c in reversed(rows)]
+            assert history
+            samples.append((time.perf_counter() - started) * 1000)
+    finally:
+        conn.close()
+    samples.sort()
+    return samples
+
+
+def main(users: int, reads: int) -> None:
+    base = os.path.dirname(setup_env("conversation-codec"))
+
+    from app.db import zstandard
+
+    layouts = ["blob", "plain", "zlib"] + (["zstd"] if zstandard else [])
+    rnd = random.Random(7)
+    user_ids = [rnd.randint(1, users) for _ in range(reads)]
+
+    print(f"conversations: {users} users, {reads} history reads per layout")
+    print(f"{'layout':>6} | {'file MB':>8} | {'build s':>7} | {'read p50':>9} | {'read p95':>9}")
+    for layout in layouts:
+        path = os.path.join(base, f"{layout}.db")
+        started = time.perf_counter()
+        _build(path, layout, users, seed=42)
+        built = time.perf_counter() - started
+        samples = _read(path, layout, user_ids)
+        print(
+            f"{layout:>6} | {os.path.getsize(path) / 2**20:>8.1f} | {built:>7.1f}"
+            f" | {statistics.median(samples):>7.3f}ms"
+            f" | {samples[min(len(samples) - 1, int(len(samples) * 0.95))]:>7.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+    main(args.users, args.reads)
@@ -0,0 +1,138 @@
+"""
+Benchmark the typo-tolerant catalog search fallback on a synthetic catalog.
+
+Queries are product title words damaged the way buyers type them (a
+dropped, doubled, swapped or substituted letter, a changed ending, or
+Latin transliteration). A query counts as recalled when at least one of
+the top ``--limit`` results has the original word in its title. Reports:
+
+* exact  - the FTS/LIKE search alone (what buyers got before)
+* search - ``catalog.search_products`` with the trigram fallback
+* fuzzy  - ``CatalogIndex.fuzzy_search`` alone
+* scan   - the same trigram scoring by brute force over every title,
+  the linear baseline the term index avoids
+
+    python -m bench.fuzzy_search [--products 50000] [--queries 500]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from bench.common import TITLES, seed_catalog_sync, setup_env
+
+_RU = "абвгдежзийклмнопрстуфхцчшщыэюя"
+_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s",
+    "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+
+def _damage(word: str, rnd: random.Random) -> str:
+    i = rnd.randrange(1, len(word) - 1)
+    kind = rnd.choice(["drop", "double", "swap", "substitute", "ending", "translit"])
+    if kind == "drop":
+        return word[:i] + word[i + 1 :]
+    if kind == "double":
+        return word[:i] + word[i] + word[i:]
+    if kind == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2 :]
+    if kind == "substitute":
+        return word[:i] + rnd.choice(_RU) + word[i + 1 :]
+    if kind == "ending":
+        return word[:-1] + rnd.choice(["о", "у", "ы", "ик", "ку"])
+    return "".join(_LATIN.get(ch, ch) for ch in word)
+
+
+def _queries(n: int, seed: int) -> list[tuple[str, str]]:
+    rnd = random.Random(seed)
+    words = sorted({w.lower() for t in TITLES for w in t.split() if len(w) >= 4})
+    return [(_damage(w, rnd), w) for w in (rnd.choice(words) for _ in range(n))]
+
+
+def _percentiles(samples: list[float]) -> tuple[float, float]:
+    samples = sorted(samples)
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+async def main(products: int, queries: int, limit: int) -> None:
+    path = setup_env("fuzzy-search")
+
+    from app import db
+    from app.catalog import _search_uncached
+    from app.catalog_index import _translit, _trigrams, index, words
+
+    await db.init_db()
+    seed_catalog_sync(path, products)
+
+    started = time.perf_counter()
+    await index.load()
+    built = time.perf_counter() - started
+    stats = index.stats()
+    print(
+        f"catalog: {products} products; index load {built:.2f}s, "
+        f"{stats['terms']} terms, {stats['trigrams']} trigrams"
+    )
+
+    # Brute-force baseline: trigram sets of every title, scored per query.
+    titles = [(e.title, [_trigrams(w) for w in words(e.title)]) for e in index._entries if e]
+
+    def scan(query: str) -> list[str]:
+        grams = [(_trigrams(w), _trigrams(_translit(w))) for w in words(query)]
+        scored = []
+        for title, title_grams in titles:
+            score = sum(
+                max((2 * len(q & t) / (len(q) + len(t)) for q in variants for t in title_grams), default=0)
+                for variants in grams
+            )
+            if score >= 0.5:
+                scored.append((score, title))
+        return [t for _, t in sorted(scored, reverse=True)[:limit]]
+
+    async def exact(query: str) -> list[str]:
+        # The pre-fallback behaviour: the SQL path with the fuzzy step skipped.
+        saved, index.ready = index.ready, False
+        try:
+            return [r["title"] for r in await _search_uncached(query=query, limit=limit)]
+        finally:
+            index.ready = saved
+
+    async def search(query: str) -> list[str]:
+        return [r["title"] for r in await _search_uncached(query=query, limit=limit)]
+
+    async def fuzzy(query: str) -> list[str]:
+        return [r["title"] for r in index.fuzzy_search(query, limit=limit)]
+
+    async def brute(query: str) -> list[str]:
+        return scan(query)
+
+    cases = _queries(queries, seed=7)
+    print(f"{len(cases)} damaged queries, top {limit}")
+    print(f"{'mode':>6} | {'recall':>6} | {'p50':>9} | {'p95':>9}")
+    for name, fn in (("exact", exact), ("search", search), ("fuzzy", fuzzy), ("scan", brute)):
+        hits = 0
+        samples = []
+        for query, word in cases:
+            t0 = time.perf_counter()
+            titles_found = await fn(query)
+            samples.append((time.perf_counter() - t0) * 1000)
+            hits += any(word in t.lower() for t in titles_found)
+        p50, p95 = _percentiles(samples)
+        print(f"{name:>6} | {hits / len(cases):>6.1%} | {p50:>7.3f}ms | {p95:>7.3f}ms")
+
+    await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=6)
+    args = parser.parse_args()
+    asyncio.run(main(args.products, args.queries, args.limit))
@@ -0,0 +1,139 @@
+"""
+Benchmark conversational write throughput against DB_SHARDS.
+
+``--procs`` worker processes (gunicorn workers in production) share one
+fresh database per shard count; each has its own event loop and writers
+and serves its slice of ``--users`` concurrent buyers. Every buyer does
+``--turns`` dialog turns: one sales session upsert plus one append of a
+user/assistant message pair, the write pattern of a sales handler.
+
+Inside one process every writer shares the event loop and the aiosqlite
+thread handoffs, so sharding barely moves throughput there (``--procs 1``).
+Across processes the unsharded file has one write lock for everybody and
+shards let workers commit to different files at once, but each worker then
+runs one writer per shard with smaller batches and more commits; that only
+wins when the workers have cores of their own. Compare ``commits`` against
+``writes/s`` before turning DB_SHARDS on.
+
+    python -m bench.shard_writes [--shards 0,2,4,8] [--procs 4] [--users 400] [--turns 20]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench.common import setup_env
+
+
+async def _init() -> None:
+    from app import db
+
+    await db.init_db()
+
+
+async def _child(first_user: int, users: int, turns: int) -> dict[str, float]:
+    from app import db
+
+    try:
+        async def buyer(user_id: int) -> None:
+            for turn in range(turns):
+                await db.upsert_sales_session(
+                    user_id=user_id, sku="SKU-000001", stage="discovery", context={"turn": turn}
+                )
+                await db.append_messages(
+                    user_id,
+                    [
+                        {"role": "user", "content": f"Есть размер L? ({turn})"},
+                        {"role": "assistant", "content": "Да, L есть в наличии в черном и хаки."},
+                    ],
+                )
+
+        # Warm the pools and writers before the clock starts.
+        for user_id in range(first_user, first_user + users):
+            await db.get_sales_session(user_id)
+        started = time.time()
+        tasks = [asyncio.create_task(buyer(user_id)) for user_id in range(first_user, first_user + users)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other buyers before close_db(), or they reopen writers
+            # whose threads keep the worker from exiting.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finished = time.time()
+        commits = db.writer_stats()["batches"] + sum(s["batches"] for s in db.shard_stats())
+    finally:
+        await db.close_db()
+
+    return {"started": started, "finished": finished, "commits": commits}
+
+
+def _run(shards: int, procs: int, users: int, turns: int) -> dict[str, float]:
+    setup_env(f"shard-writes-{shards}")
+    env = dict(os.environ, DB_SHARDS=str(shards), DB_WRITE_BEHIND_MS="0")
+    subprocess.run([sys.executable, "-m", "bench.shard_writes", "--init"], env=env, check=True)
+
+    per_proc = users // procs
+    children = [
+        subprocess.Popen(
+            [
+                sys.executable, "-m", "bench.shard_writes", "--child",
+                "--first-user", str(1 + i * per_proc), "--users", str(per_proc), "--turns", str(turns),
+            ],
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for i in range(procs)
+    ]
+    results = []
+    for child in children:
+        out, _ = child.communicate()
+        if child.returncode:
+            raise SystemExit(f"worker failed with exit status {child.returncode}")
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    # Wall time from the first worker starting to the last one finishing.
+    seconds = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    writes = per_proc * procs * turns * 2
+    return {"seconds": seconds, "writes_per_s": writes / seconds, "commits": sum(r["commits"] for r in results)}
+
+
+def main(shard_counts: list[int], procs: int, users: int, turns: int, repeat: int) -> None:
+    print(f"{procs} processes, {users} buyers x {turns} turns ({users * turns * 2} writes) per run, best of {repeat}")
+    print(f"{'shards':>6} | {'seconds':>7} | {'writes/s':>9} | {'commits':>7} | {'speedup':>7}")
+    baseline = None
+    for shards in shard_counts:
+        res = max((_run(shards, procs, users, turns) for _ in range(repeat)), key=lambda r: r["writes_per_s"])
+        baseline = baseline or res["writes_per_s"]
+        print(
+            f"{shards:>6} | {res['seconds']:>7.2f} | {res['writes_per_s']:>9.0f}"
+            f" | {res['commits']:>7} | {res['writes_per_s'] / baseline:>6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", default="0,2,4,8")
+    parser.add_argument("--procs", type=int, default=4)
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--first-user", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--init", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.init:
+        asyncio.run(_init())
+    elif args.child:
+        print(json.dumps(asyncio.run(_child(args.first_user, args.users, args.turns))))
+    else:
+        main([int(s) for s in args.shards.split(",")], args.procs, args.users, args.turns, args.repeat)
@@ -0,0 +1,66 @@
+"""
+Benchmark the TF-IDF "similar products" index on a synthetic catalog.
+
+Reports the startup build, ``similar()`` and ``rank_text()`` latency on a
+warm index, and the lazy rebuild paid by the first query after an edit.
+
+    python -m bench.similar_products [--products 50000] [--repeat 200]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+
+from bench.common import seed_catalog_sync, setup_env, timeit_async
+
+
+async def main(products: int, repeat: int) -> None:
+    path = setup_env("similar-products")
+
+    from app import db
+    from app.similar import similar_index
+
+    await db.init_db()
+    seed_catalog_sync(path, products)
+
+    started = time.perf_counter()
+    await similar_index.load()
+    built = time.perf_counter() - started
+    stats = similar_index.stats()
+    print(
+        f"catalog: {products} products; index load {built:.2f}s, "
+        f"{stats['grams']} grams, {stats['nonzeros']} nonzeros"
+    )
+
+    rnd = random.Random(7)
+    skus = [f"SKU-{rnd.randrange(products):06d}" for _ in range(repeat)]
+    queries = iter(skus * 2)
+
+    async def similar() -> None:
+        similar_index.similar(next(queries), limit=6)
+
+    async def rank_text() -> None:
+        similar_index.rank_text("теплая куртка хаки", limit=6)
+
+    print(f"{'case':>9} | {'p50':>9} | {'p95':>9}")
+    for name, fn in (("similar", similar), ("rank_text", rank_text)):
+        res = await timeit_async(fn, repeat)
+        print(f"{name:>9} | {res['p50']:>7.2f}ms | {res['p95']:>7.2f}ms")
+
+    await db.update_product_description(skus[0], "Новое описание: плотный хлопок, свободный крой")
+    started = time.perf_counter()
+    similar_index.similar(skus[0], limit=6)
+    print(f"first query after an edit (rebuild): {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.products, args.repeat))
@@ -0,0 +1,46 @@
+"""
+Compare product_cards with the product source tables.
+
+Prints every sku whose card differs from what product_card_source computes
+from products/product_variants/product_colors/product_photos (a stale,
+missing or orphaned card). Exit status is 1 when any are found.
+
+    python -m scripts.check_product_cards [--repair]
+
+``--repair`` rebuilds the listed cards in one write transaction.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+
+
+async def _run(repair: bool) -> list[str]:
+    from app import db
+
+    await db.init_db()
+    try:
+        return await db.check_product_cards(repair=repair)
+    finally:
+        await db.close_db()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repair", action="store_true", help="rebuild the mismatched cards")
+    args = parser.parse_args()
+
+    skus = asyncio.run(_run(args.repair))
+    for sku in skus:
+        print(sku)
+    if not skus:
+        print("ok: all product cards match")
+        return 0
+    print(f"\n{len(skus)} card(s) {'repaired' if args.repair else 'out of date'}")
+    return 0 if args.repair else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
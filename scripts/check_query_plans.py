@@ -0,0 +1,307 @@
+"""
+Fail if any query in the app's data modules full-scans an indexed table.
+
+Two sources of SQL are checked against a freshly migrated database:
+
+* every string literal in SOURCES that looks like a DML/SELECT statement
+  (parameters bound to NULL), and
+* the statements actually executed by a scripted run of the catalog
+  writes and searches, dialogs, orders and a retention pass (including
+  SQL assembled at runtime), captured with a trace callback on every
+  connection the app opens: pooled readers, the writer, the retention
+  job's private connections and, in a second DB_SHARDS=2 run, the shards.
+
+    python -m scripts.check_query_plans
+
+Exit status is 1 when a plan contains ``SCAN <table>`` for a table that
+has at least one index and the scan is not listed in ALLOWED_SCANS.
+"""
+
+from __future__ import annotations
+
+import ast
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+SOURCES = ["app/db.py", "app/catalog.py", "app/catalog_index.py", "app/similar.py", "app/stock.py"]
+
+# (table, substring of the statement) pairs that are intentional full scans.
+ALLOWED_SCANS: list[tuple[str, str]] = [
+    # StockMatrix.load reads every active variant once, at start-up.
+    ("product_variants", "from product_variants where is_active = 1"),
+]
+
+_SQL_START = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+_SCAN = re.compile(r"^SCAN (\w+)(.*)$")
+
+
+def _literal_statements() -> list[tuple[str, str]]:
+    out = []
+    for rel in SOURCES:
+        tree = ast.parse((ROOT / rel).read_text(encoding="utf-8"))
+        # Fragments of f-strings are assembled at runtime; the trace covers them.
+        fragments = {
+            id(part)
+            for node in ast.walk(tree)
+            if isinstance(node, ast.JoinedStr)
+            for part in node.values
+        }
+        for node in ast.walk(tree):
+            if id(node) in fragments:
+                continue
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                sql = node.value.strip()
+                if _SQL_START.match(sql) and ";" not in sql.rstrip(";"):
+                    out.append((f"{rel}:{node.lineno}", sql))
+    return out
+
+
+async def _drive_catalog() -> None:
+    from app import db
+    from app.catalog import _search_uncached, find_similar, search_products_page
+    from app.catalog_index import index
+    from app.config import settings
+    from app.similar import similar_index
+    from app.stock import stock
+
+    for i, title in enumerate(["Худи черное", "Куртка зимняя", "Брюки карго"]):
+        sku = f"CHK-{i}"
+        await db.upsert_product(
+            sku=sku, title=title, description="", gender="male", category="hoodie",
+            season="winter", insulation="", material="хлопок", price=3000 + i * 1000,
+        )
+        await db.set_variant_active(sku, "M", True)
+        await db.set_variant_stock(sku, "M", 5)
+        await db.add_color(sku, "черный")
+
+    # Warm indexes: every write below also runs their per-sku refreshes.
+    await index.load()
+    await similar_index.load()
+    await stock.load()
+
+    await db.save_product_bundle(
+        {
+            "sku": "CHK-B", "title": "Свитер", "description": "", "gender": "female", "category": "sweater",
+            "season": "winter", "insulation": "", "material": "шерсть", "price": 4500,
+        },
+        {"S": True, "M": False},
+        ["серый"],
+        ["photo-1"],
+    )
+    await db.adjust_variant_stock("CHK-0", "M", -1)
+    await db.set_color_active("CHK-0", "черный", False)
+    await db.set_color_active("CHK-0", "черный", True)
+    await db.add_photo_file_id("CHK-0", "photo-2")
+    await db.update_product_price("CHK-1", 4200)
+    await db.update_product_description("CHK-1", "Тёплая")
+    await db.toggle_product_sale("CHK-2")
+    await db.set_product_active("CHK-2", True)
+    await db.save_product_publication("CHK-0", "@channel", 1)
+    await db.get_product_publications("CHK-0")
+    await db.clear_product_publications("CHK-0")
+    await db.delete_product("CHK-B")
+
+    db.product_cache.clear()
+    await db.get_product("CHK-0")
+
+    # A stale card for the repair pass to rebuild.
+    async with db.writing() as conn:
+        await conn.execute("UPDATE product_cards SET colors_json='[]' WHERE sku='CHK-0'")
+    await db.check_product_cards()
+    await db.check_product_cards(repair=True)
+
+    searches = [
+        {},
+        {"query": "худи"},
+        {"query": "худи", "size": "M", "color": "черн"},
+        {"gender": "male", "category": "hoodie", "season": "winter"},
+        {"size": "XL", "min_price": 1000, "max_price": 5000},
+        {"color": "черн", "limit": 20},
+    ]
+    for tracking in (False, True):
+        settings.STOCK_TRACKING = tracking
+        for kwargs in searches:
+            await _search_uncached(**kwargs)
+        await find_similar(sku="CHK-0")
+        await find_similar(query="куртка", size="M")
+
+    # First and continuation pages, with the indexes cold so filter-only
+    # pages and similarity candidates reach SQL as well.
+    index.ready = False
+    similar_index.ready = False
+    for kwargs in searches:
+        kwargs = {**kwargs, "limit": 1}
+        page = await search_products_page(**kwargs)
+        if page["next_cursor"]:
+            await search_products_page(**kwargs, cursor=page["next_cursor"])
+    await find_similar(sku="CHK-0", color="черн", size="M")
+
+
+async def _drive_dialogs(user_id: int) -> None:
+    from app import db
+
+    await db.upsert_sales_session(user_id=user_id, sku="CHK-0", stage="discovery", context={"size": "M"})
+    await db.patch_sales_session(user_id, stage="closing", context_patch={"color": "черн"})
+    await db.patch_sales_session(user_id + 1, sku="CHK-1", stage="profiling")
+    await db.append_messages(user_id, [{"role": "user", "content": "Есть M?"}])
+    await db.get_recent_messages(user_id, 10)
+    await db.load_dialog_state(user_id)
+    await db.get_sales_session(user_id)
+
+    # The same writes through the write-behind buffer's flush.
+    db.write_behind = db.WriteBehind(3600)
+    try:
+        await db.patch_sales_session(
+            user_id, stage="closing", messages=[{"role": "assistant", "content": "Оформляю"}]
+        )
+        await db.write_behind.flush()
+    finally:
+        db.write_behind = None
+
+    await db.clear_conversation(user_id + 1)
+    await db.clear_sales_session(user_id + 1)
+
+
+async def _drive_orders() -> None:
+    from app import db
+
+    await db.create_order(1, "new", {"sku": "CHK-0"})
+    orders = []
+    for _ in range(3):
+        order = await db.create_sales_order(
+            user_id=1, sku="CHK-0", title="Худи черное", price=3000, size="M", reserve_stock=True
+        )
+        orders.append(order["order_no"])
+    await db.get_sales_order_by_no(orders[0])
+    await db.update_sales_order_stage(orders[0], "paid")
+    await db.set_sales_order_tracking(orders[0], "cdek", "CDEK-1")
+    await db.update_sales_order_stage(orders[0], "delivered")
+    await db.cancel_sales_order(orders[1])
+
+    # Age them so the expiry and archive passes have work to do.
+    conn = sqlite3.connect(os.environ["DB_PATH"])
+    with conn:
+        conn.execute("UPDATE sales_orders SET created_at=0, updated_at=0")
+    conn.close()
+
+
+async def _traced_statements() -> list[tuple[str, str]]:
+    from app import db
+    from app.config import settings
+
+    # Every connection the app opens (pool, writer, shards and the private
+    # ones) records the SQL it runs, with parameters expanded into literals.
+    seen: list[str] = []
+    open_connection = db._open_connection
+
+    async def traced(path, **kwargs):
+        conn = await open_connection(path, **kwargs)
+        await conn.set_trace_callback(seen.append)
+        return conn
+
+    db._open_connection = traced
+    shards = settings.DB_SHARDS
+    path = settings.DB_PATH
+    try:
+        await db.init_db()
+        await _drive_catalog()
+        await _drive_dialogs(100)
+        await _drive_orders()
+
+        settings.ORDER_RESERVATION_HOURS = 1
+        settings.ARCHIVE_ORDER_DAYS = 1
+        for rule in db.RETENTION_RULES:
+            setattr(settings, rule[1], 1)
+        await db.Retention(interval=0, batch=1).run()
+        await db.close_db()
+
+        # Per-user tables again, through shard connections.
+        settings.DB_SHARDS = 2
+        settings.DB_PATH = os.path.join(os.path.dirname(path), "sharded.db")
+        await db.init_db()
+        await _drive_dialogs(200)
+        await db.Retention(interval=0, batch=1).run()
+        await db.close_db()
+    finally:
+        db._open_connection = open_connection
+        settings.DB_SHARDS = shards
+        settings.DB_PATH = path
+
+    return [("trace", sql) for sql in seen if _SQL_START.match(sql)]
+
+
+def _indexed_tables(conn: sqlite3.Connection) -> set[str]:
+    rows = conn.execute("SELECT DISTINCT tbl_name FROM sqlite_master WHERE type='index'").fetchall()
+    return {r[0] for r in rows}
+
+
+def _allowed(table: str, sql: str) -> bool:
+    flat = " ".join(sql.lower().split())
+    return any(t == table and frag in flat for t, frag in ALLOWED_SCANS)
+
+
+def check(conn: sqlite3.Connection, statements: list[tuple[str, str]]) -> list[str]:
+    indexed = _indexed_tables(conn)
+    problems = []
+    done = set()
+    for where, sql in statements:
+        if sql in done:
+            continue
+        done.add(sql)
+
+        params = [None] * sql.count("?") if where != "trace" else []
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except sqlite3.Error as e:
+            problems.append(f"{where}: cannot explain ({e}):\n    {' '.join(sql.split())}")
+            continue
+
+        for row in plan:
+            m = _SCAN.match(row[3])
+            if not m:
+                continue
+            table, rest = m.group(1), m.group(2)
+            if "USING" in rest or "VIRTUAL TABLE" in rest:
+                continue
+            if table in indexed and not _allowed(table, sql):
+                problems.append(f"{where}: full scan of {table}:\n    {' '.join(sql.split())}")
+    return problems
+
+
+def main() -> int:
+    tmpdir = tempfile.mkdtemp(prefix="moslav-qplan-")
+    path = os.path.join(tmpdir, "plan.db")
+    os.environ["DB_PATH"] = path
+    os.environ.setdefault("BOT_TOKEN", "0:check")
+    os.environ.setdefault("WEBHOOK_SECRET", "check")
+    sys.path.insert(0, str(ROOT))
+
+    statements = asyncio.run(_traced_statements())
+    statements = _literal_statements() + statements
+
+    from app.db import unicode_lower
+
+    conn = sqlite3.connect(path)
+    conn.create_function("unicode_lower", 1, unicode_lower, deterministic=True)
+    try:
+        problems = check(conn, statements)
+    finally:
+        conn.close()
+
+    if problems:
+        print("\n".join(problems))
+        print(f"\n{len(problems)} query plan problem(s)")
+        return 1
+
+    print(f"ok: {len({s for _, s in statements})} statements checked")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Move conversational state between shard files after changing DB_SHARDS.
+
+Run it with the bot stopped, then start the bot with the new DB_SHARDS:
+
+    python -m scripts.reshard --to 4
+    python -m scripts.reshard --to 0     # back into DB_PATH
+
+Every file that may hold SHARD_TABLES rows (DB_PATH plus any existing
+``<name>.shard<i>.db``) is scanned; users whose shard changes under the
+new count have their rows copied to the destination and then deleted
+from the source, in batches. Shard files past the new count are removed
+once they are empty.
+
+The destination may already hold rows for a moved user, when DB_SHARDS was
+switched before this ran: its history then restarted at seq 1. Messages of
+both files are interleaved by timestamp and renumbered, and for sessions
+the row with the later updated_at wins. Rows an interrupted run already
+copied are recognized and skipped, so a run can simply be restarted.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import sys
+from collections import Counter
+from typing import Optional
+
+from app.config import settings
+from app.db import _RETENTION_INDEXES, SHARD_SCHEMA, SHARD_TABLES, existing_shards, shard_of, shard_path
+
+
+def _path(index: Optional[int], base: str) -> str:
+    return base if index is None else shard_path(index, base)
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SHARD_SCHEMA)
+    for statement in _RETENTION_INDEXES:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+_MESSAGE_COLUMNS = "user_id, seq, role, content, ts"
+
+
+def _merge_messages(target: sqlite3.Connection, rows: list[tuple]) -> None:
+    by_user: dict[int, list[tuple]] = {}
+    for row in rows:
+        by_user.setdefault(row[0], []).append(row)
+
+    insert = f"INSERT INTO conversation_messages({_MESSAGE_COLUMNS}) VALUES(?,?,?,?,?)"
+    for user_id, moved in by_user.items():
+        existing = target.execute(
+            f"SELECT {_MESSAGE_COLUMNS} FROM conversation_messages WHERE user_id=? ORDER BY seq", (user_id,)
+        ).fetchall()
+        if not existing:
+            target.executemany(insert, moved)
+            continue
+
+        # Copied by an interrupted run (maybe renumbered since): same role, content and ts.
+        present = Counter((r[2], r[3], r[4]) for r in existing)
+        fresh = []
+        for r in moved:
+            key = (r[2], r[3], r[4])
+            if present[key]:
+                present[key] -= 1
+            else:
+                fresh.append(r)
+        if not fresh:
+            continue
+
+        # Both files have history: order by time (moved rows first on a tie), renumber from 1.
+        merged = sorted([(r[4], 0, r[1], r) for r in fresh] + [(r[4], 1, r[1], r) for r in existing])
+        target.execute("DELETE FROM conversation_messages WHERE user_id=?", (user_id,))
+        target.executemany(insert, [(user_id, seq, r[2], r[3], r[4]) for seq, (*_, r) in enumerate(merged, 1)])
+
+
+def _move(source: sqlite3.Connection, target: sqlite3.Connection, table: str, user_ids: list[int]) -> int:
+    marks = ",".join("?" * len(user_ids))
+    columns = _MESSAGE_COLUMNS if table == "conversation_messages" else "*"
+    cur = source.execute(f"SELECT {columns} FROM {table} WHERE user_id IN ({marks})", user_ids)
+    names = [c[0] for c in cur.description]
+    rows = cur.fetchall()
+    if rows:
+        if table == "conversation_messages":
+            _merge_messages(target, rows)
+        else:
+            # One row per user: keep whichever copy was updated last.
+            updates = ", ".join(f"{n}=excluded.{n}" for n in names if n != "user_id")
+            target.executemany(
+                f"""
+                INSERT INTO {table}({', '.join(names)}) VALUES({', '.join('?' * len(names))})
+                ON CONFLICT(user_id) DO UPDATE SET {updates}
+                WHERE excluded.updated_at > {table}.updated_at
+                """,
+                rows,
+            )
+        target.commit()
+    # Only after the copy is committed.
+    source.execute(f"DELETE FROM {table} WHERE user_id IN ({marks})", user_ids)
+    source.commit()
+    return len(rows)
+
+
+def reshard(to: int, base: str, batch: int) -> dict[str, int]:
+    to = max(0, to)
+    sources: list[Optional[int]] = [None, *existing_shards(base)]
+    destinations: list[Optional[int]] = [None] if to == 0 else list(range(to))
+    conns: dict[Optional[int], sqlite3.Connection] = {}
+
+    def conn(index: Optional[int]) -> sqlite3.Connection:
+        if index not in conns:
+            conns[index] = _open(_path(index, base))
+        return conns[index]
+
+    moved = {table: 0 for table in SHARD_TABLES}
+    try:
+        for index in destinations:
+            conn(index)
+
+        for index in sources:
+            source = conn(index)
+            for table in SHARD_TABLES:
+                user_ids = [r[0] for r in source.execute(f"SELECT DISTINCT user_id FROM {table}")]
+                by_dest: dict[Optional[int], list[int]] = {}
+                for user_id in user_ids:
+                    dest = shard_of(user_id, to)
+                    if dest != index:
+                        by_dest.setdefault(dest, []).append(user_id)
+                for dest, ids in by_dest.items():
+                    for i in range(0, len(ids), batch):
+                        moved[table] += _move(source, conn(dest), table, ids[i : i + batch])
+
+        # Stamp the layout init_db checks the shard files against.
+        for index in destinations:
+            if index is not None:
+                conn(index).execute(f"PRAGMA user_version={to}")
+                conn(index).commit()
+
+        removed = 0
+        for index in sources:
+            if index is None or index < to:
+                continue
+            source = conns.pop(index)
+            left = sum(source.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in SHARD_TABLES)
+            source.close()
+            if left:
+                print(f"shard {index}: {left} rows left, not removed", file=sys.stderr)
+                continue
+            path = _path(index, base)
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(path + suffix)
+                except FileNotFoundError:
+                    pass
+            removed += 1
+    finally:
+        for c in conns.values():
+            c.close()
+
+    return {**moved, "shards_removed": removed}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", type=int, required=True, help="new DB_SHARDS value")
+    parser.add_argument("--db", default=settings.DB_PATH, help="main database file (DB_PATH)")
+    parser.add_argument("--batch", type=int, default=500, help="users per copy/delete transaction")
+    args = parser.parse_args()
+
+    report = reshard(args.to, args.db, max(1, args.batch))
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Shared fixtures.
+
+Settings are read when ``app`` is first imported, so the environment is set
+here, before any test module imports it. Every test gets its own database
+file through the ``run`` fixture.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="moslav-tests-"), "unused.db")
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("WEBHOOK_SECRET", "test")
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch) -> str:
+    from app import catalog, db
+    from app.catalog_index import index
+    from app.config import settings
+    from app.similar import similar_index
+    from app.stock import stock
+
+    path = str(tmp_path / "test.db")
+    monkeypatch.setattr(settings, "DB_PATH", path)
+    catalog.search_cache.clear()
+    db.product_cache.clear()
+    for cold in (index, similar_index, stock):
+        cold.ready = False
+    return path
+
+
+@pytest.fixture
+def run(db_path) -> Callable[[Callable[[], Awaitable[Any]]], Any]:
+    """Run ``scenario()`` against a freshly initialized database."""
+    from app import db
+
+    def _run(scenario: Callable[[], Awaitable[Any]]) -> Any:
+        async def main() -> Any:
+            await db.init_db()
+            try:
+                return await scenario()
+            finally:
+                await db.close_db()
+
+        return asyncio.run(main())
+
+    return _run
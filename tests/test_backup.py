@@ -0,0 +1,64 @@
+import os
+import sqlite3
+
+
+def _rows(path: str, sql: str) -> list[tuple]:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_backup_is_a_consistent_self_contained_copy(run, monkeypatch, tmp_path):
+    from app import db
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "BACKUP_STEP_PAGES", 1)
+    monkeypatch.setattr(settings, "BACKUP_STEP_SLEEP_MS", 0)
+    directory = str(tmp_path / "backups")
+
+    async def scenario():
+        await db.upsert_product(
+            sku="B-1", title="Худи", description="", gender="male", category="hoodie",
+            season="", insulation="", material="", price=3000,
+        )
+        await db.append_messages(3, [{"role": "user", "content": "Есть M?"}])
+        return await db.backup_database(directory)
+
+    report = run(scenario)
+    assert report["shards"] == [] and report["steps"] > 1
+    assert os.path.dirname(report["path"]) == directory
+    assert sorted(os.listdir(directory)) == [os.path.basename(report["path"])]
+    assert report["bytes"] == os.path.getsize(report["path"])
+    assert _rows(report["path"], "PRAGMA journal_mode") == [("delete",)]
+    assert _rows(report["path"], "SELECT sku, title FROM products") == [("B-1", "Худи")]
+    assert _rows(report["path"], "SELECT COUNT(*) FROM conversation_messages WHERE user_id=3") == [(1,)]
+
+
+def test_backup_rotates_old_snapshots_per_file(run, monkeypatch, tmp_path):
+    from app import db
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "DB_SHARDS", 2)
+    directory = tmp_path / "backups"
+    directory.mkdir()
+    for stamp in ("20240101-000000", "20240102-000000", "20240103-000000"):
+        for name in ("test", "test.shard0", "test.shard1"):
+            (directory / f"{name}-{stamp}.db").write_bytes(b"")
+    (directory / "other-20240101-000000.db").write_bytes(b"")
+
+    async def scenario():
+        await db.upsert_sales_session(user_id=1, sku="B-1", stage="discovery")
+        return await db.backup_database(str(directory), keep=2)
+
+    report = run(scenario)
+    stamp = os.path.basename(report["path"])[len("test-"):]
+    assert [os.path.basename(p) for p in report["shards"]] == [f"test.shard0-{stamp}", f"test.shard1-{stamp}"]
+    assert report["kept"] == 2 and len(report["removed"]) == 6
+    assert sorted(os.listdir(directory)) == sorted(
+        [f"{name}-{s}" for name in ("test", "test.shard0", "test.shard1") for s in ("20240103-000000.db", stamp)]
+        + ["other-20240101-000000.db"]
+    )
+    shard = report["shards"][db.shard_of(1, 2)]
+    assert _rows(shard, "SELECT sku FROM sales_sessions WHERE user_id=1") == [("B-1",)]
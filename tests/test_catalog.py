@@ -0,0 +1,97 @@
+import pytest
+
+
+async def _seed():
+    from app import db
+
+    await db.upsert_product(
+        sku="H-1", title="Худи оверсайз", description="Теплое", gender="male", category="hoodie",
+        season="autumn", insulation="", material="хлопок", price=3500,
+    )
+    await db.set_variant_active("H-1", "M", True)
+    await db.add_color("H-1", "Черный")
+
+
+@pytest.mark.parametrize("fts", [True, False])
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"color": "Черный"},
+        {"color": "черный"},
+        {"query": "Худи"},
+        {"query": "худи", "color": "ЧЕРН"},
+    ],
+)
+def test_sql_search_ignores_cyrillic_case(run, monkeypatch, fts, kwargs):
+    from app import db
+    from app.catalog import normalize_args, _search_uncached, search_products
+
+    async def scenario():
+        await _seed()
+        monkeypatch.setattr(db, "_fts_enabled", fts and db.fts_enabled())
+
+        # The index stays cold, so both calls run SQL.
+        found = await _search_uncached(**normalize_args(**kwargs))
+        assert [p["sku"] for p in found] == ["H-1"]
+        assert [p["sku"] for p in await search_products(**kwargs)] == ["H-1"]
+
+    run(scenario)
+
+
+@pytest.mark.parametrize("warm_index", [True, False])
+def test_find_similar_with_canonical_color(run, warm_index):
+    from app import db
+    from app.catalog import find_similar
+    from app.catalog_index import index
+    from app.similar import similar_index
+    from app.vocab import normalize_filters
+
+    async def scenario():
+        for sku, title, color in [
+            ("H-1", "Худи оверсайз хлопок", "Черный"),
+            ("H-2", "Худи оверсайз флис", "Чёрный"),
+            ("H-3", "Худи оверсайз с капюшоном", "Белый"),
+            ("H-4", "Худи на молнии", "Темно-синий"),
+        ]:
+            await db.upsert_product(
+                sku=sku, title=title, description="", gender="male", category="hoodie",
+                season="autumn", insulation="", material="хлопок", price=3500,
+            )
+            await db.set_variant_active(sku, "M", True)
+            await db.add_color(sku, color)
+        await similar_index.load()
+        if warm_index:
+            await index.load()
+
+        args = normalize_filters({"sku": "H-1", "color": "черный", "size": "m"})
+        assert args["color"] == "черн"
+        found = await find_similar(sku=args["sku"], color=args["color"], size=args["size"])
+        assert [p["sku"] for p in found] == ["H-2"]
+
+        args = normalize_filters({"sku": "H-1", "color": "синий"})
+        found = await find_similar(sku=args["sku"], color=args["color"])
+        assert [p["sku"] for p in found] == ["H-4"]
+
+    run(scenario)
+
+
+def test_search_during_index_refresh_is_not_cached(run, monkeypatch):
+    from app import db
+    from app.catalog import search_products
+    from app.catalog_index import index
+
+    async def scenario():
+        await _seed()
+        await index.load()
+        assert [p["price"] for p in await search_products(category="hoodie")] == [3500.0]
+
+        async def racer(sku: str) -> None:
+            # Runs before the index listener: sees the old entry.
+            assert [p["price"] for p in await search_products(category="hoodie")] == [3500.0]
+
+        monkeypatch.setattr(db, "_product_listeners", [racer, *db._product_listeners])
+        await db.update_product_price("H-1", 5000)
+        assert index.get("H-1")["price"] == 5000.0
+        assert [p["price"] for p in await search_products(category="hoodie")] == [5000.0]
+
+    run(scenario)
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+
+async def _seed() -> None:
+    from app import db
+
+    await db.upsert_product(
+        sku="J-1", title="Куртка", description="", gender="male", category="jacket",
+        season="winter", insulation="", material="", price=9000,
+    )
+    await db.set_variant_active("J-1", "L", True)
+    await db.set_variant_stock("J-1", "L", 2)
+
+
+async def _stage(order_no: str) -> str:
+    from app import db
+
+    return (await db.get_sales_order_by_no(order_no))["stage"]
+
+
+def test_order_moves_through_payment_and_shipping(run):
+    from app import db
+
+    async def scenario():
+        await _seed()
+        order = await db.create_sales_order(user_id=7, sku="J-1", size="L", reserve_stock=True)
+        assert await _stage(order["order_no"]) == "waiting_payment"
+
+        assert await db.update_sales_order_stage(order["order_no"], "packing")
+        assert await _stage(order["order_no"]) == "packing"
+
+        assert await db.set_sales_order_tracking(order["order_no"], "CDEK", "123")
+        shipped = await db.get_sales_order_by_no(order["order_no"])
+        assert (shipped["stage"], shipped["carrier"], shipped["tracking_number"]) == ("shipped", "CDEK", "123")
+
+        assert not await db.update_sales_order_stage("MS-00000000-NONE", "packing")
+        assert not await db.set_sales_order_tracking("MS-00000000-NONE", "CDEK", "1")
+
+    run(scenario)
+
+
+@pytest.mark.parametrize("step", ["payok", "track"])
+def test_expired_order_is_not_revived(run, step):
+    from app import db
+
+    async def scenario():
+        await _seed()
+        order = await db.create_sales_order(user_id=7, sku="J-1", size="L", reserve_stock=True)
+        # The admin looked the order up before expiry cancelled it.
+        seen = await db.get_sales_order_by_no(order["order_no"])
+        assert seen["stage"] == "waiting_payment"
+        async with db.writing() as conn:
+            await conn.execute(
+                "UPDATE sales_orders SET created_at = created_at - 7200 WHERE order_no=?", (order["order_no"],)
+            )
+        assert await db.expire_unpaid_orders(1) == 1
+
+        if step == "payok":
+            assert not await db.update_sales_order_stage(order["order_no"], "packing")
+        else:
+            assert not await db.set_sales_order_tracking(order["order_no"], "CDEK", "123")
+        assert await _stage(order["order_no"]) == "cancelled"
+
+    run(scenario)
+
+
+def test_memory_storage_stage_transitions():
+    from app.storage import MemoryStorage
+
+    async def scenario():
+        m = MemoryStorage()
+        order = await m.create_sales_order(user_id=7, sku="J-1", size="L")
+        assert await m.update_sales_order_stage(order["order_no"], "packing")
+        assert await m.update_sales_order_stage(order["order_no"], "cancelled") is True
+        assert not await m.update_sales_order_stage(order["order_no"], "packing")
+        assert not await m.set_sales_order_tracking(order["order_no"], "CDEK", "123")
+        assert (await m.get_sales_order_by_no(order["order_no"]))["stage"] == "cancelled"
+
+    asyncio.run(scenario())
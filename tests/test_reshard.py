@@ -0,0 +1,92 @@
+import sqlite3
+
+from scripts.reshard import _move, _open, reshard
+
+
+def _messages(conn: sqlite3.Connection, user_id: int) -> list[tuple]:
+    return conn.execute(
+        "SELECT seq, content, ts FROM conversation_messages WHERE user_id=? ORDER BY seq", (user_id,)
+    ).fetchall()
+
+
+def _add_messages(conn: sqlite3.Connection, user_id: int, rows: list[tuple[int, str, int]]) -> None:
+    conn.executemany(
+        "INSERT INTO conversation_messages(user_id, seq, role, content, ts) VALUES(?,?,'user',?,?)",
+        [(user_id, seq, content, ts) for seq, content, ts in rows],
+    )
+    conn.commit()
+
+
+def _add_session(conn: sqlite3.Connection, user_id: int, stage: str, updated_at: int) -> None:
+    conn.execute(
+        "INSERT INTO sales_sessions(user_id, sku, stage, created_at, updated_at) VALUES(?,'J-1',?,?,?)",
+        (user_id, stage, updated_at, updated_at),
+    )
+    conn.commit()
+
+
+def test_move_into_an_empty_shard(tmp_path):
+    source, target = _open(str(tmp_path / "main.db")), _open(str(tmp_path / "main.shard0.db"))
+    _add_messages(source, 1, [(1, "a", 10), (2, "b", 11)])
+
+    assert _move(source, target, "conversation_messages", [1]) == 2
+    assert _messages(target, 1) == [(1, "a", 10), (2, "b", 11)]
+    assert _messages(source, 1) == []
+
+
+def test_move_interleaves_history_the_shard_already_has(tmp_path):
+    source, target = _open(str(tmp_path / "main.db")), _open(str(tmp_path / "main.shard0.db"))
+    # DB_SHARDS was switched on first: the shard restarted at seq 1.
+    _add_messages(source, 1, [(1, "old-1", 10), (2, "old-2", 20)])
+    _add_messages(target, 1, [(1, "new-1", 30), (2, "new-2", 40)])
+
+    _move(source, target, "conversation_messages", [1])
+    assert _messages(target, 1) == [(1, "old-1", 10), (2, "old-2", 20), (3, "new-1", 30), (4, "new-2", 40)]
+
+
+def test_rerun_after_an_interrupted_move_copies_nothing_twice(tmp_path):
+    source, target = _open(str(tmp_path / "main.db")), _open(str(tmp_path / "main.shard0.db"))
+    _add_messages(source, 1, [(1, "old", 10)])
+    _add_messages(target, 1, [(1, "new", 30)])
+    _move(source, target, "conversation_messages", [1])
+    # Interrupted before the source delete: the rows are back in the source.
+    _add_messages(source, 1, [(1, "old", 10)])
+
+    _move(source, target, "conversation_messages", [1])
+    assert _messages(target, 1) == [(1, "old", 10), (2, "new", 30)]
+
+
+def test_move_keeps_the_newer_session(tmp_path):
+    source, target = _open(str(tmp_path / "main.db")), _open(str(tmp_path / "main.shard0.db"))
+    _add_session(source, 1, "discovery", 100)
+    _add_session(target, 1, "closing", 200)
+    _add_session(source, 2, "closing", 300)
+    _add_session(target, 2, "discovery", 200)
+
+    assert _move(source, target, "sales_sessions", [1, 2]) == 2
+    stages = target.execute("SELECT user_id, stage FROM sales_sessions ORDER BY user_id").fetchall()
+    assert stages == [(1, "closing"), (2, "closing")]
+    assert source.execute("SELECT COUNT(*) FROM sales_sessions").fetchone()[0] == 0
+
+
+def test_reshard_there_and_back(tmp_path):
+    from app.db import shard_of, shard_path
+
+    base = str(tmp_path / "main.db")
+    main = _open(base)
+    for user_id in range(1, 21):
+        _add_messages(main, user_id, [(1, f"hi {user_id}", 10)])
+        _add_session(main, user_id, "discovery", 100)
+    main.close()
+
+    report = reshard(2, base, batch=3)
+    assert report["conversation_messages"] == 20 and report["sales_sessions"] == 20
+    for user_id in range(1, 21):
+        shard = sqlite3.connect(shard_path(shard_of(user_id, 2), base))
+        assert _messages(shard, user_id) == [(1, f"hi {user_id}", 10)]
+        shard.close()
+
+    report = reshard(0, base, batch=500)
+    assert report["shards_removed"] == 2
+    main = sqlite3.connect(base)
+    assert main.execute("SELECT COUNT(*) FROM conversation_messages").fetchone()[0] == 20
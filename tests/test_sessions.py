@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+
+def test_patch_changes_only_the_given_fields(run):
+    from app import db
+
+    async def scenario():
+        await db.upsert_sales_session(
+            user_id=5, sku="J-1", stage="selling", psychotype="analyst", context={"size": "M", "color": "черн"}
+        )
+        await db.patch_sales_session(5, stage="collect_size", context_patch={"size": "L", "color": None})
+        session = await db.get_sales_session(5)
+        assert (session["sku"], session["stage"], session["psychotype"]) == ("J-1", "collect_size", "analyst")
+        assert session["context"] == {"size": "L"}
+
+    run(scenario)
+
+
+def test_first_patch_creates_the_session(run):
+    from app import db
+
+    async def scenario():
+        await db.patch_sales_session(
+            9, stage="profiling", context_patch={"gender": "female", "fit": None},
+            messages=[{"role": "user", "content": "Здравствуйте"}],
+        )
+        session = await db.get_sales_session(9)
+        assert (session["sku"], session["stage"], session["context"]) == ("", "profiling", {"gender": "female"})
+        assert [m["content"] for m in await db.get_recent_messages(9, 5)] == ["Здравствуйте"]
+
+    run(scenario)
+
+
+@pytest.mark.parametrize("key", ['say "hi"', ""])
+def test_context_keys_must_be_path_labels(run, key):
+    from app import db
+
+    async def scenario():
+        await db.upsert_sales_session(user_id=5, stage="selling")
+        with pytest.raises(ValueError):
+            await db.patch_sales_session(5, context_patch={key: 1})
+        assert (await db.get_sales_session(5))["context"] == {}
+
+    run(scenario)
+
+
+def test_memory_storage_patch_creates_and_validates():
+    from app.storage import MemoryStorage
+
+    async def scenario():
+        m = MemoryStorage()
+        await m.patch_sales_session(9, stage="profiling", context_patch={"gender": "female"})
+        session = await m.get_sales_session(9)
+        assert (session["stage"], session["context"]) == ("profiling", {"gender": "female"})
+        with pytest.raises(ValueError):
+            await m.patch_sales_session(9, context_patch={'a"b': 1})
+
+    asyncio.run(scenario())
+
+
+def test_dialog_state_changes_round_trip(run):
+    from app import db
+
+    async def scenario():
+        await db.upsert_sales_session(user_id=5, sku="J-1", stage="selling", context={"size": "M"})
+        state = await db.load_dialog_state(5)
+        assert state.changes() == {}
+
+        state.sku = "J-2"
+        state.stage = "collect_size"
+        state.context["size"] = "L"
+        assert state.changes() == {"sku": "J-2", "stage": "collect_size", "context_patch": {"size": "L"}}
+        await db.patch_sales_session(5, **state.changes())
+
+        reloaded = await db.load_dialog_state(5)
+        assert (reloaded.sku, reloaded.stage, reloaded.context) == ("J-2", "collect_size", {"size": "L"})
+
+    run(scenario)
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+
+import pytest
+
+
+def test_settings_changed_after_import_take_effect(run, monkeypatch, db_path):
+    from app import db
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "DB_SHARDS", 2)
+    monkeypatch.setattr(settings, "DB_MESSAGE_CODEC", "zlib")
+    assert db.shard_path(1) == db_path[: -len(".db")] + ".shard1.db"
+    assert db.shard_of(7) == db.shard_of(7, 2) is not None
+    assert isinstance(db._encode_content("куртка " * 100), bytes)
+
+    async def scenario():
+        await db.append_messages(7, [{"role": "user", "content": "куртка " * 100}])
+        assert [m["content"] for m in await db.get_recent_messages(7, 5)] == ["куртка " * 100]
+
+    run(scenario)
+    shard = sqlite3.connect(db.shard_path(db.shard_of(7, 2), db_path))
+    assert shard.execute("SELECT typeof(content) FROM conversation_messages WHERE user_id=7").fetchall() == [("blob",)]
+    assert os.path.exists(db_path)
+
+
+async def _noop():
+    pass
+
+
+def _say(user_id: int, text: str):
+    from app import db
+
+    async def scenario():
+        await db.append_messages(user_id, [{"role": "user", "content": text}])
+
+    return scenario
+
+
+async def _history(user_ids) -> dict[int, list[str]]:
+    from app import db
+
+    return {u: [m["content"] for m in await db.get_recent_messages(u, 5)] for u in user_ids}
+
+
+def test_sharding_waits_for_reshard(run, monkeypatch, db_path):
+    from app.config import settings
+    from scripts.reshard import reshard
+
+    users = range(1, 9)
+    for user_id in users:
+        run(_say(user_id, f"привет {user_id}"))
+
+    monkeypatch.setattr(settings, "DB_SHARDS", 2)
+    with pytest.raises(RuntimeError, match="reshard --to 2"):
+        run(_noop)
+
+    reshard(2, db_path, batch=500)
+
+    async def sharded():
+        assert await _history(users) == {u: [f"привет {u}"] for u in users}
+
+    run(sharded)
+
+
+@pytest.mark.parametrize("switch_to", [4, 0])
+def test_shards_of_another_count_are_refused(run, monkeypatch, db_path, switch_to):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "DB_SHARDS", 2)
+    for user_id in range(1, 9):
+        run(_say(user_id, "привет"))
+
+    monkeypatch.setattr(settings, "DB_SHARDS", switch_to)
+    with pytest.raises(RuntimeError, match=f"reshard --to {switch_to}"):
+        run(_noop)
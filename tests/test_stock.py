@@ -0,0 +1,193 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+
+async def _seed(stock: int) -> None:
+    from app import db
+
+    await db.upsert_product(
+        sku="J-1", title="Куртка", description="", gender="male", category="jacket",
+        season="winter", insulation="", material="", price=9000,
+    )
+    await db.set_variant_active("J-1", "L", True)
+    await db.set_variant_stock("J-1", "L", stock)
+
+
+async def _order(**kwargs):
+    from app import db
+
+    return await db.create_sales_order(user_id=7, sku="J-1", size="l", reserve_stock=True, **kwargs)
+
+
+async def _stock() -> int:
+    from app import db
+
+    async with db.connection() as conn:
+        cur = await conn.execute("SELECT stock FROM product_variants WHERE sku='J-1' AND size='L'")
+        return (await cur.fetchone())[0]
+
+
+def test_reservation_is_undone_when_the_order_insert_fails(run, monkeypatch):
+    from app import db
+
+    async def scenario():
+        await _seed(2)
+        first = await _order()
+        assert first["stock_reserved"] and await _stock() == 1
+
+        # Same order_no again: the INSERT fails, so must the decrement.
+        monkeypatch.setattr(db, "_make_order_no", lambda: first["order_no"])
+        with pytest.raises(sqlite3.IntegrityError):
+            await _order()
+        assert await _stock() == 1
+
+    run(scenario)
+
+
+def test_sold_out_variant_writes_no_order(run):
+    from app import db
+
+    async def scenario():
+        await _seed(1)
+        assert await _order() is not None
+        assert await _order() is None
+        assert await _stock() == 0
+        async with db.connection() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM sales_orders")
+            assert (await cur.fetchone())[0] == 1
+
+    run(scenario)
+
+
+def test_cancel_returns_the_unit_once(run):
+    from app import db
+    from app.stock import stock
+
+    async def scenario():
+        await _seed(1)
+        await stock.load()
+        order = await _order()
+        unreserved = await db.create_sales_order(user_id=8, sku="J-1", size="L")
+        assert await _stock() == 0 and stock.get("J-1", "L") == 0
+
+        assert (await db.cancel_sales_order(order["order_no"]))["stock_reserved"]
+        assert await _stock() == 1 and stock.get("J-1", "L") == 1
+        assert (await db.get_sales_order_by_no(order["order_no"]))["stage"] == "cancelled"
+
+        assert await db.cancel_sales_order(order["order_no"]) is None
+        await db.update_sales_order_stage(unreserved["order_no"], "cancelled")
+        assert await _stock() == 1
+        assert (await db.get_sales_order_by_no(unreserved["order_no"]))["stage"] == "cancelled"
+
+    run(scenario)
+
+
+def test_shipped_order_keeps_its_unit(run):
+    from app import db
+
+    async def scenario():
+        await _seed(1)
+        order = await _order()
+        await db.set_sales_order_tracking(order["order_no"], "CDEK", "123")
+        assert await db.cancel_sales_order(order["order_no"]) is None
+        assert await _stock() == 0
+
+    run(scenario)
+
+
+def test_unpaid_orders_expire_and_return_stock(run):
+    from app import db
+
+    async def scenario():
+        await _seed(3)
+        stale, paid, fresh = await _order(), await _order(), await _order()
+        await db.update_sales_order_stage(paid["order_no"], "packing")
+        async with db.writing() as conn:
+            await conn.execute(
+                "UPDATE sales_orders SET created_at = created_at - 7200 WHERE order_no IN (?, ?)",
+                (stale["order_no"], paid["order_no"]),
+            )
+        assert await _stock() == 0
+
+        assert await db.expire_unpaid_orders(1) == 1
+        assert await _stock() == 1
+        stages = [(await db.get_sales_order_by_no(o["order_no"]))["stage"] for o in (stale, paid, fresh)]
+        assert stages == ["cancelled", "packing", "waiting_payment"]
+
+    run(scenario)
+
+
+def test_memory_storage_reserves_and_returns_stock():
+    from app.storage import MemoryStorage
+
+    async def scenario():
+        m = MemoryStorage()
+        await m.upsert_product(
+            sku="J-1", title="Куртка", description="", gender="male", category="jacket",
+            season="winter", insulation="", material="", price=9000,
+        )
+        await m.set_variant_active("J-1", "L", True)
+        await m.set_variant_stock("J-1", "L", 1)
+
+        order = await m.create_sales_order(user_id=7, sku="J-1", size="l", reserve_stock=True)
+        assert await m.create_sales_order(user_id=7, sku="J-1", size="l", reserve_stock=True) is None
+        assert m.stock_level("J-1", "L") == 0
+        await m.update_sales_order_stage(order["order_no"], "cancelled")
+        assert m.stock_level("J-1", "L") == 1
+        assert await m.cancel_sales_order(order["order_no"]) is None
+
+    asyncio.run(scenario())
+
+
+def test_refresh_keeps_a_stock_write_made_during_its_read(run, monkeypatch):
+    from app import db
+    from app.stock import stock
+
+    async def scenario():
+        await _seed(5)
+        await stock.load()
+        fetch = stock._fetch
+        raced = []
+
+        async def slow_fetch(sku=None):
+            snapshot = await fetch(sku)
+            if not raced:
+                # A checkout commits after the read but before the refresh applies it.
+                raced.append(await db.adjust_variant_stock("J-1", "L", -1))
+            return snapshot
+
+        monkeypatch.setattr(stock, "_fetch", slow_fetch)
+        await stock.refresh("J-1")
+        assert raced and await _stock() == 4
+        assert stock.get("J-1", "L") == 4
+
+    run(scenario)
+
+
+def test_variant_writes_agree_on_the_size(run):
+    from app import db
+
+    async def scenario():
+        await _seed(0)
+        await db.set_variant_active("J-1", " m ", True)
+        assert await db.set_variant_stock("J-1", "m", 3) == 0
+        assert await db.adjust_variant_stock("J-1", "M", -1) == 2
+        async with db.connection() as conn:
+            cur = await conn.execute("SELECT size, stock FROM product_variants WHERE sku='J-1' ORDER BY size")
+            assert await cur.fetchall() == [("L", 0), ("M", 2)]
+
+    run(scenario)
+
+
+def test_memory_storage_variant_writes_agree_on_the_size():
+    from app.storage import MemoryStorage
+
+    async def scenario():
+        m = MemoryStorage()
+        await m.set_variant_active("J-1", "m", True)
+        assert await m.set_variant_stock("J-1", "m", 3) == 0
+        assert m.stock_level("J-1", "M") == 3
+
+    asyncio.run(scenario())
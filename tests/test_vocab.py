@@ -0,0 +1,55 @@
+import pytest
+
+from app.vocab import canonical, normalize_filters
+
+
+@pytest.mark.parametrize(
+    "facet, value, code",
+    [
+        # Exact labels, codes and synonyms.
+        ("category", "Спортивный костюм", "tracksuit"),
+        ("category", "hoodie", "hoodie"),
+        ("category", "t-shirt", "tshirt"),
+        ("season", "Весна-Осень", "autumn"),
+        ("gender", "для парня", "male"),
+        ("color", "light blue", "голуб"),
+        # Single words, inflected.
+        ("category", "толстовку", "hoodie"),
+        ("category", "штаны", "pants"),
+        ("category", "куртки", "jacket"),
+        ("season", "зимняя", "winter"),
+        ("season", "летняя", "summer"),
+        ("season", "демисезонная", "autumn"),
+        ("gender", "мужской", "male"),
+        ("gender", "женская", "female"),
+        ("color", "black", "черн"),
+        ("color", "Чёрный", "черн"),
+        ("color", "синюю", "син"),
+        # Multi-word phrases: the noun names the garment.
+        ("category", "спортивные штаны", "pants"),
+        ("category", "спортивная куртка", "jacket"),
+        ("category", "тёплая толстовка", "hoodie"),
+        ("category", "худи оверсайз", "hoodie"),
+        ("season", "куртка на зиму", "winter"),
+        ("color", "темно-синий", "син"),
+        # Adjectives that describe the garment, not a filter value.
+        ("season", "лёгкая", None),
+        ("season", "тёплая", None),
+        ("category", "спортивный", "tracksuit"),
+        ("category", "оверсайз", None),
+        ("color", "яркий", None),
+    ],
+)
+def test_canonical(facet, value, code):
+    assert canonical(facet, value) == code
+
+
+def test_normalize_filters_passes_unknown_values_through():
+    args = {"query": "худи", "category": "спортивные штаны", "season": "лёгкая", "color": "black", "limit": 3}
+    assert normalize_filters(args) == {
+        "query": "худи",
+        "category": "pants",
+        "season": "лёгкая",
+        "color": "черн",
+        "limit": 3,
+    }
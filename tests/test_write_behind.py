@@ -0,0 +1,50 @@
+async def _committed(user_id: int) -> tuple[str, int]:
+    from app import db
+
+    async with db.user_connection(user_id) as conn:
+        cur = await conn.execute("SELECT stage FROM sales_sessions WHERE user_id=?", (user_id,))
+        stage = (await cur.fetchone())[0]
+        cur = await conn.execute("SELECT COUNT(*) FROM conversation_messages WHERE user_id=?", (user_id,))
+        return stage, (await cur.fetchone())[0]
+
+
+def test_patch_buffers_session_with_messages(run, monkeypatch):
+    from app import db
+
+    async def scenario():
+        await db.upsert_sales_session(user_id=5, sku="J-1", stage="discovery", context={"size": "M"})
+        # A long interval: only the explicit flush below commits.
+        monkeypatch.setattr(db, "write_behind", db.WriteBehind(3600))
+
+        await db.patch_sales_session(
+            5,
+            stage="closing",
+            context_patch={"size": "L", "color": "черн"},
+            messages=[{"role": "user", "content": "Беру L"}, {"role": "assistant", "content": "Оформляю"}],
+        )
+        assert await _committed(5) == ("discovery", 0)
+        session = await db.get_sales_session(5)
+        assert session["stage"] == "closing"
+        assert session["context"] == {"size": "L", "color": "черн"}
+
+        await db.write_behind.flush()
+        assert await _committed(5) == ("closing", 2)
+        assert (await db.get_sales_session(5))["context"] == {"size": "L", "color": "черн"}
+
+    run(scenario)
+
+
+def test_patch_without_session_buffers_a_new_session(run, monkeypatch):
+    from app import db
+
+    async def scenario():
+        monkeypatch.setattr(db, "write_behind", db.WriteBehind(3600))
+        await db.patch_sales_session(
+            6, stage="profiling", context_patch={"gender": "male"}, messages=[{"role": "user", "content": "Привет"}]
+        )
+        await db.write_behind.flush()
+        session = await db.get_sales_session(6)
+        assert (session["stage"], session["context"]) == ("profiling", {"gender": "male"})
+        assert len(await db.get_recent_messages(6, 10)) == 1
+
+    run(scenario)
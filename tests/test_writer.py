@@ -0,0 +1,52 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+
+def test_locked_database_fails_the_waiting_caller(run, db_path, monkeypatch):
+    from app import db
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "DB_BUSY_TIMEOUT_MS", 100)
+
+    async def scenario():
+        await db.create_order(1, "new", {})  # opens the writer connection
+        outside = sqlite3.connect(db_path, isolation_level=None)
+        outside.execute("BEGIN IMMEDIATE")
+        try:
+            with pytest.raises(sqlite3.OperationalError, match="locked"):
+                await asyncio.wait_for(db.create_order(1, "new", {}), 3)
+        finally:
+            outside.execute("ROLLBACK")
+            outside.close()
+
+        # The writer survives and serves the next caller.
+        order_id = await asyncio.wait_for(db.create_order(1, "new", {}), 3)
+        async with db.connection() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM orders WHERE id = ?", (order_id,))
+            assert (await cur.fetchone())[0] == 1
+
+    run(scenario)
+
+
+def test_close_returns_while_lock_is_held(run, db_path, monkeypatch):
+    from app import db
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "DB_BUSY_TIMEOUT_MS", 100)
+
+    async def scenario():
+        await db.create_order(1, "new", {})  # opens the writer connection
+        outside = sqlite3.connect(db_path, isolation_level=None)
+        outside.execute("BEGIN IMMEDIATE")
+        try:
+            pending = [asyncio.create_task(db.create_order(2, "new", {})) for _ in range(3)]
+            results = await asyncio.wait_for(asyncio.gather(*pending, return_exceptions=True), 3)
+            assert all(isinstance(r, sqlite3.OperationalError) for r in results)
+            await asyncio.wait_for(db.close_db(), 3)
+        finally:
+            outside.execute("ROLLBACK")
+            outside.close()
+
+    run(scenario)